@@ -42,9 +42,110 @@ class GenerateSampleAdjacency(object):
         )
         return rand_matrix
 
-    def main(self):
+    @staticmethod
+    def create_dense_dataset(hdf5_handle, name, matrix, chromosomes, symmetric=False):
+        """
+        Store a matrix as a dense chunked dataset
+
+        Parameters
+        ----------
+        hdf5_handle : h5py.File
+        name : str
+            Name of the dataset, the resolution
+        matrix : numpy.ndarray
+            Square matrix of the values
+        chromosomes : list
+            List of [name, length] for each chromosome
+        symmetric : bool (Optional)
+            Only store the upper triangle of a symmetric matrix. The chunks
+            below the diagonal are never written, so take no space in the
+            file.
+        """
+        size = matrix.shape[0]
+        dset = hdf5_handle.create_dataset(
+            name,
+            (size, size),
+            dtype='int32',
+            chunks=True,
+            compression="gzip"
+        )
+        dset.attrs['chromosomes'] = chromosomes
+
+        if symmetric is False:
+            dset[0:size, 0:size] = matrix
+            return dset
+
+        dset.attrs['triangle'] = 'upper'
+        band = dset.chunks[0]
+        for start in range(0, size, band):
+            end = min(start + band, size)
+            dset[start:end, start:size] = np.triu(matrix[start:end, start:size])
+
+        return dset
+
+    @staticmethod
+    def create_sparse_dataset(  # pylint: disable=too-many-arguments
+            hdf5_handle, name, bin1, bin2, counts, size, chromosomes, symmetric=False):
+        """
+        Store the non-zero cells of a size x size matrix in the sparse
+        layout that is read by `reader.hdf5_adjacency`. The cells are sorted
+        into rows and indexed by the offset of the first cell of each row.
+
+        Parameters
+        ----------
+        hdf5_handle : h5py.File
+        name : str
+            Name of the group, the resolution
+        bin1, bin2 : numpy.ndarray
+            Row and column of each cell. Each cell should only be listed once.
+        counts : numpy.ndarray
+            Value of each cell
+        size : int
+            Number of bins in the matrix
+        chromosomes : list
+            List of [name, length] for each chromosome
+        symmetric : bool (Optional)
+            Only store the cells in the upper triangle of a symmetric matrix
+        """
+        bin1 = np.asarray(bin1, dtype=np.int64)
+        bin2 = np.asarray(bin2, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int32)
+
+        keep = counts != 0
+        if symmetric is True:
+            keep &= bin1 <= bin2
+        bin1, bin2, counts = bin1[keep], bin2[keep], counts[keep]
+
+        order = np.lexsort((bin2, bin1))
+        bin1, bin2, counts = bin1[order], bin2[order], counts[order]
+        offsets = np.zeros(size + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(bin1, minlength=size))
+
+        group = hdf5_handle.create_group(name)
+        group.attrs['chromosomes'] = chromosomes
+        group.attrs['shape'] = [size, size]
+        group.attrs['layout'] = 'sparse'
+        if symmetric is True:
+            group.attrs['triangle'] = 'upper'
+        for dset_name, values in [
+                ('bin1_offset', offsets), ('bin2_id', bin2), ('count', counts)]:
+            group.create_dataset(dset_name, data=values, chunks=True, compression="gzip")
+
+        return group
+
+    def main(self, layout="dense", filename=None, symmetric=False):
         """
         Main function
+
+        Parameters
+        ----------
+        layout : str (Optional)
+            Store each resolution as a "dense" (default) matrix or in the
+            "sparse" layout
+        filename : str (Optional)
+            Location of the file. Defaults to tests/data/sample_adjacency.hdf5
+        symmetric : bool (Optional)
+            Generate symmetric matrices and only store their upper triangle
         """
         resolutions = [10000, 100000, 1000000]
         chromosomes = [
@@ -60,7 +161,9 @@ class GenerateSampleAdjacency(object):
         d_size = sum([c[1] for c in chromosomes])
 
         # Create the HDF5 file
-        filename = os.path.join(os.path.dirname(__file__), "../tests/data/sample_adjacency.hdf5")
+        if filename is None:
+            filename = os.path.join(
+                os.path.dirname(__file__), "../tests/data/sample_adjacency.hdf5")
         hdf5_handle = h5py.File(filename, "w")
 
         for resolution in resolutions:
@@ -68,15 +171,14 @@ class GenerateSampleAdjacency(object):
             d_sample = np.zeros([local_size, local_size], dtype='int32')
             d_sample += self.create_matrix(local_size)
 
-            dset = hdf5_handle.create_dataset(
-                str(resolution),
-                (local_size, local_size),
-                dtype='int32',
-                chunks=True,
-                compression="gzip"
-            )
-            dset.attrs['chromosomes'] = chromosomes
-            dset[0:local_size, 0:local_size] += d_sample
+            if layout == "sparse":
+                bin1, bin2 = np.nonzero(d_sample)
+                self.create_sparse_dataset(
+                    hdf5_handle, str(resolution), bin1, bin2, d_sample[bin1, bin2],
+                    local_size, chromosomes, symmetric)
+            else:
+                self.create_dense_dataset(
+                    hdf5_handle, str(resolution), d_sample, chromosomes, symmetric)
 
         hdf5_handle.close()
 
@@ -16,6 +16,7 @@
 """
 
 # Required for importing the modules
+from .connection import connection_manager  # NOQA
 from .dmp import dmp  # NOQA
 from .rest import rest  # NOQA
 
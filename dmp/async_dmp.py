@@ -0,0 +1,596 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Asyncio version of the DMP API.
+
+`async_dmp` provides coroutine versions of the lookups, `set_file`,
+`get_file_history` and the meta data edits from `dmp`. The queries, document
+layout and validation all come from `dmp.queries`, which is shared with `dmp`
+so that the two stay in step; only the round trips to the database differ.
+
+Against a server the `motor` driver is used. This is only imported when it is
+needed, so it is not a dependency of the rest of the package. The in-memory
+backends (see `connection_manager`), including the sample data set from
+``dmp(test=True)`` when ``test=True``, are wrapped by `async_database` to
+provide the same interface as a motor database.
+"""
+
+from __future__ import print_function
+
+import asyncio
+import os
+import threading
+
+from bson.objectid import ObjectId
+from pymongo import ReadPreference
+from pymongo.errors import OperationFailure
+
+from dmp import queries, schema
+from dmp.cache import file_cache
+from dmp.connection import connection_manager
+from dmp.dmp import dmp
+
+
+class async_cursor(object):  # pylint: disable=invalid-name
+    """
+    Asynchronous wrapper for the cursor of an in-memory backend, with the
+    parts of the motor cursor interface used by `async_dmp`
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def sort(self, *args, **kwargs):
+        """
+        Order the results, see pymongo.cursor.Cursor.sort
+        """
+        self._cursor = self._cursor.sort(*args, **kwargs)
+        return self
+
+    def limit(self, limit):
+        """
+        Limit the number of results, see pymongo.cursor.Cursor.limit
+        """
+        self._cursor = self._cursor.limit(limit)
+        return self
+
+    def batch_size(self, batch_size):  # pylint: disable=unused-argument
+        """
+        Accepted for compatibility, all results are already in memory
+        """
+        return self
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._cursor)
+        except StopIteration:
+            raise StopAsyncIteration
+
+    async def to_list(self, length=None):
+        """
+        Get the results as a list
+
+        Parameters
+        ----------
+        length : int
+            Maximum number of results to return. All are returned if None.
+        """
+        results = []
+        async for document in self:
+            results.append(document)
+            if length is not None and len(results) >= length:
+                break
+        return results
+
+
+class async_collection(object):  # pylint: disable=invalid-name
+    """
+    Asynchronous wrapper for a collection of an in-memory backend. `find`
+    and `aggregate` return an `async_cursor`, and all other collection
+    methods become coroutines.
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def find(self, *args, **kwargs):
+        """
+        See pymongo.collection.Collection.find
+        """
+        return async_cursor(self._collection.find(*args, **kwargs))
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        See pymongo.collection.Collection.aggregate
+        """
+        return async_cursor(iter(self._collection.aggregate(pipeline, **kwargs)))
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return method(*args, **kwargs)
+
+        return call
+
+
+class async_database(object):  # pylint: disable=invalid-name
+    """
+    Asynchronous wrapper for the database of an in-memory backend, such as
+    the database from ``dmp(test=True)``
+    """
+
+    def __init__(self, db_handle):
+        self._db_handle = db_handle
+        self.name = db_handle.name
+
+    def __getitem__(self, name):
+        return async_collection(self._db_handle[name])
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+
+class async_dmp(object):  # pylint: disable=invalid-name
+    """
+    Coroutine based access to the DMP. See `dmp` for the full description of
+    each of the methods.
+
+    Example
+    -------
+    .. code-block:: python
+       :linenos:
+
+       import asyncio
+       from dmp.async_dmp import async_dmp
+
+       da = async_dmp('dmp.cnf')
+
+       async def main():
+           files = await da.get_files_by_file_type(<user_id>, 'bam')
+           history = await da.get_file_history(<user_id>, files[0]['_id'])
+
+       asyncio.get_event_loop().run_until_complete(main())
+    """
+
+    _lock = threading.Lock()
+    _pid = os.getpid()
+    _clients = {}
+
+    validate_file = staticmethod(dmp.validate_file)
+    validate_files = staticmethod(dmp.validate_files)
+    register_file_types = dmp.register_file_types
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, cnf_loc='', test=False, db_handle=None, cache_size=None, cache_ttl=None):
+        """
+        Initialise the module and setup parameters
+
+        Parameters
+        ----------
+        cnf_loc : str
+            Location of the configuration file
+        test : bool
+            Use an in-memory database loaded with the sample files
+        db_handle : Database (Optional)
+            An existing motor database, or `async_database`, to use instead
+            of the one in the configuration file
+        cache_size : int (Optional)
+            See `dmp`
+        cache_ttl : int (Optional)
+            See `dmp`
+        """
+        self.cnf_loc = cnf_loc
+        self._graph_lookup = None
+        self._db_handle = None
+        self._motor_params = None
+        self.cache = None
+        self.file_types = queries.DEFAULT_FILE_TYPES
+
+        if test is True:
+            self._db_handle = async_database(dmp(test=True).db_handle)
+            if cache_size:
+                self.cache = file_cache(cache_size, cache_ttl or 300)
+        elif db_handle is not None:
+            self._db_handle = db_handle
+            if cache_size:
+                self.cache = file_cache(cache_size, cache_ttl or 300)
+        else:
+            params = connection_manager.get_config(cnf_loc, "dmp")
+
+            # The schema version is checked with the shared synchronous
+            # client, once per process, before any coroutines are run
+            schema.check_version(
+                connection_manager.get_database(cnf_loc, "dmp"),
+                (os.path.abspath(cnf_loc), params["db"]))
+            if params["file_types"]:
+                self.register_file_types(queries.parse_file_types(params["file_types"]))
+
+            if params["backend"] == "mongodb":
+                # The motor client is only looked up once there is a loop
+                # to run it on, see db_handle
+                self._motor_params = params
+            else:
+                self._db_handle = async_database(connection_manager.get_database(cnf_loc, "dmp"))
+
+            if cache_size is None:
+                cache_size = params["cache_size"]
+            if cache_ttl is None:
+                cache_ttl = params["cache_ttl"]
+            if cache_size:
+                self.cache = file_cache.get_shared(
+                    (os.path.abspath(cnf_loc), params["db"]), cache_size, cache_ttl)
+
+    @property
+    def db_handle(self):
+        """
+        The database, from the motor client for the current event loop when
+        connected to a server
+        """
+        if self._motor_params is None:
+            return self._db_handle
+        return self._get_client(self.cnf_loc, self._motor_params)[self._motor_params["db"]]
+
+    @classmethod
+    def _get_client(cls, cnf_loc, params):
+        """
+        Get the motor client shared by all async_dmp objects in the process
+        for a configuration file and event loop
+
+        A motor client can only be used on the event loop that it was
+        created for, so each loop has its own client. Clients for loops that
+        have been closed are dropped, as are all clients inherited across a
+        fork (see `connection_manager`).
+        """
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        loop = asyncio.get_event_loop()
+        key = (os.path.abspath(cnf_loc), id(loop))
+        with cls._lock:
+            pid = os.getpid()
+            if pid != cls._pid:
+                cls._clients = {}
+                cls._pid = pid
+            cls._clients = dict(
+                (client_key, (client_loop, client))
+                for client_key, (client_loop, client) in cls._clients.items()
+                if not client_loop.is_closed()
+            )
+
+            if key not in cls._clients:
+                kwargs = {
+                    "read_preference": ReadPreference.SECONDARY_PREFERRED,
+                    "maxPoolSize": params["max_pool_size"],
+                    "minPoolSize": params["min_pool_size"]
+                }
+                if params["wait_queue_timeout_ms"] is not None:
+                    kwargs["waitQueueTimeoutMS"] = params["wait_queue_timeout_ms"]
+                if params["user"]:
+                    kwargs["username"] = params["user"]
+                    kwargs["password"] = params["pass"]
+                    kwargs["authSource"] = "admin"
+                cls._clients[key] = (
+                    loop,
+                    AsyncIOMotorClient(params["host"], params["port"], io_loop=loop, **kwargs))
+            return cls._clients[key][1]
+
+    def _invalidate(self, file_id):
+        """
+        Remove a file from the cache after it has been changed
+        """
+        if self.cache is not None:
+            self.cache.invalidate(file_id)
+
+    async def _get_rows(  # pylint: disable=too-many-arguments
+            self, user_id, key=None, value=None, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
+        """
+        List of the file dictionary objects for a query (see `dmp._get_rows`)
+        """
+        return [
+            entry async for entry in self._iter_rows(
+                user_id, key, value, rest, limit=limit, after=after, sort=sort,
+                fields=fields, exclude=exclude, owners=owners)
+        ]
+
+    async def _iter_rows(  # pylint: disable=too-many-arguments
+            self, user_id, key=None, value=None, rest=False, batch_size=None,
+            limit=None, after=None, sort=None, fields=None, exclude=None, owners=None):
+        """
+        Asynchronous generator version of `_get_rows`
+        """
+        row_filter, projection, order, limit = queries.row_query(
+            user_id, key, value, rest, limit, after, sort, fields, exclude, owners)
+
+        results = self.db_handle.entries.find(row_filter, projection)
+        if order is not None:
+            results = results.sort(order)
+        if limit is not None:
+            results = results.limit(limit)
+        if batch_size is not None:
+            results = results.batch_size(batch_size)
+
+        async for entry in results:
+            yield queries.format_entry(entry)
+
+    def iter_files(  # pylint: disable=too-many-arguments
+            self, user_id, key=None, value=None, rest=False, batch_size=1000,
+            limit=None, after=None, sort=None, fields=None, exclude=None, owners=None):
+        """
+        Asynchronously iterate over the file dictionary objects for a
+        `user_id` (see `dmp.iter_files`)
+
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           async for file_obj in da.iter_files(<user_id>, 'file_type', 'bam'):
+               print(file_obj['_id'])
+        """
+        return self._iter_rows(
+            str(user_id), key, value, rest, batch_size, limit=limit, after=after, sort=sort,
+            fields=fields, exclude=exclude, owners=owners)
+
+    async def get_file_by_id(  # pylint: disable=too-many-arguments
+            self, user_id, file_id, rest=False, fields=None, exclude=None):
+        """
+        Returns files data based on the unique_id for a given file (see
+        `dmp.get_file_by_id`)
+        """
+        cache_key = queries.projection_key(rest, fields, exclude)
+        generation = None
+        if self.cache is not None:
+            file_obj = self.cache.get(str(user_id), file_id, cache_key)
+            if file_obj is not None:
+                return file_obj
+            generation = self.cache.generation(file_id)
+
+        file_obj = await self._get_rows(
+            str(user_id), '_id', ObjectId(str(file_id)), rest, fields=fields, exclude=exclude)
+
+        if not file_obj:
+            return {"msg": "No files found"}
+
+        if self.cache is not None:
+            self.cache.set(str(user_id), file_id, file_obj[0], cache_key, generation)
+
+        return file_obj[0]
+
+    async def get_file_by_file_path(  # pylint: disable=too-many-arguments
+            self, user_id, file_path, rest=False, fields=None, exclude=None):
+        """
+        List of the files for a user at a `file_path` (see
+        `dmp.get_file_by_file_path`)
+        """
+        return await self._get_rows(
+            str(user_id), 'file_path', str(file_path), rest, fields=fields, exclude=exclude)
+
+    async def _get_files(  # pylint: disable=too-many-arguments
+            self, user_id, key, value, rest, limit, after, sort, fields, exclude, owners):
+        file_obj = await self._get_rows(
+            str(user_id), key, value, rest, limit=limit, after=after, sort=sort,
+            fields=fields, exclude=exclude, owners=owners)
+
+        if not file_obj:
+            return {"msg": "No files found"}
+
+        return file_obj
+
+    async def get_files_by_user(  # pylint: disable=too-many-arguments
+            self, user_id, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
+        """
+        List of the files that have been loaded by a user (see
+        `dmp.get_files_by_user`)
+        """
+        return await self._get_files(
+            user_id, None, None, rest, limit, after, sort, fields, exclude, owners)
+
+    async def get_files_by_file_type(  # pylint: disable=too-many-arguments
+            self, user_id, file_type, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
+        """
+        List of the files for a user with a `file_type` (see
+        `dmp.get_files_by_file_type`)
+        """
+        return await self._get_files(
+            user_id, "file_type", str(file_type), rest, limit, after, sort, fields, exclude, owners)
+
+    async def get_files_by_data_type(  # pylint: disable=too-many-arguments
+            self, user_id, data_type, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
+        """
+        List of the files for a user with a `data_type` (see
+        `dmp.get_files_by_data_type`)
+        """
+        return await self._get_files(
+            user_id, "data_type", str(data_type), rest, limit, after, sort, fields, exclude, owners)
+
+    async def get_files_by_taxon_id(  # pylint: disable=too-many-arguments
+            self, user_id, taxon_id, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
+        """
+        List of the files for a user with a `taxon_id` (see
+        `dmp.get_files_by_taxon_id`)
+        """
+        return await self._get_files(
+            user_id, "taxon_id", int(taxon_id), rest, limit, after, sort, fields, exclude, owners)
+
+    async def get_files_by_assembly(  # pylint: disable=too-many-arguments
+            self, user_id, assembly, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
+        """
+        List of the files for a user with an `assembly` (see
+        `dmp.get_files_by_assembly`)
+        """
+        return await self._get_files(
+            user_id, "meta_data.assembly", str(assembly), rest, limit, after, sort,
+            fields, exclude, owners)
+
+    async def _get_file_parents_graph(self, user_id, file_id, max_depth=None):
+        """
+        See `dmp._get_file_parents_graph`
+        """
+        parent_files = []
+        pipeline = queries.graph_pipeline(user_id, file_id, max_depth)
+        async for file_obj in self.db_handle.entries.aggregate(pipeline):
+            parent_files += queries.graph_links(file_id, file_obj)
+        return parent_files
+
+    async def _get_file_parents_bfs(self, user_id, file_id, max_depth=None):
+        """
+        See `dmp._get_file_parents_bfs`
+        """
+        walk = queries.parent_walk(user_id, file_id, max_depth)
+        query = walk.next_query()
+        while query is not None:
+            async for file_obj in self.db_handle.entries.find(*query):
+                walk.add(file_obj)
+            query = walk.next_query()
+
+        return walk.links
+
+    async def get_file_history(self, user_id, file_id, max_depth=None):
+        """
+        Returns the list of [child, parent] file_id pairs from the current
+        file to the original file(s) (see `dmp.get_file_history`)
+        """
+        if max_depth is not None and max_depth < 1:
+            return []
+
+        parent_files = None
+        if self._graph_lookup is not False:
+            try:
+                parent_files = await self._get_file_parents_graph(user_id, file_id, max_depth)
+                self._graph_lookup = True
+            except (OperationFailure, NotImplementedError):
+                self._graph_lookup = False
+
+        if parent_files is None:
+            parent_files = await self._get_file_parents_bfs(user_id, file_id, max_depth)
+
+        return queries.unique_links(parent_files)
+
+    async def _resolve_ancestors(self, user_id, parent_dir):
+        """
+        See `dmp._resolve_ancestors`
+        """
+        query = queries.parent_query(user_id, parent_dir)
+        if query is None:
+            return []
+        return queries.child_ancestors(await self.db_handle.entries.find_one(*query))
+
+    async def _move_subtree(self, user_id, file_id, ancestors):
+        """
+        See `dmp._move_subtree`
+        """
+        entries = self.db_handle.entries
+
+        below = await entries.find(*queries.subtree_query(user_id, file_id)).to_list(None)
+        await entries.bulk_write(queries.move_requests(file_id, ancestors, below), ordered=False)
+        for entry in below:
+            self._invalidate(entry["_id"])
+
+    async def _update_usage(self, user_id, files, size):
+        """
+        Increment the stored usage counters for a user
+        """
+        await self.db_handle.usage.update_one(
+            {"_id": user_id}, {"$inc": {"files": files, "size": size}}, upsert=True)
+
+    async def set_file(  # pylint: disable=too-many-arguments
+            self, user_id, file_path, path_type, file_type="", size=0, parent_dir="",
+            data_type="", taxon_id="", compressed=None, source_id=None, meta_data=None,
+            **kwargs):
+        """
+        Adds a file to the data management API (see `dmp.set_file`)
+
+        Returns
+        -------
+        str
+            The id for the file
+        """
+        entry = queries.build_entry(
+            user_id, file_path, path_type, file_type, size, parent_dir, data_type,
+            taxon_id, compressed, source_id, meta_data, **kwargs)
+
+        self.validate_file(entry, self.file_types)
+
+        entry["ancestors"] = await self._resolve_ancestors(user_id, parent_dir)
+
+        result = await self.db_handle.entries.insert_one(entry)
+        await self._update_usage(user_id, 1, entry["size"])
+        return str(result.inserted_id)
+
+    async def add_file_metadata(self, user_id, file_id, key, value):
+        """
+        Add a key value pair to the meta data for a file (see
+        `dmp.add_file_metadata`)
+        """
+        path = 'meta_data.' + str(key)
+        await self._update_and_validate(user_id, file_id, path, value)
+
+        return file_id
+
+    async def remove_file_metadata(self, user_id, file_id, key):
+        """
+        Remove a key value pair from the meta data for a given file (see
+        `dmp.remove_file_metadata`)
+        """
+        path = 'meta_data.' + str(key)
+        await self._update_and_validate(user_id, file_id, path, queries.UNSET)
+
+        return file_id
+
+    async def modify_column(self, user_id, file_id, key, value):
+        """
+        Update a key value pair for the record (see `dmp.modify_column`)
+        """
+        value = queries.column_value(key, value)
+
+        if str(key) == 'parent_dir':
+            ancestors = await self._resolve_ancestors(user_id, value)
+            queries.check_move(file_id, ancestors)
+
+        old_value = await self._update_and_validate(user_id, file_id, str(key), value)
+
+        if str(key) == 'size':
+            await self._update_usage(user_id, 0, value - (old_value or 0))
+
+        if str(key) == 'parent_dir':
+            await self._move_subtree(user_id, file_id, ancestors)
+
+        return file_id
+
+    async def _update_and_validate(self, user_id, file_id, path, value):
+        """
+        See `dmp._update_and_validate`
+        """
+        entries = self.db_handle.entries
+        change = queries.field_update(user_id, file_id, path, value, self.file_types)
+
+        for row_filter in change.attempts():
+            guard = change.guard(await entries.find_one(row_filter))
+            result = await entries.update_one(guard, change.update)
+            if result.matched_count == 1:
+                self._invalidate(file_id)
+                return change.old_value
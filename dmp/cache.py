@@ -0,0 +1,365 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import collections
+import copy
+import logging
+import threading
+import time
+
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger("dmp.cache")  # pylint: disable=invalid-name
+
+
+class file_cache(object):  # pylint: disable=invalid-name
+    """
+    In-process LRU cache with a time to live for the file records returned by
+    `dmp.get_file_by_id`.
+
+    Entries are keyed on (`file_id`, `user_id`, `rest`) and can be invalidated
+    for a file_id, either by the dmp methods that modify a file or by a
+    change stream listener that sees writes from other processes. Once a
+    listener has been started the cache is bypassed whenever its change
+    stream is not open, as changes from other processes could be missed.
+
+    Each invalidation also moves on the generation of the file, so that a
+    record read from the database before a write is not cached after it.
+    """
+
+    _registry_lock = threading.Lock()
+    _registry = {}
+
+    # Seconds to wait before reopening a change stream that failed, doubled
+    # after each failure up to MAX_RETRY_DELAY
+    RETRY_DELAY = 1.0
+    MAX_RETRY_DELAY = 60.0
+
+    # Longest time that the listener waits on the change stream before it
+    # checks whether it has been stopped
+    MAX_AWAIT_TIME_MS = 500
+
+    def __init__(self, max_size=10000, ttl=300):
+        """
+        Parameters
+        ----------
+        max_size : int
+            Maximum number of records to keep
+        ttl : int
+            Number of seconds that a record is kept for
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._keys_by_file = {}
+        # Generation of the files that were invalidated most recently, the
+        # others are at the floor generation
+        self._generation = 0
+        self._floor = 0
+        self._generations = collections.OrderedDict()
+        self._listener = None
+        self._watching = False
+        self._stop = threading.Event()
+        self.counters = {
+            "hits": 0,
+            "misses": 0,
+            "evictions": 0,
+            "expirations": 0,
+            "invalidations": 0,
+            "bypassed": 0,
+            "stream_errors": 0
+        }
+
+    @classmethod
+    def get_shared(cls, key, max_size=10000, ttl=300):
+        """
+        Get the cache that is shared by all dmp objects within the process for
+        a configuration. The size and ttl are only used when the cache is first
+        created.
+
+        Parameters
+        ----------
+        key : tuple
+            Identifier for the configuration
+        """
+        with cls._registry_lock:
+            if key not in cls._registry:
+                cls._registry[key] = cls(max_size, ttl)
+            return cls._registry[key]
+
+    def get(self, user_id, file_id, rest=False):
+        """
+        Get a copy of a cached file record
+
+        Returns
+        -------
+        dict
+            The file record, or None if it is not in the cache
+        """
+        key = (str(file_id), user_id, rest)
+        with self._lock:
+            if self._bypassed():
+                self.counters["bypassed"] += 1
+                return None
+
+            if key not in self._entries:
+                self.counters["misses"] += 1
+                return None
+
+            expires, value = self._entries[key]
+            if expires < time.time():
+                self._remove(key)
+                self.counters["expirations"] += 1
+                self.counters["misses"] += 1
+                return None
+
+            # Move the key to the most recently used end
+            self._entries[key] = self._entries.pop(key)
+            self.counters["hits"] += 1
+
+        return copy.deepcopy(value)
+
+    def generation(self, file_id):
+        """
+        Get the invalidation generation of a file. This should be read before
+        the record is fetched from the database and passed to `set`.
+
+        Returns
+        -------
+        int
+        """
+        with self._lock:
+            return self._generations.get(str(file_id), self._floor)
+
+    def set(self, user_id, file_id, value, rest=False, generation=None):
+        """
+        Add a file record to the cache
+
+        Parameters
+        ----------
+        generation : int
+            Generation of the file from `generation` when the record was read.
+            The record is not cached if the file has been invalidated since.
+        """
+        key = (str(file_id), user_id, rest)
+        with self._lock:
+            if self._bypassed():
+                return
+            if generation is not None and generation != self._generations.get(
+                    key[0], self._floor):
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + self.ttl, copy.deepcopy(value))
+            self._keys_by_file.setdefault(key[0], set()).add(key)
+
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.counters["evictions"] += 1
+
+    def invalidate(self, file_id):
+        """
+        Remove all cached records for a file_id
+        """
+        with self._lock:
+            self._generation += 1
+            self._generations.pop(str(file_id), None)
+            self._generations[str(file_id)] = self._generation
+            while len(self._generations) > self.max_size:
+                # Files that are dropped move up to the floor generation
+                self._floor = self._generations.popitem(last=False)[1]
+
+            keys = self._keys_by_file.get(str(file_id), set())
+            if keys:
+                self.counters["invalidations"] += 1
+            for key in list(keys):
+                self._remove(key)
+
+    def clear(self):
+        """
+        Remove all records from the cache
+        """
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        """
+        Remove all records and move every file on to a new generation. Must be
+        called with the lock held.
+        """
+        self._entries.clear()
+        self._keys_by_file = {}
+        self._generation += 1
+        self._floor = self._generation
+        self._generations.clear()
+
+    def _bypassed(self):
+        """
+        The cache is not used while a listener is running without an open
+        change stream. Must be called with the lock held.
+        """
+        return self._listener is not None and not self._watching
+
+    def _remove(self, key):
+        del self._entries[key]
+        keys = self._keys_by_file[key[0]]
+        keys.discard(key)
+        if not keys:
+            del self._keys_by_file[key[0]]
+
+    def get_stats(self):
+        """
+        Snapshot of the cache counters
+
+        Returns
+        -------
+        dict
+            hits : int
+            misses : int
+            evictions : int
+                Records removed to keep the cache within max_size
+            expirations : int
+                Records found to be older than the ttl
+            invalidations : int
+                Files removed from the cache due to a write
+            bypassed : int
+                Lookups that were not served while the change stream of the
+                listener was not open
+            stream_errors : int
+                Number of times that the change stream failed
+            size : int
+                Number of records currently in the cache
+            watching : bool
+                The change stream of the listener is open
+        """
+        with self._lock:
+            stats = dict(self.counters)
+            stats["size"] = len(self._entries)
+            stats["watching"] = self._watching
+        return stats
+
+    def _handle_change(self, change):
+        """
+        Invalidate the cached records for a change stream event
+        """
+        if change.get("operationType") == "invalidate":
+            self.clear()
+        elif "documentKey" in change:
+            self.invalidate(change["documentKey"]["_id"])
+
+    def _watch(self, collection):
+        """
+        Follow the change stream until the listener is stopped. If the stream
+        fails then the error is logged and the stream is reopened, after a
+        delay that increases with each failure, from the last change that was
+        seen. The cache is bypassed until the stream is open again.
+        """
+        pipeline = [{"$match": {"operationType": {"$in": [
+            "update", "replace", "delete", "invalidate"]}}}]
+        resume_token = None
+        delay = self.RETRY_DELAY
+
+        while not self._stop.is_set():
+            try:
+                with collection.watch(
+                        pipeline, resume_after=resume_token,
+                        max_await_time_ms=self.MAX_AWAIT_TIME_MS) as stream:
+                    with self._lock:
+                        if resume_token is None:
+                            # Changes may have been missed before the stream
+                            # was opened
+                            self._clear()
+                        self._watching = True
+                    delay = self.RETRY_DELAY
+
+                    while not self._stop.is_set():
+                        change = stream.try_next()
+                        if change is not None:
+                            self._handle_change(change)
+                            resume_token = change.get("_id")
+            except PyMongoError as err:
+                with self._lock:
+                    opened = self._watching
+                    self._watching = False
+                    self.counters["stream_errors"] += 1
+                if not opened and isinstance(err, OperationFailure):
+                    # The server could not resume the stream from the token,
+                    # eg as it is no longer in the oplog
+                    resume_token = None
+                logger.warning(
+                    "Change stream for the file cache failed, retrying in %.1fs: %s",
+                    delay, err)
+            finally:
+                with self._lock:
+                    self._watching = False
+
+            self._stop.wait(delay)
+            delay = min(delay * 2, self.MAX_RETRY_DELAY)
+
+    def start_listener(self, collection):
+        """
+        Start a daemon thread that follows the change stream for the entries
+        collection and invalidates records that are modified by other
+        processes. Change streams require a replica set. The cache is not
+        used until the change stream is open. Does nothing while a listener
+        thread is running, including one that is being stopped.
+
+        Parameters
+        ----------
+        collection : Collection
+            The entries collection
+        """
+        with self._lock:
+            if self._listener is not None:
+                return
+            self._stop.clear()
+            self._listener = threading.Thread(target=self._watch, args=(collection,))
+            self._listener.daemon = True
+        self._listener.start()
+
+    def stop_listener(self, timeout=None):
+        """
+        Stop the change stream listener and wait for its thread to finish.
+        The listener notices within MAX_AWAIT_TIME_MS that it has been
+        stopped. If the thread is still running after the timeout then it is
+        kept as the listener, so that a second one can not be started.
+
+        Parameters
+        ----------
+        timeout : float
+            Number of seconds to wait for the thread, waits until it has
+            finished if None
+
+        Returns
+        -------
+        threading.Thread
+            The listener thread, or None if there was no listener
+        """
+        with self._lock:
+            listener = self._listener
+        if listener is None:
+            return None
+
+        self._stop.set()
+        listener.join(timeout)
+        with self._lock:
+            if not listener.is_alive() and self._listener is listener:
+                self._listener = None
+        return listener
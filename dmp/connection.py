@@ -0,0 +1,464 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import os
+import threading
+import configparser
+
+from pymongo import MongoClient, ReadPreference
+from pymongo import monitoring
+
+
+class pool_stats(monitoring.ConnectionPoolListener):  # pylint: disable=invalid-name
+    """
+    Connection pool listener that keeps running counts of the pool events for
+    a shared client so that the pool can be sized from real usage.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {
+            "pools_created": 0,
+            "pools_cleared": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "checkins": 0,
+            "waits": 0,
+            "waiting": 0,
+            "max_waiting": 0,
+            "in_use": 0,
+            "max_in_use": 0,
+            "open_sockets": 0,
+            "sockets_created": 0,
+            "sockets_closed": 0,
+        }
+
+    def _incr(self, key, value=1):
+        self.counters[key] += value
+
+    def get_stats(self):
+        """
+        Snapshot of the current counters
+
+        Returns
+        -------
+        dict
+            checkouts : int
+                Number of connections successfully checked out of the pool
+            checkout_failures : int
+                Number of checkouts that failed or timed out
+            checkins : int
+                Number of connections returned to the pool
+            waits : int
+                Number of checkouts that had to wait while others were still
+                queued for a connection
+            waiting : int
+                Number of checkouts currently queued
+            in_use : int
+                Number of connections currently checked out
+            open_sockets : int
+                Number of sockets currently open to the server
+        """
+        with self._lock:
+            return dict(self.counters)
+
+    def pool_created(self, event):
+        with self._lock:
+            self._incr("pools_created")
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self._incr("pools_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self._incr("sockets_created")
+            self._incr("open_sockets")
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        with self._lock:
+            self._incr("sockets_closed")
+            self._incr("open_sockets", -1)
+
+    def connection_check_out_started(self, event):
+        with self._lock:
+            if self.counters["waiting"] > 0:
+                self._incr("waits")
+            self._incr("waiting")
+            self.counters["max_waiting"] = max(
+                self.counters["max_waiting"], self.counters["waiting"])
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self._incr("waiting", -1)
+            self._incr("checkout_failures")
+
+    def connection_checked_out(self, event):
+        with self._lock:
+            self._incr("waiting", -1)
+            self._incr("checkouts")
+            self._incr("in_use")
+            self.counters["max_in_use"] = max(
+                self.counters["max_in_use"], self.counters["in_use"])
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self._incr("checkins")
+            self._incr("in_use", -1)
+
+
+def _mongodb_client(params, stats):
+    """
+    Create a lazily connecting pooled client for a MongoDB server
+    """
+    kwargs = {
+        "read_preference": ReadPreference.SECONDARY_PREFERRED,
+        "maxPoolSize": params["max_pool_size"],
+        "minPoolSize": params["min_pool_size"],
+        "connect": False,
+        "event_listeners": [stats]
+    }
+    if params["wait_queue_timeout_ms"] is not None:
+        kwargs["waitQueueTimeoutMS"] = params["wait_queue_timeout_ms"]
+    if params["user"]:
+        kwargs["username"] = params["user"]
+        kwargs["password"] = params["pass"]
+        kwargs["authSource"] = "admin"
+
+    return MongoClient(params["host"], params["port"], **kwargs)
+
+
+def _memory_client(params, stats):  # pylint: disable=unused-argument
+    """
+    Create an in-memory client with indexes (see `dmp.memory`)
+    """
+    from dmp.memory import memory_client
+    return memory_client()
+
+
+def _mongomock_client(params, stats):  # pylint: disable=unused-argument
+    """
+    Create a mongomock client
+    """
+    import mongomock
+    return mongomock.MongoClient()
+
+
+class connection_manager(object):  # pylint: disable=invalid-name
+    """
+    Process wide registry of MongoClient objects keyed on the location of the
+    configuration file and the section within it.
+
+    A MongoClient is thread-safe and maintains its own connection pool, so a
+    single client per configuration is shared between all dmp and reader
+    objects in a process. Clients are created lazily (``connect=False``) and
+    the registry is reset if the process has been forked so that a child
+    never reuses the sockets of its parent.
+
+    The configuration section can define the following optional parameters
+    alongside host, port, user, pass and db:
+
+    .. code-block:: none
+
+       max_pool_size = 100
+       min_pool_size = 0
+       wait_queue_timeout_ms = 1000
+
+    The storage backend defaults to a MongoDB server. The in-memory backend
+    from `dmp.memory`, or mongomock, can be used instead, in which case the
+    connection parameters are ignored and the data is shared by all objects in
+    the process that use the configuration:
+
+    .. code-block:: none
+
+       backend = memory
+
+    Further backends can be added with `register_backend`.
+
+    As well as the settings for the `dmp.cache.file_cache`:
+
+    .. code-block:: none
+
+       cache_size = 10000
+       cache_ttl = 300
+       cache_watch = 1
+
+    and extra file types for `dmp.validate_file`, with the fields that each
+    requires in the meta_data:
+
+    .. code-block:: none
+
+       file_types = vcf:assembly, cram:assembly, xml
+
+    Calls to the dmp methods can be recorded by the sinks of a
+    `dmp.instrumentation.query_recorder`, with calls slower than
+    `slow_query_ms` written to the "dmp.slow_query" log. The bytes returned
+    are only counted with `instrumentation_bytes`:
+
+    .. code-block:: none
+
+       instrumentation = prometheus, log
+       instrumentation_bytes = 1
+       slow_query_ms = 250
+    """
+
+    _lock = threading.Lock()
+    _pid = os.getpid()
+    _clients = {}
+
+    # Factory for the client of each storage backend, called with the
+    # configuration parameters and the pool_stats listener
+    _backends = {
+        "mongodb": _mongodb_client,
+        "memory": _memory_client,
+        "mongomock": _mongomock_client,
+    }
+
+    @classmethod
+    def _check_fork(cls):
+        """
+        Drop all clients inherited across a fork. The inherited clients are
+        not closed as their sockets still belong to the parent process.
+        """
+        pid = os.getpid()
+        if pid != cls._pid:
+            cls._clients = {}
+            cls._pid = pid
+
+    @staticmethod
+    def _key(cnf_loc, section):
+        return (os.path.abspath(cnf_loc) if cnf_loc else '', section)
+
+    @staticmethod
+    def _read_config(cnf_loc, section):
+        """
+        Load the connection parameters from the configuration file
+        """
+        config = configparser.RawConfigParser()
+        config.read(cnf_loc)
+
+        backend = "mongodb"
+        if config.has_option(section, "backend"):
+            backend = config.get(section, "backend")
+
+        if backend == "mongodb":
+            params = {
+                "host": config.get(section, "host"),
+                "port": config.getint(section, "port"),
+                "user": config.get(section, "user"),
+                "pass": config.get(section, "pass"),
+                "db": config.get(section, "db"),
+            }
+        else:
+            params = {
+                "host": None,
+                "port": None,
+                "user": "",
+                "pass": "",
+                "db": config.get(section, "db") if config.has_option(section, "db") else section,
+            }
+
+        params.update({
+            "backend": backend,
+            "max_pool_size": 100,
+            "min_pool_size": 0,
+            "wait_queue_timeout_ms": None,
+            "cache_size": 0,
+            "cache_ttl": 300,
+            "cache_watch": 0,
+            "file_types": "",
+            "instrumentation": "",
+            "instrumentation_bytes": 0,
+            "slow_query_ms": 0
+        })
+
+        for option in [
+                "max_pool_size", "min_pool_size", "wait_queue_timeout_ms",
+                "cache_size", "cache_ttl", "cache_watch", "slow_query_ms",
+                "instrumentation_bytes"]:
+            if config.has_option(section, option):
+                params[option] = config.getint(section, option)
+        for option in ["file_types", "instrumentation"]:
+            if config.has_option(section, option):
+                params[option] = config.get(section, option)
+
+        return params
+
+    @classmethod
+    def _create_client(cls, params):
+        """
+        Create the client for the backend in the given parameters
+        """
+        if params["backend"] not in cls._backends:
+            raise ValueError("Unknown storage backend: " + str(params["backend"]))
+        stats = pool_stats()
+        client = cls._backends[params["backend"]](params, stats)
+        return {"client": client, "db": params["db"], "stats": stats, "params": params}
+
+    @classmethod
+    def register_backend(cls, name, factory):
+        """
+        Add a storage backend that can be selected with the `backend`
+        parameter of the configuration file or the `backend` argument of
+        `create_client`
+
+        Parameters
+        ----------
+        name : str
+            Name of the backend
+        factory : function
+            Called with the dict of configuration parameters and a
+            `pool_stats` listener. Returns an object with the pymongo
+            MongoClient interface.
+        """
+        with cls._lock:
+            cls._backends[name] = factory
+
+    @classmethod
+    def create_client(cls, backend="memory"):
+        """
+        Create a new client that is not shared, for testing
+
+        Parameters
+        ----------
+        backend : str
+            Name of the storage backend, "memory" (default) or "mongomock"
+
+        Returns
+        -------
+        MongoClient
+        """
+        if backend not in cls._backends:
+            raise ValueError("Unknown storage backend: " + str(backend))
+        return cls._backends[backend]({}, pool_stats())
+
+    @classmethod
+    def _get_entry(cls, cnf_loc, section, **kwargs):
+        key = cls._key(cnf_loc, section)
+        with cls._lock:
+            cls._check_fork()
+            if key not in cls._clients:
+                params = cls._read_config(cnf_loc, section)
+                params.update(kwargs)
+                cls._clients[key] = cls._create_client(params)
+            return cls._clients[key]
+
+    @classmethod
+    def get_client(cls, cnf_loc='', section='dmp', **kwargs):
+        """
+        Get the shared client for a configuration
+
+        Parameters
+        ----------
+        cnf_loc : str
+            Location of the configuration file
+        section : str
+            Section of the configuration file with the connection parameters
+        max_pool_size : int (Optional)
+            Override the pool size from the configuration file. Only used when
+            the client is first created.
+
+        Returns
+        -------
+        MongoClient
+        """
+        return cls._get_entry(cnf_loc, section, **kwargs)["client"]
+
+    @classmethod
+    def get_database(cls, cnf_loc='', section='dmp', **kwargs):
+        """
+        Get a handle to the database defined in the configuration, using the
+        shared client
+
+        Parameters
+        ----------
+        cnf_loc : str
+            Location of the configuration file
+        section : str
+            Section of the configuration file with the connection parameters
+
+        Returns
+        -------
+        Database
+        """
+        entry = cls._get_entry(cnf_loc, section, **kwargs)
+        return entry["client"][entry["db"]]
+
+    @classmethod
+    def get_config(cls, cnf_loc='', section='dmp'):
+        """
+        Parameters that were loaded from the configuration file for the shared
+        client
+
+        Parameters
+        ----------
+        cnf_loc : str
+            Location of the configuration file
+        section : str
+            Section of the configuration file with the connection parameters
+
+        Returns
+        -------
+        dict
+        """
+        return dict(cls._get_entry(cnf_loc, section)["params"])
+
+    @classmethod
+    def get_pool_stats(cls, cnf_loc='', section='dmp'):
+        """
+        Pool statistics for the shared client of a configuration
+
+        Parameters
+        ----------
+        cnf_loc : str
+            Location of the configuration file
+        section : str
+            Section of the configuration file with the connection parameters
+
+        Returns
+        -------
+        dict
+            See `pool_stats.get_stats`. Empty if no client has been created
+            for the configuration in this process.
+        """
+        key = cls._key(cnf_loc, section)
+        with cls._lock:
+            cls._check_fork()
+            if key not in cls._clients:
+                return {}
+            return cls._clients[key]["stats"].get_stats()
+
+    @classmethod
+    def close_all(cls):
+        """
+        Close all shared clients and empty the registry
+        """
+        with cls._lock:
+            for entry in cls._clients.values():
+                entry["client"].close()
+            cls._clients = {}
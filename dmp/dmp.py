@@ -17,16 +17,24 @@
 
 from __future__ import print_function, unicode_literals
 
+import copy
 import datetime
 import os
 import random
 import sys
-import configparser
 
 import pymongo
-from pymongo import MongoClient, ReadPreference
-import bson
 from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, OperationFailure
+
+from dmp.cache import file_cache
+from dmp.connection import connection_manager
+from dmp.instrumentation import instrumented_database, query_recorder
+from dmp import queries, schema
+from dmp.queries import parse_file_types
+# Re-exported as they were defined here before they moved to dmp.queries
+from dmp.queries import (  # noqa: F401 pylint: disable=unused-import
+    FILE_TYPES, PATH_TYPES, PROJECTIONS, ENTRY_FIELDS)
 
 from dm_generator.GenerateSampleBigBed import GenerateSampleBigBed
 from dm_generator.GenerateSampleBigWig import GenerateSampleBigWig
@@ -39,51 +47,174 @@ class dmp(object):  # pylint: disable=invalid-name
     API for management of files within the VRE
     """
 
-    def __init__(self, cnf_loc='', test=False):
+    # Public methods that are recorded when instrumentation is enabled
+    _INSTRUMENTED = (
+        "iter_files", "get_file_by_id", "get_file_by_file_path", "get_files_by_user",
+        "get_files_by_file_type", "get_files_by_data_type", "get_files_by_taxon_id",
+        "get_files_by_assembly", "get_file_history", "get_file_descendants", "remove_file",
+        "remove_files", "list_dir", "get_dir_usage", "rebuild_usage", "get_user_usage",
+        "get_usage_summary", "purge_expired", "set_file", "set_files", "add_file_metadata",
+        "remove_file_metadata", "modify_column", "bulk_update_metadata"
+    )
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, cnf_loc='', test=False, cache_size=None, cache_ttl=None, backend="memory",
+            sample_data=True, instrumentation=None):
         """
         Initialise the module and setup parameters
+
+        Parameters
+        ----------
+        cnf_loc : str
+            Location of the configuration file
+        test : bool
+            Use an in-memory test database loaded with sample files
+        cache_size : int (Optional)
+            Number of records to keep in the `get_file_by_id` cache. Defaults
+            to the `cache_size` in the configuration file. Set to 0 to disable
+            the cache.
+        cache_ttl : int (Optional)
+            Number of seconds to keep records in the cache for. Defaults to the
+            `cache_ttl` in the configuration file.
+        backend : str (Optional)
+            Storage backend for the test database, "memory" (default) or
+            "mongomock". Outside of testing the backend is set by the
+            configuration file (see `connection_manager`).
+        sample_data : bool (Optional)
+            Load the sample files into the test database. Set to False to
+            start with an empty database.
+        instrumentation : dmp.instrumentation.query_recorder (Optional)
+            Record the calls to the public methods. Defaults to the
+            `instrumentation` sinks in the configuration file.
         """
 
-        config = configparser.RawConfigParser()
-        config.read(cnf_loc)
+        self.cnf_loc = cnf_loc
+        self._graph_lookup = None
+        self.cache = None
+        self.instrumentation = None
+        self.file_types = queries.DEFAULT_FILE_TYPES
 
         if test is True:
-            import mongomock
-            self.client = mongomock.MongoClient()
+            self.client = connection_manager.create_client(backend)
             self.db_handle = self.client["dmp"]
-            self._test_loading_dataset()
         else:
-            host = config.get("dmp", "host")
-            port = config.getint("dmp", "port")
-            user = config.get("dmp", "user")
-            password = config.get("dmp", "pass")
-            dmp_db = config.get("dmp", "db")
-
             try:
-                self.client = MongoClient(
-                    host, port,
-                    read_preference=ReadPreference.SECONDARY_PREFERRED
-                )
-                self.client.admin.authenticate(user, password)
-                self.db_handle = self.client[dmp_db]
+                self.client = connection_manager.get_client(cnf_loc, "dmp")
+                self.db_handle = connection_manager.get_database(cnf_loc, "dmp")
             except RuntimeError:
                 error = sys.exc_info()[0]
                 print("Error: %s" % error)
                 sys.exit(1)
 
         self.entries = self.db_handle.entries
-        self.db_handle.entries.create_index(
-            [('user_id', pymongo.ASCENDING)],
-            unique=False, background=True)
-        self.db_handle.entries.create_index(
-            [('user_id', pymongo.ASCENDING), ('file_type', pymongo.ASCENDING)],
-            unique=False, background=True)
-        self.db_handle.entries.create_index(
-            [('user_id', pymongo.ASCENDING), ('data_type', pymongo.ASCENDING)],
-            unique=False, background=True)
-        self.db_handle.entries.create_index(
-            [('user_id', pymongo.ASCENDING), ('taxon_id', pymongo.ASCENDING)],
-            unique=False, background=True)
+        if test is True:
+            schema.ensure_indexes(self.db_handle)
+            if sample_data is True:
+                self._test_loading_dataset()
+            if cache_size:
+                self.cache = file_cache(cache_size, cache_ttl or 300)
+        else:
+            schema.check_version(
+                self.db_handle, (os.path.abspath(cnf_loc), self.db_handle.name))
+
+            params = connection_manager.get_config(cnf_loc, "dmp")
+            if params["file_types"]:
+                self.register_file_types(parse_file_types(params["file_types"]))
+            if cache_size is None:
+                cache_size = params["cache_size"]
+            if cache_ttl is None:
+                cache_ttl = params["cache_ttl"]
+            if cache_size:
+                self.cache = file_cache.get_shared(
+                    (os.path.abspath(cnf_loc), self.db_handle.name), cache_size, cache_ttl)
+                if params["cache_watch"]:
+                    self.cache.start_listener(self.entries)
+            if instrumentation is None and params["instrumentation"]:
+                instrumentation = query_recorder.get_shared(
+                    (os.path.abspath(cnf_loc), self.db_handle.name),
+                    params["instrumentation"], params["slow_query_ms"],
+                    bool(params["instrumentation_bytes"]))
+
+        if instrumentation is not None:
+            self._instrument(instrumentation)
+
+    def _instrument(self, recorder):
+        """
+        Record the calls to the public methods and the operations that they
+        send to the database with a query_recorder
+        """
+        self.instrumentation = recorder
+        self.db_handle = instrumented_database(self.db_handle)
+        self.entries = self.db_handle.entries
+        for name in self._INSTRUMENTED:
+            setattr(self, name, recorder.wrap(name, getattr(self, name)))
+
+    def get_query_stats(self):
+        """
+        Wall time, documents, bytes and round trips recorded for each method
+
+        Returns
+        -------
+        dict
+            See `dmp.instrumentation.histogram_sink.get_stats`. Empty if
+            instrumentation is disabled.
+        """
+        if self.instrumentation is None:
+            return {}
+        return self.instrumentation.get_stats()
+
+    def get_cache_stats(self):
+        """
+        Hit and miss counts for the `get_file_by_id` cache
+
+        Returns
+        -------
+        dict
+            See `dmp.cache.file_cache.get_stats`. Empty if the cache is
+            disabled.
+        """
+        if self.cache is None:
+            return {}
+        return self.cache.get_stats()
+
+    def _invalidate(self, file_id):
+        """
+        Remove a file from the `get_file_by_id` cache after it has been
+        modified
+        """
+        if self.cache is not None:
+            self.cache.invalidate(file_id)
+
+    def ensure_indexes(self, unique_file_path=False):
+        """
+        Create any missing indexes on the entries collection. This is done
+        automatically the first time that a dmp object is created for a
+        database within a process, but can also be run explicitly as part of a
+        deployment (see `dmp.schema`).
+
+        Parameters
+        ----------
+        unique_file_path : bool
+            Require each `file_path` to be unique for a user
+
+        Returns
+        -------
+        list
+            Names of the indexes that were created
+        """
+        return schema.ensure_indexes(self.db_handle, unique_file_path)
+
+    def get_pool_stats(self):
+        """
+        Connection pool statistics for the shared client used by this object
+
+        Returns
+        -------
+        dict
+            Counts of checkouts, waits and open sockets for the pool. See
+            `dmp.connection.pool_stats`. Empty when running in test mode.
+        """
+        return connection_manager.get_pool_stats(self.cnf_loc, "dmp")
 
     @staticmethod
     def _copy_to_tmp(file_path, tmp_path):
@@ -189,7 +320,9 @@ class dmp(object):  # pylint: disable=invalid-name
                     data_type, 9606, None, [file_id],
                     meta_data={'assembly': 'GCA_0123456789', 'tool': 'bwa_aligner'})
 
-    def _get_rows(self, user_id, key=None, value=None, rest=False):
+    def _get_rows(  # pylint: disable=too-many-arguments
+            self, user_id, key=None, value=None, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
         """
         Get a list of the file dictionary objects given a `user_id` and
         `taxon_id`
@@ -232,45 +365,180 @@ class dmp(object):  # pylint: disable=invalid-name
            da = dmp()
            da.get_files_by_taxon_id(<user_id>, <taxon_id>)
         """
-        entries = self.db_handle.entries
-        files = []
+        return list(self._iter_rows(
+            user_id, key, value, rest, limit=limit, after=after, sort=sort,
+            fields=fields, exclude=exclude, owners=owners))
 
-        row_filter = {"user_id": user_id}
-        if (
-                key is not None
-                and isinstance(str(key), str)
-                and isinstance(value, (str, int, float, bson.objectid.ObjectId))
-        ):
-            row_filter[key] = value
+    def _iter_rows(  # pylint: disable=too-many-arguments
+            self, user_id, key=None, value=None, rest=False, batch_size=None,
+            limit=None, after=None, sort=None, fields=None, exclude=None, owners=None):
+        """
+        Generator version of `_get_rows`. Documents are read from the cursor
+        `batch_size` at a time and are only converted to their serialisable
+        form as they are yielded.
 
-        if rest is True:
-            results = entries.find(
-                row_filter,
-                {
-                    "file_type": 1, "size": 1, "data_type": 1, "taxon_id": 1,
-                    "source_id": 1, "meta_data": 1, "creation_time": 1
-                }
-            )
-        else:
-            results = entries.find(
-                row_filter,
-                {
-                    "file_path": 1, "path_type": 1, "file_type": 1, "size": 1,
-                    "parent_dir": 1, "data_type": 1, "taxon_id": 1,
-                    "source_id": 1, "meta_data": 1, "creation_time": 1
-                }
-            )
+        When any of `limit`, `after` or `sort` are given the results are
+        ordered on (`creation_time`, `_id`) and `after` is used as a keyset
+        cursor so that each page is a bounded range scan of the index.
+        """
+        row_filter, projection, order, limit = queries.row_query(
+            user_id, key, value, rest, limit, after, sort, fields, exclude, owners)
+
+        results = self.db_handle.entries.find(row_filter, projection)
+        if order is not None:
+            results = results.sort(order)
+        if limit is not None:
+            results = results.limit(limit)
+
+        if batch_size is not None:
+            results = results.batch_size(batch_size)
 
         for entry in results:
-            entry["_id"] = str(entry["_id"])
-            entry["creation_time"] = str(entry["creation_time"])
-            if "expiration_date" in entry["meta_data"]:
-                entry["meta_data"]["expiration_date"] = str(entry["meta_data"]["expiration_date"])
-            files.append(entry)
+            yield queries.format_entry(entry)
+
+    # The field that each of the public getters filters on, with a sample
+    # value, for checking the query plans
+    _GETTER_QUERIES = [
+        ("get_file_by_id", "_id", ObjectId(str("000000000000000000000000"))),
+        ("get_file_by_file_path", "file_path", ""),
+        ("get_files_by_user", None, None),
+        ("get_files_by_file_type", "file_type", ""),
+        ("get_files_by_data_type", "data_type", ""),
+        ("get_files_by_taxon_id", "taxon_id", 0),
+        ("get_files_by_assembly", "meta_data.assembly", ""),
+    ]
+
+    @staticmethod
+    def _plan_stages(plan):
+        """
+        Flatten a query plan from explain() into a list of its stages
+        """
+        stages = [plan]
+        for child in [plan.get("inputStage")] + plan.get("inputStages", []):
+            if child is not None:
+                stages += dmp._plan_stages(child)
+        return stages
+
+    def _query_plan_indexed(self, row_filter):
+        """
+        Check whether a query can be answered from the index bounds alone, ie
+        without a COLLSCAN and without filtering fetched documents. Uses
+        explain() when the backend supports it, otherwise checks the filter
+        fields against the defined indexes.
+
+        Returns
+        -------
+        tuple
+            (bool, str) for whether the query is indexed and a summary of the
+            plan
+        """
+        entries = self.db_handle.entries
+        cursor = entries.find(row_filter)
+
+        if hasattr(cursor, "explain"):
+            winning_plan = cursor.explain()["queryPlanner"]["winningPlan"]
+            winning_plan = winning_plan.get("queryPlan", winning_plan)
+            stages = self._plan_stages(winning_plan)
+            names = [stage["stage"] for stage in stages]
+            unique_scan = any([stage.get("isUnique") for stage in stages])
+            residual = any([
+                stage["stage"] == "FETCH" and "filter" in stage for stage in stages
+            ])
+            indexed = "COLLSCAN" not in names and (unique_scan or not residual)
+            return (indexed, "+".join(names))
+
+        fields = set(row_filter.keys())
+        for name, index in entries.index_information().items():
+            index_fields = [field for field, direction in index["key"]]
+            if set(index_fields) <= fields and (index.get("unique") or name == "_id_"):
+                return (True, "IXSCAN " + name)
+            if set(index_fields[:len(fields)]) == fields:
+                return (True, "IXSCAN " + name)
+        return (False, "COLLSCAN")
+
+    def check_query_plans(self, user_id="test"):
+        """
+        Check that the queries made by each of the public getters are served
+        by an index
+
+        Parameters
+        ----------
+        user_id : str
+            User to build the sample queries for
+
+        Returns
+        -------
+        dict
+            For each getter, a dict with `indexed` (bool) and `plan` (str).
+            Getters with `indexed` as False scan all of the users documents.
+        """
+        plans = {}
+        for getter, key, value in self._GETTER_QUERIES:
+            indexed, plan = self._query_plan_indexed(queries.row_filter(user_id, key, value))
+            plans[getter] = {"indexed": indexed, "plan": plan}
+        return plans
+
+    def iter_files(  # pylint: disable=too-many-arguments
+            self, user_id, key=None, value=None, rest=False, batch_size=1000,
+            limit=None, after=None, sort=None, fields=None, exclude=None, owners=None):
+        """
+        Iterate over the file dictionary objects for a `user_id`, optionally
+        filtered on a single field, without loading them all into memory.
 
-        return files
+        Parameters
+        ----------
+        user_id : str
+            Identifier to uniquely locate the users files. Can be set to
+            "common" if the files can be shared between users
+        key : str (Optional)
+            Field to filter on, eg `file_type`, `data_type`, `taxon_id` or
+            `meta_data.assembly`
+        value : str (Optional)
+            Value that the `key` field must match
+        rest : bool (Optional)
+            Exclude the file system fields as for the `get_files_by_*` methods
+        batch_size : int (Optional)
+            Number of documents to retrieve from the server per round trip
+        limit : int (Optional)
+            Maximum number of files to return
+        after : tuple (Optional)
+            (`creation_time`, `_id`) of the last file on the previous page.
+            Only files after this one are returned.
+        sort : int (Optional)
+            Order the files by `creation_time`, pymongo.ASCENDING (default) or
+            pymongo.DESCENDING
+        fields : list or str (Optional)
+            Fields to return, or the name of a projection in `PROJECTIONS`
+            ("summary", "full" or "rest"). Defaults to "rest" when `rest` is
+            True, otherwise "full".
+        exclude : list (Optional)
+            Fields to leave out, eg "meta_data.tool_params"
+        owners : list (Optional)
+            Return the files of each of these users, eg [user_id, "common"],
+            instead of only those of `user_id`. The files are ordered on
+            `creation_time` as for the pages.
+
+        Returns
+        -------
+        generator
+            Yields a dict object for each file (see `get_files_by_user`)
 
-    def get_file_by_id(self, user_id, file_id, rest=False):
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           from dmp import dmp
+           da = dmp()
+           for file_obj in da.iter_files(<user_id>, 'file_type', 'bam'):
+               print(file_obj['_id'])
+        """
+        return self._iter_rows(
+            str(user_id), key, value, rest, batch_size, limit=limit, after=after, sort=sort,
+            fields=fields, exclude=exclude, owners=owners)
+
+    def get_file_by_id(  # pylint: disable=too-many-arguments
+            self, user_id, file_id, rest=False, fields=None, exclude=None):
         """
         Returns files data based on the unique_id for a given file
 
@@ -281,6 +549,10 @@ class dmp(object):  # pylint: disable=invalid-name
             "common" if the files can be shared between users
         file_id : str
             Location of the file in the file system
+        fields : list or str (Optional)
+            Fields to return, or the name of a projection in `PROJECTIONS`
+        exclude : list (Optional)
+            Fields to leave out
 
         Returns
         -------
@@ -318,14 +590,27 @@ class dmp(object):  # pylint: disable=invalid-name
            da = dmp()
            da.get_file_by_id(<unique_file_id>)
         """
-        file_obj = self._get_rows(str(user_id), '_id', ObjectId(str(file_id)), rest)
+        cache_key = queries.projection_key(rest, fields, exclude)
+        generation = None
+        if self.cache is not None:
+            file_obj = self.cache.get(str(user_id), file_id, cache_key)
+            if file_obj is not None:
+                return file_obj
+            generation = self.cache.generation(file_id)
+
+        file_obj = self._get_rows(
+            str(user_id), '_id', ObjectId(str(file_id)), rest, fields=fields, exclude=exclude)
 
         if not file_obj:
             return {"msg": "No files found"}
 
+        if self.cache is not None:
+            self.cache.set(str(user_id), file_id, file_obj[0], cache_key, generation)
+
         return file_obj[0]
 
-    def get_file_by_file_path(self, user_id, file_path, rest=False):
+    def get_file_by_file_path(  # pylint: disable=too-many-arguments
+            self, user_id, file_path, rest=False, fields=None, exclude=None):
         """
         Get a list of the file dictionary objects given a `user_id` and
         `file_path`
@@ -337,6 +622,10 @@ class dmp(object):  # pylint: disable=invalid-name
             "common" if the files can be shared between users
         file_path : str
             File path (see validate_file)
+        fields : list or str (Optional)
+            Fields to return, or the name of a projection in `PROJECTIONS`
+        exclude : list (Optional)
+            Fields to leave out
 
         Returns
         -------
@@ -368,11 +657,14 @@ class dmp(object):  # pylint: disable=invalid-name
            da = dmp()
            da.get_files_by_file_path(<user_id>, <file_type>)
         """
-        file_obj = self._get_rows(str(user_id), 'file_path', str(file_path), rest)
+        file_obj = self._get_rows(
+            str(user_id), 'file_path', str(file_path), rest, fields=fields, exclude=exclude)
 
         return file_obj
 
-    def get_files_by_user(self, user_id, rest=False):
+    def get_files_by_user(  # pylint: disable=too-many-arguments
+            self, user_id, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
         """
         Get a list of the file dictionary objects given a `user_id`
 
@@ -381,6 +673,24 @@ class dmp(object):  # pylint: disable=invalid-name
         user_id : str
             Identifier to uniquely locate the users files. Can be set to
             "common" if the files can be shared between users
+        limit : int (Optional)
+            Maximum number of files to return
+        after : tuple (Optional)
+            (`creation_time`, `_id`) of the last file on the previous page.
+            Only files after this one are returned.
+        sort : int (Optional)
+            Order the files by `creation_time`, pymongo.ASCENDING (default) or
+            pymongo.DESCENDING
+        fields : list or str (Optional)
+            Fields to return, or the name of a projection in `PROJECTIONS`
+            ("summary", "full" or "rest"). Defaults to "rest" when `rest` is
+            True, otherwise "full".
+        exclude : list (Optional)
+            Fields to leave out, eg "meta_data.tool_params"
+        owners : list (Optional)
+            Return the files of each of these users, eg [user_id, "common"],
+            instead of only those of `user_id`. The files are ordered on
+            `creation_time` as for the pages.
 
         Returns
         -------
@@ -396,14 +706,18 @@ class dmp(object):  # pylint: disable=invalid-name
            da = dmp()
            da.get_files_by_user(<user_id>)
         """
-        file_obj = self._get_rows(str(user_id), None, None, rest)
+        file_obj = self._get_rows(
+            str(user_id), None, None, rest, limit=limit, after=after, sort=sort,
+            fields=fields, exclude=exclude, owners=owners)
 
         if not file_obj:
             return {"msg": "No files found"}
 
         return file_obj
 
-    def get_files_by_file_type(self, user_id, file_type, rest=False):
+    def get_files_by_file_type(  # pylint: disable=too-many-arguments
+            self, user_id, file_type, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
         """
         Get a list of the file dictionary objects given a `user_id` and
         `file_type`
@@ -415,6 +729,24 @@ class dmp(object):  # pylint: disable=invalid-name
             "common" if the files can be shared between users
         file_type : str
             File format (see validate_file)
+        limit : int (Optional)
+            Maximum number of files to return
+        after : tuple (Optional)
+            (`creation_time`, `_id`) of the last file on the previous page.
+            Only files after this one are returned.
+        sort : int (Optional)
+            Order the files by `creation_time`, pymongo.ASCENDING (default) or
+            pymongo.DESCENDING
+        fields : list or str (Optional)
+            Fields to return, or the name of a projection in `PROJECTIONS`
+            ("summary", "full" or "rest"). Defaults to "rest" when `rest` is
+            True, otherwise "full".
+        exclude : list (Optional)
+            Fields to leave out, eg "meta_data.tool_params"
+        owners : list (Optional)
+            Return the files of each of these users, eg [user_id, "common"],
+            instead of only those of `user_id`. The files are ordered on
+            `creation_time` as for the pages.
 
         Returns
         -------
@@ -446,14 +778,18 @@ class dmp(object):  # pylint: disable=invalid-name
            da = dmp()
            da.get_files_by_file_type(<user_id>, <file_type>)
         """
-        file_obj = self._get_rows(str(user_id), "file_type", str(file_type), rest)
+        file_obj = self._get_rows(
+            str(user_id), "file_type", str(file_type), rest, limit=limit, after=after,
+            sort=sort, fields=fields, exclude=exclude, owners=owners)
 
         if not file_obj:
             return {"msg": "No files found"}
 
         return file_obj
 
-    def get_files_by_data_type(self, user_id, data_type, rest=False):
+    def get_files_by_data_type(  # pylint: disable=too-many-arguments
+            self, user_id, data_type, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
         """
         Get a list of the file dictionary objects given a `user_id` and
         `data_type`
@@ -465,6 +801,24 @@ class dmp(object):  # pylint: disable=invalid-name
             "common" if the files can be shared between users
         data_type : str
             The type of information in the file (RNA-seq, ChIP-seq, etc)
+        limit : int (Optional)
+            Maximum number of files to return
+        after : tuple (Optional)
+            (`creation_time`, `_id`) of the last file on the previous page.
+            Only files after this one are returned.
+        sort : int (Optional)
+            Order the files by `creation_time`, pymongo.ASCENDING (default) or
+            pymongo.DESCENDING
+        fields : list or str (Optional)
+            Fields to return, or the name of a projection in `PROJECTIONS`
+            ("summary", "full" or "rest"). Defaults to "rest" when `rest` is
+            True, otherwise "full".
+        exclude : list (Optional)
+            Fields to leave out, eg "meta_data.tool_params"
+        owners : list (Optional)
+            Return the files of each of these users, eg [user_id, "common"],
+            instead of only those of `user_id`. The files are ordered on
+            `creation_time` as for the pages.
 
         Returns
         -------
@@ -496,14 +850,18 @@ class dmp(object):  # pylint: disable=invalid-name
            da = dmp()
            da.get_files_by_data_type(<user_id>, <data_type>)
         """
-        file_obj = self._get_rows(str(user_id), "data_type", str(data_type), rest)
+        file_obj = self._get_rows(
+            str(user_id), "data_type", str(data_type), rest, limit=limit, after=after,
+            sort=sort, fields=fields, exclude=exclude, owners=owners)
 
         if not file_obj:
             return {"msg": "No files found"}
 
         return file_obj
 
-    def get_files_by_taxon_id(self, user_id, taxon_id, rest=False):
+    def get_files_by_taxon_id(  # pylint: disable=too-many-arguments
+            self, user_id, taxon_id, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
         """
         Get a list of the file dictionary objects given a `user_id` and
         `taxon_id`
@@ -515,6 +873,24 @@ class dmp(object):  # pylint: disable=invalid-name
             "common" if the files can be shared between users
         taxon_id : int
             Taxon ID that the species that the file has been derived from
+        limit : int (Optional)
+            Maximum number of files to return
+        after : tuple (Optional)
+            (`creation_time`, `_id`) of the last file on the previous page.
+            Only files after this one are returned.
+        sort : int (Optional)
+            Order the files by `creation_time`, pymongo.ASCENDING (default) or
+            pymongo.DESCENDING
+        fields : list or str (Optional)
+            Fields to return, or the name of a projection in `PROJECTIONS`
+            ("summary", "full" or "rest"). Defaults to "rest" when `rest` is
+            True, otherwise "full".
+        exclude : list (Optional)
+            Fields to leave out, eg "meta_data.tool_params"
+        owners : list (Optional)
+            Return the files of each of these users, eg [user_id, "common"],
+            instead of only those of `user_id`. The files are ordered on
+            `creation_time` as for the pages.
 
         Returns
         -------
@@ -546,14 +922,18 @@ class dmp(object):  # pylint: disable=invalid-name
            da = dmp()
            da.get_files_by_taxon_id(<user_id>, <taxon_id>)
         """
-        file_obj = self._get_rows(str(user_id), "taxon_id", int(taxon_id), rest)
+        file_obj = self._get_rows(
+            str(user_id), "taxon_id", int(taxon_id), rest, limit=limit, after=after,
+            sort=sort, fields=fields, exclude=exclude, owners=owners)
 
         if not file_obj:
             return {"msg": "No files found"}
 
         return file_obj
 
-    def get_files_by_assembly(self, user_id, assembly, rest=False):
+    def get_files_by_assembly(  # pylint: disable=too-many-arguments
+            self, user_id, assembly, rest=False, limit=None, after=None, sort=None,
+            fields=None, exclude=None, owners=None):
         """
         Get a list of the file dictionary objects given a `user_id` and
         `assembly`
@@ -565,6 +945,24 @@ class dmp(object):  # pylint: disable=invalid-name
             "common" if the files can be shared between users
         assembly : str
             Assembly that the species that the file has been derived from
+        limit : int (Optional)
+            Maximum number of files to return
+        after : tuple (Optional)
+            (`creation_time`, `_id`) of the last file on the previous page.
+            Only files after this one are returned.
+        sort : int (Optional)
+            Order the files by `creation_time`, pymongo.ASCENDING (default) or
+            pymongo.DESCENDING
+        fields : list or str (Optional)
+            Fields to return, or the name of a projection in `PROJECTIONS`
+            ("summary", "full" or "rest"). Defaults to "rest" when `rest` is
+            True, otherwise "full".
+        exclude : list (Optional)
+            Fields to leave out, eg "meta_data.tool_params"
+        owners : list (Optional)
+            Return the files of each of these users, eg [user_id, "common"],
+            instead of only those of `user_id`. The files are ordered on
+            `creation_time` as for the pages.
 
         Returns
         -------
@@ -596,17 +994,19 @@ class dmp(object):  # pylint: disable=invalid-name
            da = dmp()
            da.get_files_by_taxon_id(<user_id>, <taxon_id>)
         """
-        file_obj = self._get_rows(str(user_id), "meta_data.assembly", str(assembly), rest)
+        file_obj = self._get_rows(
+            str(user_id), "meta_data.assembly", str(assembly), rest, limit=limit,
+            after=after, sort=sort, fields=fields, exclude=exclude, owners=owners)
 
         if not file_obj:
             return {"msg": "No files found"}
 
         return file_obj
 
-    def _get_file_parents(self, user_id, file_id):
+    def _get_file_parents_graph(self, user_id, file_id, max_depth=None):
         """
-        Private function for getting all parents on a file_id. This function
-        reursively goes up the tree of parents to get a full history.
+        Private function for getting all parents of a file_id in a single
+        aggregation using `$graphLookup` on the `source_id` links.
 
         Parameters
         ----------
@@ -614,29 +1014,53 @@ class dmp(object):  # pylint: disable=invalid-name
             Identifier to uniquely locate the users files. Can be set to
             "common" if the files can be shared between users
         file_id : str
-            File ID for leafe file
+            File ID for leaf file
+        max_depth : int
+            Maximum number of generations of parents to return
 
         Returns
         -------
         file_ids : list
-            List of parent file_ids
+            List of [child, parent] file_id pairs
         """
-        entries = self.db_handle.entries
-        file_obj = entries.find_one(
-            {'user_id': user_id, '_id': ObjectId(file_id)}, {"source_id": 1}
-        )
-
         parent_files = []
-        if file_obj is not None and file_obj['source_id']:
-            source_count = len(file_obj['source_id'])
-            if source_count > 0:
-                for source_id in file_obj['source_id']:
-                    parent_files.append([file_id, str(source_id)])
-                    parent_files += self._get_file_parents(user_id, source_id)
+        for file_obj in self.db_handle.entries.aggregate(
+                queries.graph_pipeline(user_id, file_id, max_depth)):
+            parent_files += queries.graph_links(file_id, file_obj)
 
         return parent_files
 
-    def get_file_history(self, user_id, file_id):
+    def _get_file_parents_bfs(self, user_id, file_id, max_depth=None):
+        """
+        Private function for getting all parents of a file_id for backends
+        without `$graphLookup`. The tree is walked breadth first with a single
+        `$in` query per generation.
+
+        Parameters
+        ----------
+        user_id : str
+            Identifier to uniquely locate the users files. Can be set to
+            "common" if the files can be shared between users
+        file_id : str
+            File ID for leaf file
+        max_depth : int
+            Maximum number of generations of parents to return
+
+        Returns
+        -------
+        file_ids : list
+            List of [child, parent] file_id pairs
+        """
+        walk = queries.parent_walk(user_id, file_id, max_depth)
+        query = walk.next_query()
+        while query is not None:
+            for file_obj in self.db_handle.entries.find(*query):
+                walk.add(file_obj)
+            query = walk.next_query()
+
+        return walk.links
+
+    def get_file_history(self, user_id, file_id, max_depth=None):
         """
         Returns the full path of file_ids from the current file to the original
         file(s)
@@ -652,6 +1076,9 @@ class dmp(object):  # pylint: disable=invalid-name
             ID of the file. This is the value returned when a file is loaded
             into the DMP or is the `_id` for a given file when the files have
             been retrieved.
+        max_depth : int (Optional)
+            Limit the number of generations of parent files that are returned.
+            By default the full history is returned.
 
         Returns
         -------
@@ -674,13 +1101,75 @@ class dmp(object):  # pylint: disable=invalid-name
         These IDs can then be requested to ruturn the meta data and locations
         with the `get_file_by_id` method.
         """
-        unique_data = [
-            list(x) for x in set(tuple(x) for x in self._get_file_parents(user_id, file_id))
-        ]
+        if max_depth is not None and max_depth < 1:
+            return []
+
+        parent_files = None
+        if self._graph_lookup is not False:
+            try:
+                parent_files = self._get_file_parents_graph(user_id, file_id, max_depth)
+                self._graph_lookup = True
+            except (OperationFailure, NotImplementedError):
+                self._graph_lookup = False
+
+        if parent_files is None:
+            parent_files = self._get_file_parents_bfs(user_id, file_id, max_depth)
+
+        return queries.unique_links(parent_files)
+
+    def get_file_descendants(self, user_id, file_id, max_depth=None):
+        """
+        Returns the file_ids of all files that have been derived from a file,
+        following the `source_id` links down the tree one generation at a time.
+
+        Parameters
+        ----------
+        user_id : str
+            Identifier to uniquely locate the users files. Can be set to
+            "common" if the files can be shared between users
+        file_id : str
+            ID of the file. This is the value returned when a file is loaded
+            into the DMP or is the `_id` for a given file when the files have
+            been retrieved.
+        max_depth : int (Optional)
+            Limit the number of generations of derived files that are
+            returned. By default all descendants are returned.
 
-        return unique_data
+        Returns
+        -------
+        list
+            List of the file_ids of the derived files, ordered by generation.
 
-    def remove_file(self, user_id, file_id):
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           from dmp import dmp
+           da = dmp()
+           descendants = da.get_file_descendants(<user_id>, <file_id>)
+        """
+        entries = self.db_handle.entries
+
+        frontier = [ObjectId(str(file_id))]
+        seen = set(frontier)
+        depth = 0
+        descendants = []
+        while frontier and (max_depth is None or depth < max_depth):
+            results = entries.find(
+                {"user_id": user_id, "source_id": {"$in": frontier}}, {"_id": 1}
+            )
+            frontier = []
+            for file_obj in results:
+                if file_obj["_id"] not in seen:
+                    seen.add(file_obj["_id"])
+                    frontier.append(file_obj["_id"])
+                    descendants.append(str(file_obj["_id"]))
+            depth += 1
+
+        return descendants
+
+    def remove_file(self, user_id, file_id, cascade=False):
         """
         Removes a single file from the directory. Returns the ID of the file
         that was removed
@@ -694,6 +1183,9 @@ class dmp(object):  # pylint: disable=invalid-name
             ID of the file. This is the value returned when a file is loaded
             into the DMP or is the `_id` for a given file when the files have
             been retrieved.
+        cascade : bool (Optional)
+            Also remove all of the files that have been derived from this file
+            (see `get_file_descendants`)
 
         Returns
         -------
@@ -709,11 +1201,369 @@ class dmp(object):  # pylint: disable=invalid-name
            da = dmp()
            da.remove_file(<file_id>)
         """
-        self.db_handle.entries.delete_one({'user_id': user_id, '_id': ObjectId(file_id)})
+        if cascade is True:
+            file_ids = [file_id] + self.get_file_descendants(user_id, file_id)
+            self.remove_files(user_id, file_ids)
+        else:
+            entry = self.db_handle.entries.find_one_and_delete(
+                {'user_id': user_id, '_id': ObjectId(file_id)}, {'size': 1}
+            )
+            if entry is not None:
+                self._update_usage(user_id, -1, -(entry.get('size') or 0))
+            self._invalidate(file_id)
         return file_id
 
+    def remove_files(self, user_id, file_ids):
+        """
+        Removes a list of files from the directory in a single request
+
+        Parameters
+        ----------
+        user_id : str
+            Identifier to uniquely locate the users files. Can be set to
+            "common" if the files can be shared between users
+        file_ids : list
+            IDs of the files to remove
+
+        Returns
+        -------
+        int
+            The number of files that were removed.
+        """
+        entries = self.db_handle.entries
+        row_filter = {
+            'user_id': user_id, '_id': {'$in': [ObjectId(str(f_id)) for f_id in file_ids]}
+        }
+        removed = list(entries.find(row_filter, {'user_id': 1, 'size': 1}))
+        deleted_count = self._delete_entries(row_filter, removed)
+        for file_id in file_ids:
+            self._invalidate(file_id)
+        return deleted_count
+
+    def _resolve_ancestors(self, user_id, parent_dir):
+        """
+        Get the materialised path for a new entry within `parent_dir`. This is
+        the list of the `_id` of every directory from the root down to and
+        including the parent directory.
+        """
+        query = queries.parent_query(user_id, parent_dir)
+        if query is None:
+            return []
+        return queries.child_ancestors(self.db_handle.entries.find_one(*query))
+
+    def _resolve_batch_ancestors(self, batch):
+        """
+        Set the materialised paths for a list of new entries with a single
+        query for the parent directories that are not part of the list.
+        Directories must come before their contents within the list.
+        """
+        batch_ids = set([entry["_id"] for entry in batch])
+        parent_oids = set()
+        for entry in batch:
+            parent_oid = queries.to_object_id(entry.get("parent_dir"))
+            if isinstance(parent_oid, ObjectId) and parent_oid not in batch_ids:
+                parent_oids.add(parent_oid)
+
+        known = {}
+        if parent_oids:
+            results = self.db_handle.entries.find(
+                {"_id": {"$in": list(parent_oids)}}, {"user_id": 1, "ancestors": 1}
+            )
+            for parent in results:
+                known[parent["_id"]] = (parent["user_id"], parent.get("ancestors", []))
+
+        for entry in batch:
+            entry["ancestors"] = []
+            parent_oid = queries.to_object_id(entry.get("parent_dir"))
+            if parent_oid in known and known[parent_oid][0] == entry["user_id"]:
+                entry["ancestors"] = known[parent_oid][1] + [parent_oid]
+            known[entry["_id"]] = (entry["user_id"], entry["ancestors"])
+
+    def _move_subtree(self, user_id, file_id, ancestors):
+        """
+        Update the materialised paths of an entry, and everything below it,
+        after it has been moved to a new parent directory
+        """
+        entries = self.db_handle.entries
+
+        below = list(entries.find(*queries.subtree_query(user_id, file_id)))
+        entries.bulk_write(queries.move_requests(file_id, ancestors, below), ordered=False)
+        for entry in below:
+            self._invalidate(entry["_id"])
+
+    def list_dir(self, user_id, dir_id, recursive=False, rest=False):
+        """
+        List the entries within a directory
+
+        Parameters
+        ----------
+        user_id : str
+            Identifier to uniquely locate the users files. Can be set to
+            "common" if the files can be shared between users
+        dir_id : str
+            ID of the directory
+        recursive : bool (Optional)
+            Include the contents of all sub-directories
+        rest : bool (Optional)
+            Exclude the file system fields as for the `get_files_by_*` methods
+
+        Returns
+        -------
+        list
+            List of dict objects for each file, directory or link (see
+            `get_files_by_user`). Empty if the directory has no contents.
+
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           from dmp import dmp
+           da = dmp()
+           da.list_dir(<user_id>, <dir_id>, recursive=True)
+        """
+        if recursive is True:
+            return self._get_rows(str(user_id), "ancestors", ObjectId(str(dir_id)), rest)
+        return self._get_rows(str(user_id), "parent_dir", str(dir_id), rest)
+
+    def get_dir_usage(self, user_id, dir_id):
+        """
+        Get the number of entries and the total size of everything below a
+        directory, computed on the server
+
+        Parameters
+        ----------
+        user_id : str
+            Identifier to uniquely locate the users files. Can be set to
+            "common" if the files can be shared between users
+        dir_id : str
+            ID of the directory
+
+        Returns
+        -------
+        dict
+            files : int
+                Number of files below the directory
+            dirs : int
+                Number of sub-directories below the directory
+            links : int
+                Number of links below the directory
+            size : int
+                Sum of the `size` of everything below the directory
+
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           from dmp import dmp
+           da = dmp()
+           usage = da.get_dir_usage(<user_id>, <dir_id>)
+        """
+        pipeline = [
+            {"$match": {"user_id": str(user_id), "ancestors": ObjectId(str(dir_id))}},
+            {"$group": {"_id": "$path_type", "count": {"$sum": 1}, "size": {"$sum": "$size"}}}
+        ]
+
+        usage = {"files": 0, "dirs": 0, "links": 0, "size": 0}
+        for group in self.db_handle.entries.aggregate(pipeline):
+            if group["_id"] in ("file", "dir", "link"):
+                usage[group["_id"] + "s"] = group["count"]
+            usage["size"] += group["size"]
+        return usage
+
+    def _delete_entries(self, row_filter, removed):
+        """
+        Delete the entries matching `row_filter` and update the usage
+        counters. `removed` is the list of the entries (with `user_id` and
+        `size`) that are expected to be deleted. If fewer are deleted, because
+        of a concurrent change, the counters for those users are rebuilt.
+
+        Returns
+        -------
+        int
+            Number of entries that were deleted
+        """
+        result = self.db_handle.entries.delete_many(row_filter)
+
+        if result.deleted_count == len(removed):
+            usage = {}
+            for entry in removed:
+                user_usage = usage.setdefault(entry["user_id"], [0, 0])
+                user_usage[0] -= 1
+                user_usage[1] -= entry.get("size") or 0
+            for user_id, (files, size) in usage.items():
+                self._update_usage(user_id, files, size)
+        else:
+            self.rebuild_usage(list(set([entry["user_id"] for entry in removed])))
+
+        return result.deleted_count
+
+    def _update_usage(self, user_id, files, size):
+        """
+        Increment the stored usage counters for a user
+        """
+        self.db_handle.usage.update_one(
+            {"_id": user_id}, {"$inc": {"files": files, "size": size}}, upsert=True)
+
+    def rebuild_usage(self, user_ids=None):
+        """
+        Recalculate the stored usage counters from the entries collection
+
+        Parameters
+        ----------
+        user_ids : list (Optional)
+            Users to recalculate. By default all users are recalculated.
+        """
+        schema.rebuild_usage(self.db_handle, user_ids)
+
+    def get_user_usage(self, user_id):
+        """
+        Get the number of files and bytes stored by a user from the counters
+        that are maintained as files are added, modified and removed.
+
+        Parameters
+        ----------
+        user_id : str
+            Identifier to uniquely locate the users files. Can be set to
+            "common" if the files can be shared between users
+
+        Returns
+        -------
+        dict
+            files : int
+                Number of files
+            size : int
+                Sum of the `size` of the files
+        """
+        usage = self.db_handle.usage.find_one({"_id": str(user_id)})
+        if usage is None:
+            return {"files": 0, "size": 0}
+        return {"files": usage["files"], "size": usage["size"]}
+
+    def get_usage_summary(self, user_id=None, group_by=None):
+        """
+        Get the number of files and bytes stored, grouped by the given
+        fields. The totals are calculated on the server.
+
+        Parameters
+        ----------
+        user_id : str (Optional)
+            Only include the files for this user
+        group_by : list (Optional)
+            Fields to group the totals by, eg `user_id`, `file_type` or
+            `data_type`. Defaults to `user_id`.
+
+        Returns
+        -------
+        list
+            List of dict objects with the value for each of the `group_by`
+            fields, the number of `files` and their total `size`
+
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           from dmp import dmp
+           da = dmp()
+           usage = da.get_usage_summary(group_by=['user_id', 'file_type'])
+        """
+        if group_by is None:
+            group_by = ["user_id"]
+
+        pipeline = []
+        if user_id is not None:
+            pipeline.append({"$match": {"user_id": str(user_id)}})
+        pipeline.append({
+            "$group": {
+                "_id": dict([(field.replace(".", "_"), "$" + field) for field in group_by]),
+                "files": {"$sum": 1},
+                "size": {"$sum": "$size"}
+            }
+        })
+
+        summary = []
+        for group in self.db_handle.entries.aggregate(pipeline):
+            row = dict([
+                (field, group["_id"].get(field.replace(".", "_"))) for field in group_by
+            ])
+            row["files"] = group["files"]
+            row["size"] = group["size"]
+            summary.append(row)
+
+        return summary
+
+    def purge_expired(self, batch_size=1000, dry_run=False):
+        """
+        Remove all files whose `meta_data.expiration_date` has passed.
+
+        Files are removed in batches of `batch_size` with one bounded delete
+        per batch, so the purge does not hold long locks on the collection
+        and can be run regularly from a scheduled job. This is an opt-in
+        alternative to a TTL index on the expiration date.
+
+        Parameters
+        ----------
+        batch_size : int
+            Maximum number of files to remove in a single request
+        dry_run : bool
+            Only report what would be removed
+
+        Returns
+        -------
+        dict
+            files : int
+                Number of files removed
+            bytes : int
+                Sum of the `size` of the files removed
+            batches : int
+                Number of delete requests made
+
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           from dmp import dmp
+           da = dmp()
+           reclaimed = da.purge_expired(dry_run=True)
+        """
+        entries = self.db_handle.entries
+        row_filter = {"meta_data.expiration_date": {"$lte": datetime.datetime.utcnow()}}
+        summary = {"files": 0, "bytes": 0, "batches": 0}
+
+        if dry_run is True:
+            results = entries.find(row_filter, {"size": 1}).batch_size(batch_size)
+            for entry in results:
+                summary["files"] += 1
+                summary["bytes"] += entry.get("size") or 0
+            return summary
+
+        while True:
+            batch = list(
+                entries.find(row_filter, {"user_id": 1, "size": 1}).sort(
+                    "meta_data.expiration_date", pymongo.ASCENDING).limit(batch_size)
+            )
+            if not batch:
+                break
+
+            deleted_count = self._delete_entries(
+                dict(row_filter, _id={"$in": [entry["_id"] for entry in batch]}), batch)
+            summary["batches"] += 1
+            summary["files"] += deleted_count
+            if deleted_count == len(batch):
+                summary["bytes"] += sum([entry.get("size") or 0 for entry in batch])
+            for entry in batch:
+                self._invalidate(entry["_id"])
+
+            if len(batch) < batch_size:
+                break
+
+        return summary
+
     @staticmethod
-    def validate_file(entry):
+    def validate_file(entry, file_types=None):
         """
         Validate that the required meta data for a given entry is present. If
         there is missing data then a ValueError excepetion is raised. This
@@ -750,6 +1600,10 @@ class dmp(object):  # pylint: disable=invalid-name
                 Dictionary object containing the extra data related to the
                 generation of the file or describing the way it was processed
                 assembly : string
+        file_types : dmp.queries.file_type_table (Optional)
+            Accepted file types. Defaults to the built in `FILE_TYPES`, the
+            `file_types` of a dmp object also include those registered with
+            it.
 
         Returns
         -------
@@ -758,87 +1612,49 @@ class dmp(object):  # pylint: disable=invalid-name
 
         If there are issues with the entry then a ValueError is raised.
         """
+        queries.check_entry(entry, file_types)
 
-        # Check the user_id is not empty:
-        if 'user_id' not in entry or entry['user_id'] is None or entry['user_id'] == '':
-            raise ValueError('User ID must be specified for all entries')
-
-        # Check the file_id is not empty:
-        if 'file_path' not in entry or entry['file_path'] is None or entry['file_path'] == '':
-            raise ValueError('User ID must be specified for all entries')
-
-        if entry['path_type'] not in ['file', 'dir', 'link']:
-            raise ValueError('Path type must be of value file|dir|link')
-
-        # Defined list of acepted file types
-        file_types = {
-            "amb": ["assembly"],
-            "ann": ["assembly"],
-            "bam": ["assembly"],
-            "bb": ["assembly"],
-            "bed": ["assembly"],
-            "bt2": ["assembly"],
-            "bw": ["assembly"],
-            "bwt": ["assembly"],
-            "cpt": [],
-            "csv": [],
-            "dcd": [],
-            "fa": [],
-            "fasta": ["assembly"],  # This might not always be true and might need to be reviewed
-            "fastq": [],
-            "gem": ["assembly"],
-            "gff3": ["assembly"],
-            "gz": [],
-            "hdf5": ["assembly"],
-            "json": [],
-            'lif': [],
-            "pac": ["assembly"],
-            "pdb": [],
-            "pdf": [],
-            "png": [],
-            "prmtop": [],
-            "sa": ["assembly"],
-            "tbi": ["assembly"],
-            "tif": [],
-            "tpr": [],
-            "trj": [],
-            "tsv": [],
-            "txt": [],
-            "wig": ["assembly"]
-        }
-
-        # Check all files match the defined types
-        if (
-                'file_type' not in entry or
-                entry['file_type'] == "" or
-                entry['file_type'] not in file_types
-        ):
-            raise ValueError(
-                "File type must be one of the valid file types: " + ','.join(file_types)
-            )
-
-        if isinstance(entry['size'], int) is False:
-            raise TypeError('Size must be an integer')
+        return True
 
-        # Check all files have a matching Taxon ID
-        if 'taxon_id' not in entry or entry['taxon_id'] is None:
-            raise ValueError('Taxon ID must be specified for all entries')
+    @staticmethod
+    def validate_files(records, file_types=None):
+        """
+        Validate a list of entries, reporting every problem with each entry
+        rather than stopping at the first (see `validate_file`)
 
-        # Require assembly in the meta_data
-        ft_assembly_required = [k for k in file_types if "assembly" in file_types[k]]
-        if str.lower(str(entry['file_type'])) in ft_assembly_required:
-            if 'meta_data' not in entry or 'assembly' not in entry['meta_data']:
-                raise ValueError(
-                    'Matching assembly ID is required within the meta_data field'
-                )
+        Parameters
+        ----------
+        records : list
+            List of entry dict objects
+        file_types : dmp.queries.file_type_table (Optional)
+            Accepted file types, see `validate_file`
 
-        if entry['source_id'] is not None:
-            if 'meta_data' not in entry or 'tool' not in entry['meta_data']:
-                raise ValueError(
-                    'Matching Tool name is required within the meta_data field'
-                )
+        Returns
+        -------
+        list
+            List of dict objects with the `index` of each invalid entry and
+            the list of `errors` for it. Empty if all of the entries are valid.
+        """
+        report = []
+        for index, entry in enumerate(records):
+            errors = [
+                message for error, message in queries.iter_entry_errors(entry, file_types)]
+            if errors:
+                report.append({"index": index, "errors": errors})
+        return report
+
+    def register_file_types(self, file_types):
+        """
+        Add to the list of file types accepted by this object. Other dmp
+        objects, and `validate_file` without `file_types`, are not affected.
 
-        return True
+        Parameters
+        ----------
+        file_types : dict
+            Map of each new file type to the list of the fields that it
+            requires within the meta_data, eg ``{"vcf": ["assembly"]}``
+        """
+        self.file_types = self.file_types.extend(file_types)
 
     def set_file(  # pylint: disable=too-many-arguments,too-many-locals
             self, user_id, file_path, path_type, file_type="", size=0, parent_dir="", data_type="",
@@ -908,30 +1724,128 @@ class dmp(object):  # pylint: disable=invalid-name
             9606, None, meta_data={'assembly' : 'GCA_0000nnnn',
             'downloaded_from' : 'http://www.', })
         """
-        entry = {
-            "user_id": user_id,
-            "file_path": file_path,
-            "path_type": path_type,
-            "parent_dir": parent_dir,
-            "file_type": file_type,
-            "size": size,
-            "data_type": data_type,
-            "taxon_id": taxon_id,
-            "compressed": compressed,
-            "source_id": source_id,
-            "meta_data": meta_data,
-            "creation_time": datetime.datetime.utcnow()
-        }
-        date_delta = datetime.timedelta(days=84)  # 12 weeks
-        entry["meta_data"]["expiration_date"] = entry["creation_time"] + date_delta
-        entry.update(kwargs)
+        entry = queries.build_entry(
+            user_id, file_path, path_type, file_type, size, parent_dir, data_type,
+            taxon_id, compressed, source_id, meta_data, **kwargs)
+
+        self.validate_file(entry, self.file_types)
 
-        self.validate_file(entry)
+        entry["ancestors"] = self._resolve_ancestors(user_id, parent_dir)
 
         entries = self.db_handle.entries
         entry_id = entries.insert_one(entry).inserted_id
+        self._update_usage(user_id, 1, entry["size"])
         return str(entry_id)
 
+    def set_files(self, records, ordered=False, batch_size=1000):
+        """
+        Adds a list of files to the data management API in batches.
+
+        All of the records are validated before anything is loaded. Records
+        that fail validation are reported and skipped, the remaining records
+        are inserted with a single request per batch.
+
+        Parameters
+        ----------
+        records : list
+            List of dict objects, each with the same keys as the parameters of
+            `set_file`
+        ordered : bool
+            If True then loading stops at the first record that fails to be
+            inserted. If False (default) then the server inserts all of the
+            records that it can.
+        batch_size : int
+            Maximum number of records to send in a single request
+
+        Returns
+        -------
+        dict
+            ids : list
+                The file_id for each record, in the same order as the records.
+                None for records that were not loaded.
+            errors : list
+                List of dict objects with the `index` of the record that was
+                not loaded and the `error` message.
+
+        Example
+        -------
+        .. code-block:: python
+           :linenos:
+
+           from dmp import dmp
+           da = dmp()
+           result = da.set_files([
+               {
+                   'user_id': 'user1', 'file_path': '/tmp/example_1.fastq',
+                   'path_type': 'file', 'file_type': 'fastq',
+                   'data_type': 'RNA-seq', 'taxon_id': 9606
+               },
+               {
+                   'user_id': 'user1', 'file_path': '/tmp/example_2.fastq',
+                   'path_type': 'file', 'file_type': 'fastq',
+                   'data_type': 'RNA-seq', 'taxon_id': 9606
+               }
+           ])
+        """
+        not_loaded = "Not loaded due to an earlier error"
+        ids = [None] * len(records)
+        errors = []
+
+        valid = []
+        for index, record in enumerate(records):
+            try:
+                entry = queries.build_entry(**record)
+                self.validate_file(entry, self.file_types)
+            except (ValueError, TypeError, KeyError) as err:
+                errors.append({"index": index, "error": str(err)})
+                if ordered is True:
+                    errors += [
+                        {"index": i, "error": not_loaded} for i in range(index + 1, len(records))
+                    ]
+                    break
+                continue
+            if "_id" not in entry:
+                entry["_id"] = ObjectId()
+            valid.append((index, entry))
+
+        self._resolve_batch_ancestors([entry for index, entry in valid])
+
+        entries = self.db_handle.entries
+        failed = False
+        usage = {}
+        for batch_start in range(0, len(valid), batch_size):
+            batch = valid[batch_start:batch_start + batch_size]
+            if failed is True:
+                errors += [{"index": index, "error": not_loaded} for index, entry in batch]
+                continue
+
+            batch_errors = {}
+            try:
+                entries.insert_many([entry for index, entry in batch], ordered=ordered)
+            except BulkWriteError as err:
+                for write_error in err.details.get("writeErrors", []):
+                    batch_errors[write_error["index"]] = write_error.get("errmsg", "Write error")
+
+            first_error = min(batch_errors) if batch_errors else None
+            failed = ordered is True and first_error is not None
+
+            for batch_index, (index, entry) in enumerate(batch):
+                if batch_index in batch_errors:
+                    errors.append({"index": index, "error": batch_errors[batch_index]})
+                elif failed is True and batch_index > first_error:
+                    errors.append({"index": index, "error": not_loaded})
+                else:
+                    ids[index] = str(entry["_id"])
+                    loaded_usage = usage.setdefault(entry["user_id"], [0, 0])
+                    loaded_usage[0] += 1
+                    loaded_usage[1] += entry["size"]
+
+        for user_id, (files, size) in usage.items():
+            self._update_usage(user_id, files, size)
+
+        errors.sort(key=lambda error: error["index"])
+        return {"ids": ids, "errors": errors}
+
     def add_file_metadata(self, user_id, file_id, key, value):
         """
         Add a key value pair to the meta data for a file
@@ -962,19 +1876,8 @@ class dmp(object):  # pylint: disable=invalid-name
             This is an id for that file within the system and can be used for
             tracing this file and where it is used and where it has come from.
         """
-        entries = self.db_handle.entries
-        entry = entries.find_one(
-            {'user_id': user_id, '_id': ObjectId(file_id)}
-        )
-        entry['meta_data'][str(key)] = value
-
-        # Check that the changes are still valid
-        self.validate_file(entry)
-
-        entries.update(
-            {'_id': ObjectId(file_id)},
-            {'$set': {'meta_data': entry['meta_data']}}
-        )
+        path = 'meta_data.' + str(key)
+        self._update_and_validate(user_id, file_id, path, value)
 
         return file_id
 
@@ -1000,19 +1903,8 @@ class dmp(object):  # pylint: disable=invalid-name
             This is an id for that file within the system and can be used for
             tracing this file and where it is used and where it has come from.
         """
-        entries = self.db_handle.entries
-        entry = entries.find_one(
-            {'user_id': user_id, '_id': ObjectId(file_id)}
-        )
-        del entry['meta_data'][key]
-
-        # Check that the changes are still valid
-        self.validate_file(entry)
-
-        entries.update(
-            {'user_id': user_id, '_id': ObjectId(file_id)},
-            {'$set': {'meta_data': entry['meta_data']}}
-        )
+        path = 'meta_data.' + str(key)
+        self._update_and_validate(user_id, file_id, path, queries.UNSET)
 
         return file_id
 
@@ -1043,22 +1935,212 @@ class dmp(object):  # pylint: disable=invalid-name
             This is an id for that file within the system and can be used for
             tracing this file and where it is used and where it has come from.
         """
+        value = queries.column_value(key, value)
+
+        if str(key) == 'parent_dir':
+            ancestors = self._resolve_ancestors(user_id, value)
+            queries.check_move(file_id, ancestors)
+
+        old_value = self._update_and_validate(user_id, file_id, str(key), value)
+
+        if str(key) == 'size':
+            self._update_usage(user_id, 0, value - (old_value or 0))
+
+        if str(key) == 'parent_dir':
+            self._move_subtree(user_id, file_id, ancestors)
+
+        return file_id
+
+    def bulk_update_metadata(self, updates, batch_size=1000):
+        """
+        Add key value pairs to the meta data of many files with one request
+        per batch
+
+        Each batch of files is read with a single query and every change is
+        validated as for `add_file_metadata` before anything is written. The
+        changes to a file are then only applied if the file has not been
+        changed by another request in the meantime.
+
+        Parameters
+        ----------
+        updates : list
+            List of dict objects with the `user_id`, `file_id`, `key` and
+            `value` for each change (see `add_file_metadata`)
+        batch_size : int
+            Maximum number of changes to send in a single request
+
+        Returns
+        -------
+        dict
+            matched : int
+                Number of files that the changes were applied to
+            modified : int
+                Number of files that were changed
+            unmatched : list
+                The `file_id` of each change that did not match a file for
+                the user, or where the file was changed by another request
+                before the change could be applied
+            errors : list
+                List of dict objects with the `index` of the change that
+                failed and the `error` message
+        """
+        matched = 0
+        modified = 0
+        unmatched = []
+        errors = []
+
         entries = self.db_handle.entries
-        entry = entries.find_one(
-            {'user_id': user_id, '_id': ObjectId(file_id)}
-        )
-        if str(key) in ['size', 'taxon_id']:
-            entry[str(key)] = int(value)
-        else:
-            entry[str(key)] = value
+        for batch_start in range(0, len(updates), batch_size):
+            batch = updates[batch_start:batch_start + batch_size]
+            changes = self._prepare_bulk_updates(
+                batch, batch_start, entries.find(
+                    {'_id': {'$in': [queries.to_object_id(u['file_id']) for u in batch]}}),
+                unmatched, errors)
+            if not changes:
+                continue
+
+            requests = [
+                pymongo.UpdateOne(change['filter'], {'$set': change['set']})
+                for change in changes
+            ]
+            try:
+                result = entries.bulk_write(requests, ordered=False)
+                matched += result.matched_count
+                modified += result.modified_count
+                write_errors = []
+            except BulkWriteError as err:
+                matched += err.details.get("nMatched", 0)
+                modified += err.details.get("nModified", 0)
+                write_errors = err.details.get("writeErrors", [])
+            for write_error in write_errors:
+                errors.append({
+                    "index": changes[write_error["index"]]["indexes"][0],
+                    "error": write_error.get("errmsg", "Write error")
+                })
+
+            failed = set(write_error["index"] for write_error in write_errors)
+            unmatched += self._unapplied_changes(
+                entries, [change for i, change in enumerate(changes) if i not in failed])
+
+            for change in changes:
+                self._invalidate(change['file_id'])
+
+        return {"matched": matched, "modified": modified, "unmatched": unmatched, "errors": errors}
+
+    def _prepare_bulk_updates(  # pylint: disable=too-many-arguments
+            self, batch, batch_start, current, unmatched, errors):
+        """
+        Validate a batch of meta data changes against the current documents
+        and group them into a single change for each file
+
+        Parameters
+        ----------
+        batch : list
+            Changes from `bulk_update_metadata`
+        batch_start : int
+            Index of the first change of the batch
+        current : iterable
+            The current documents for the files in the batch
+        unmatched : list
+            Extended with the file_id of the changes that do not match a file
+        errors : list
+            Extended with the changes that fail validation
 
-        # Check that the changes are still valid
-        self.validate_file(entry)
+        Returns
+        -------
+        list
+            dict for each file with the `filter` that matches the file while
+            it is unchanged, the paths to `set`, the `indexes` of the changes
+            and the `file_id`
+        """
+        documents = dict(((entry['user_id'], entry['_id']), entry) for entry in current)
+
+        changes = {}
+        order = []
+        for index, update in enumerate(batch, batch_start):
+            key = (update['user_id'], queries.to_object_id(update['file_id']))
+            if key not in documents:
+                unmatched.append(update['file_id'])
+                continue
+
+            path = 'meta_data.' + str(update['key'])
+            if key not in changes:
+                entry = documents[key]
+                changes[key] = {
+                    'filter': queries.guard_filter(
+                        {'user_id': key[0], '_id': key[1]}, entry, queries.VALIDATED_PATHS),
+                    'entry': entry,
+                    'set': {},
+                    'indexes': [],
+                    'file_id': update['file_id']
+                }
+                order.append(key)
+
+            change = changes[key]
+            try:
+                _, old_value = queries.prepare_update(
+                    change['entry'], change['filter'], path, update['value'], self.file_types)
+            except (ValueError, TypeError) as err:
+                errors.append({"index": index, "error": str(err)})
+                continue
+
+            if path not in change['filter']:
+                change['filter'][path] = (
+                    {'$exists': False} if old_value is queries.UNSET else old_value)
+            change['entry'] = copy.deepcopy(change['entry'])
+            queries.apply_path(change['entry'], path, update['value'])
+            change['set'][path] = update['value']
+            change['indexes'].append(index)
+
+        return [changes[key] for key in order if changes[key]['set']]
 
-        # Update the entry witin the mongodb
-        entries.update(
-            {'user_id': user_id, '_id': ObjectId(file_id)},
-            {'$set': {str(key): entry[str(key)]}}
+    @staticmethod
+    def _unapplied_changes(entries, changes):
+        """
+        The file_id of the changes in a bulk write that did not match their
+        file, found by checking which files do not have the values that were
+        set
+        """
+        if not changes:
+            return []
+        applied = set(
+            entry['_id'] for entry in entries.find(
+                {'$or': [
+                    dict([('_id', change['filter']['_id'])] + list(change['set'].items()))
+                    for change in changes
+                ]},
+                {'_id': 1}
+            )
         )
+        return [change['file_id'] for change in changes if change['filter']['_id'] not in applied]
 
-        return file_id
+    def _update_and_validate(self, user_id, file_id, path, value):
+        """
+        Apply an update to a single field of a file. The change is validated
+        against the current document before anything is written, and is then
+        only applied if none of the fields that the validation depended on
+        have been changed since the document was read. If another request
+        changed the file in between then the file is read again and the
+        change retried.
+
+        Parameters
+        ----------
+        user_id : str
+        file_id : str
+        path : str
+            Dotted path of the field that is being changed
+        value
+            New value for the path, or `queries.UNSET` if it is being removed
+
+        Returns
+        -------
+        The value of the path before the change, or None if it was not set
+        """
+        entries = self.db_handle.entries
+        change = queries.field_update(user_id, file_id, path, value, self.file_types)
+
+        for row_filter in change.attempts():
+            guard = change.guard(entries.find_one(row_filter))
+            if entries.update_one(guard, change.update).matched_count == 1:
+                self._invalidate(file_id)
+                return change.old_value
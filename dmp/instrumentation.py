@@ -0,0 +1,582 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+import types
+
+import bson
+from bson import json_util
+
+# Upper bounds, in seconds, of the latency buckets. These match the defaults
+# of the Prometheus client libraries.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Collection methods that are sent to the backend
+_OPERATIONS = frozenset([
+    "find", "find_one", "aggregate", "count_documents", "distinct", "insert_one",
+    "insert_many", "update_one", "update_many", "replace_one", "delete_one",
+    "delete_many", "find_one_and_update", "find_one_and_delete", "find_one_and_replace",
+    "bulk_write"
+])
+
+# Operations whose first argument is a query filter that can be explained
+_FILTERED = frozenset([
+    "find", "find_one", "count_documents", "update_one", "update_many", "replace_one",
+    "delete_one", "delete_many", "find_one_and_update", "find_one_and_delete",
+    "find_one_and_replace"
+])
+
+# Cursor methods that return the cursor so that they can be chained
+_CHAINED = frozenset([
+    "sort", "limit", "skip", "batch_size", "hint", "max_time_ms", "collation",
+    "allow_disk_use", "comment"
+])
+
+# Maximum number of queries kept for the slow query log of a call
+_MAX_QUERIES = 20
+
+_local = threading.local()
+
+slow_query_log = logging.getLogger("dmp.slow_query")
+
+
+def _active():
+    """
+    Calls being recorded on the current thread, innermost last
+    """
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def _count_document(document):
+    """
+    Add a document returned by the backend to the calls being recorded
+    """
+    stack = _active()
+    if not stack or not isinstance(document, dict):
+        return
+    size = None
+    for call in stack:
+        call["documents"] += 1
+        if call["count_bytes"]:
+            # Encoding the document again is as costly as decoding it, so
+            # this is only done for the recorders that ask for it
+            if size is None:
+                size = len(bson.encode(document))
+            call["bytes"] += size
+
+
+class instrumented_cursor(object):  # pylint: disable=invalid-name
+    """
+    Cursor wrapper that counts the documents, and optionally the bytes,
+    that are returned
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        document = next(self._cursor)
+        _count_document(document)
+        return document
+
+    next = __next__
+
+    def __getattr__(self, name):
+        attr = getattr(self._cursor, name)
+        if name not in _CHAINED:
+            return attr
+
+        def chain(*args, **kwargs):
+            """
+            Apply the method to the wrapped cursor and return the wrapper
+            """
+            attr(*args, **kwargs)
+            return self
+        return chain
+
+
+class instrumented_collection(object):  # pylint: disable=invalid-name
+    """
+    Collection wrapper that counts each operation as a round trip to the
+    backend and keeps the queries for the slow query log
+    """
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name not in _OPERATIONS:
+            return attr
+
+        collection = self._collection
+
+        def operation(*args, **kwargs):
+            """
+            Record the operation for the active calls and run it
+            """
+            stack = _active()
+            if stack:
+                for call in stack:
+                    call["round_trips"] += 1
+                queries = stack[-1]["queries"]
+                if len(queries) < _MAX_QUERIES:
+                    query = args[0] if args else kwargs.get("filter", kwargs.get("pipeline"))
+                    if name == "distinct":
+                        query = args[1] if len(args) > 1 else kwargs.get("filter")
+                    elif name in ("insert_one", "insert_many", "bulk_write"):
+                        query = None
+                    queries.append((collection, name, query))
+
+            result = attr(*args, **kwargs)
+            if name in ("find", "aggregate"):
+                return instrumented_cursor(result)
+            _count_document(result)
+            return result
+        return operation
+
+
+class instrumented_database(object):  # pylint: disable=invalid-name
+    """
+    Database wrapper that returns instrumented collections
+    """
+
+    def __init__(self, database):
+        self._database = database
+        self._collections = {}
+
+    def __getitem__(self, name):
+        if name not in self._collections:
+            self._collections[name] = instrumented_collection(self._database[name])
+        return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_") or hasattr(type(self._database), name):
+            return getattr(self._database, name)
+        return self[name]
+
+
+def _explain(collection, operation, query):
+    """
+    Winning plan of the backend for a query, or a description of why it could
+    not be explained
+    """
+    try:
+        if operation in _FILTERED:
+            explain = collection.find(query or {}).explain()
+        elif operation == "aggregate":
+            explain = collection.database.command(
+                "aggregate", collection.name, pipeline=query, explain=True)
+        else:
+            return None
+    except Exception as err:  # pylint: disable=broad-except
+        return {"error": str(err)}
+    return explain.get("queryPlanner", {}).get("winningPlan", explain)
+
+
+class histogram_sink(object):  # pylint: disable=invalid-name
+    """
+    In-process latency histogram and running totals for each dmp method
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        """
+        Parameters
+        ----------
+        buckets : tuple
+            Upper bounds of the latency buckets in seconds
+        """
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._methods = {}
+
+    def record(self, event):
+        """
+        Add a call to the histogram
+        """
+        with self._lock:
+            stats = self._methods.get(event["method"])
+            if stats is None:
+                stats = self._methods[event["method"]] = {
+                    "calls": 0, "errors": 0, "slow": 0, "seconds": 0.0,
+                    "max_seconds": 0.0, "documents": 0, "bytes": 0, "round_trips": 0,
+                    "buckets": [0] * (len(self.buckets) + 1)
+                }
+            stats["calls"] += 1
+            stats["errors"] += 1 if event["error"] else 0
+            stats["slow"] += 1 if event["slow"] else 0
+            stats["seconds"] += event["seconds"]
+            stats["max_seconds"] = max(stats["max_seconds"], event["seconds"])
+            stats["documents"] += event["documents"]
+            stats["bytes"] += event["bytes"]
+            stats["round_trips"] += event["round_trips"]
+            stats["buckets"][bisect.bisect_left(self.buckets, event["seconds"])] += 1
+
+    def get_stats(self):
+        """
+        Snapshot of the totals for each method
+
+        Returns
+        -------
+        dict
+            Keyed on the method name, with:
+
+            calls : int
+            errors : int
+                Calls that raised an exception
+            slow : int
+                Calls that were slower than the slow query threshold
+            seconds : float
+                Total wall time
+            max_seconds : float
+            documents : int
+                Documents returned by the backend
+            bytes : int
+                BSON size of the documents returned by the backend. Only
+                counted by a `query_recorder` with `count_bytes`, otherwise 0.
+            round_trips : int
+                Operations sent to the backend
+            buckets : list
+                (upper bound, cumulative count) for each latency bucket
+        """
+        with self._lock:
+            stats = {}
+            for method, values in self._methods.items():
+                stats[method] = dict(values)
+                cumulative = 0
+                buckets = []
+                for bound, count in zip(self.buckets + (float("inf"),), values["buckets"]):
+                    cumulative += count
+                    buckets.append((bound, cumulative))
+                stats[method]["buckets"] = buckets
+            return stats
+
+    def reset(self):
+        """
+        Clear all of the totals
+        """
+        with self._lock:
+            self._methods = {}
+
+
+class prometheus_sink(histogram_sink):  # pylint: disable=invalid-name
+    """
+    Histogram that can be rendered in the Prometheus text exposition format
+    for a metrics endpoint
+
+    Example
+    -------
+    .. code-block:: python
+       :linenos:
+
+       from dmp.dmp import dmp
+       from dmp.instrumentation import query_recorder, prometheus_sink
+
+       metrics = prometheus_sink()
+       da = dmp(test=True, instrumentation=query_recorder([metrics]))
+       da.get_files_by_user("test")
+       print(metrics.exposition())
+    """
+
+    _COUNTERS = [
+        ("calls", "dmp_calls_total", "Calls to each dmp method"),
+        ("errors", "dmp_errors_total", "Calls that raised an exception"),
+        ("slow", "dmp_slow_calls_total", "Calls over the slow query threshold"),
+        ("documents", "dmp_documents_total", "Documents returned by the backend"),
+        ("bytes", "dmp_bytes_total", "BSON bytes returned by the backend"),
+        ("round_trips", "dmp_round_trips_total", "Operations sent to the backend"),
+    ]
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, prefix=""):
+        """
+        Parameters
+        ----------
+        buckets : tuple
+            Upper bounds of the latency buckets in seconds
+        prefix : str
+            Prefix for the metric names
+        """
+        super(prometheus_sink, self).__init__(buckets)
+        self.prefix = prefix
+
+    def exposition(self):
+        """
+        Render the metrics
+
+        Returns
+        -------
+        str
+            Metrics in the Prometheus text format (version 0.0.4)
+        """
+        stats = self.get_stats()
+        lines = []
+        for key, name, help_text in self._COUNTERS:
+            name = self.prefix + name
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " counter")
+            for method in sorted(stats):
+                lines.append('{0}{{method="{1}"}} {2}'.format(name, method, stats[method][key]))
+
+        name = self.prefix + "dmp_call_duration_seconds"
+        lines.append("# HELP " + name + " Wall time of each dmp method")
+        lines.append("# TYPE " + name + " histogram")
+        for method in sorted(stats):
+            for bound, count in stats[method]["buckets"]:
+                bound = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append('{0}_bucket{{method="{1}",le="{2}"}} {3}'.format(
+                    name, method, bound, count))
+            lines.append('{0}_sum{{method="{1}"}} {2!r}'.format(
+                name, method, stats[method]["seconds"]))
+            lines.append('{0}_count{{method="{1}"}} {2}'.format(
+                name, method, stats[method]["calls"]))
+
+        return "\n".join(lines) + "\n"
+
+
+class log_sink(object):  # pylint: disable=invalid-name
+    """
+    Write each call as a JSON record to a logger
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        """
+        Parameters
+        ----------
+        logger : logging.Logger
+            Defaults to the "dmp.queries" logger
+        level : int
+            Level to log the records at
+        """
+        self.logger = logger or logging.getLogger("dmp.queries")
+        self.level = level
+
+    def record(self, event):
+        """
+        Log a call
+        """
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, json.dumps(event, sort_keys=True))
+
+
+class query_recorder(object):  # pylint: disable=invalid-name
+    """
+    Records the wall time, documents returned and round trips to the backend
+    for each call to a dmp method, and passes them to a set of sinks. The
+    bytes returned are also recorded when `count_bytes` is set.
+
+    Calls that take longer than the slow query threshold are logged to the
+    "dmp.slow_query" logger, with the queries that were run and the plan that
+    the backend chose for each.
+    """
+
+    # Sinks that can be named in the `instrumentation` configuration parameter
+    sink_types = {
+        "histogram": histogram_sink,
+        "prometheus": prometheus_sink,
+        "log": log_sink,
+    }
+
+    _registry_lock = threading.Lock()
+    _registry = {}
+
+    def __init__(self, sinks=None, slow_query_ms=None, explain=True, count_bytes=False):
+        """
+        Parameters
+        ----------
+        sinks : list
+            Objects with a `record(event)` method. Defaults to a
+            `histogram_sink`.
+        slow_query_ms : int
+            Threshold in milliseconds for the slow query log. Disabled when
+            None or 0.
+        explain : bool
+            Include the plan of each query in the slow query log
+        count_bytes : bool
+            Record the BSON size of the documents that are returned. Each
+            document has to be encoded again to measure it, which costs about
+            as much as decoding it, so this is off by default.
+        """
+        self.sinks = list(sinks) if sinks is not None else [histogram_sink()]
+        self.slow_query_ms = slow_query_ms
+        self.explain = explain
+        self.count_bytes = count_bytes
+
+    @classmethod
+    def from_config(cls, sink_names, slow_query_ms=None, count_bytes=False):
+        """
+        Create a recorder from the `instrumentation`, `slow_query_ms` and
+        `instrumentation_bytes` configuration parameters
+
+        Parameters
+        ----------
+        sink_names : str
+            Comma separated names of the sinks, eg "prometheus, log"
+        """
+        sinks = []
+        for sink_name in sink_names.split(","):
+            sink_name = sink_name.strip()
+            if not sink_name:
+                continue
+            if sink_name not in cls.sink_types:
+                raise ValueError("Unknown instrumentation sink: " + sink_name)
+            sinks.append(cls.sink_types[sink_name]())
+        return cls(sinks, slow_query_ms, count_bytes=count_bytes)
+
+    @classmethod
+    def get_shared(cls, key, sink_names, slow_query_ms=None, count_bytes=False):
+        """
+        Get the recorder that is shared by all dmp objects within the process
+        for a configuration. The sinks are only created when the recorder is
+        first requested.
+
+        Parameters
+        ----------
+        key : tuple
+            Identifier for the configuration
+        """
+        with cls._registry_lock:
+            if key not in cls._registry:
+                cls._registry[key] = cls.from_config(sink_names, slow_query_ms, count_bytes)
+            return cls._registry[key]
+
+    def get_sink(self, sink_type):
+        """
+        First sink that is an instance of the given class, or None
+        """
+        for sink in self.sinks:
+            if isinstance(sink, sink_type):
+                return sink
+        return None
+
+    def get_stats(self):
+        """
+        Totals from the first histogram sink, see `histogram_sink.get_stats`
+        """
+        sink = self.get_sink(histogram_sink)
+        if sink is None:
+            return {}
+        return sink.get_stats()
+
+    def wrap(self, name, func):
+        """
+        Instrument a function
+
+        Generators are timed while they are being iterated and are recorded
+        once they are exhausted or closed.
+
+        Parameters
+        ----------
+        name : str
+            Method name to record the calls under
+        func : function
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            """
+            Record a call to the wrapped function
+            """
+            call = self._start(name, self.count_bytes)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as err:
+                self._pause(call)
+                self._finish(call, err)
+                raise
+            self._pause(call)
+            if isinstance(result, types.GeneratorType):
+                return self._iterate(call, result)
+            self._finish(call, None)
+            return result
+        return wrapper
+
+    @staticmethod
+    def _start(name, count_bytes=False):
+        call = {
+            "method": name, "seconds": 0.0, "documents": 0, "bytes": 0, "round_trips": 0,
+            "queries": [], "started": None, "count_bytes": count_bytes
+        }
+        query_recorder._resume(call)
+        return call
+
+    @staticmethod
+    def _resume(call):
+        _active().append(call)
+        call["started"] = time.time()
+
+    @staticmethod
+    def _pause(call):
+        call["seconds"] += time.time() - call["started"]
+        stack = _active()
+        for i in range(len(stack) - 1, -1, -1):
+            if stack[i] is call:
+                del stack[i]
+                break
+
+    def _iterate(self, call, generator):
+        error = None
+        try:
+            while True:
+                self._resume(call)
+                try:
+                    item = next(generator)
+                except StopIteration:
+                    return
+                except Exception as err:
+                    error = err
+                    raise
+                finally:
+                    self._pause(call)
+                yield item
+        finally:
+            generator.close()
+            self._finish(call, error)
+
+    def _finish(self, call, error):
+        """
+        Pass a completed call to the sinks and the slow query log
+        """
+        queries = call.pop("queries")
+        del call["started"]
+        del call["count_bytes"]
+        call["error"] = type(error).__name__ if error is not None else None
+        call["slow"] = bool(self.slow_query_ms) and call["seconds"] * 1000 >= self.slow_query_ms
+
+        for sink in self.sinks:
+            sink.record(call)
+
+        if call["slow"] and slow_query_log.isEnabledFor(logging.WARNING):
+            record = dict(call)
+            record["queries"] = []
+            for collection, operation, query in queries:
+                entry = {"collection": collection.name, "operation": operation, "query": query}
+                if self.explain:
+                    entry["explain"] = _explain(collection, operation, query)
+                record["queries"].append(entry)
+            slow_query_log.warning(json_util.dumps(record, sort_keys=True))
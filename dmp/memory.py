@@ -0,0 +1,1390 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+In-memory storage backend.
+
+`memory_client` implements the parts of the pymongo client, database,
+collection and cursor interfaces that are used by `dmp`, `rest` and `schema`,
+so that they can run without a MongoDB server. The indexes created on a
+collection are kept up to date as it changes and are used to answer queries,
+and `explain()` reports the plan that was chosen, so tests and benchmarks use
+the same access paths as a server would.
+
+Each index is a hash table on the first field of the index. The entries within
+each bucket are held as a list ordered on the remaining fields of the index,
+which is sorted lazily after writes. Equality matches on a prefix of the index
+fields are answered with a hash lookup and a binary search, and range matches
+on the first field with a binary search of the sorted bucket keys.
+"""
+
+from __future__ import print_function
+
+import bisect
+import datetime
+import heapq
+import itertools
+import threading
+
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+from pymongo.results import (
+    BulkWriteResult, DeleteResult, InsertManyResult, InsertOneResult, UpdateResult)
+
+_MISSING = object()
+
+# Position of each type in the MongoDB sort order
+_TYPE_ORDER = {
+    int: 2,
+    float: 2,
+    str: 3,
+    dict: 4,
+    list: 5,
+    bytes: 6,
+    ObjectId: 7,
+    bool: 8,
+    datetime.datetime: 9,
+}
+
+# Types that are their own sort key, apart from the rank
+_SCALAR_ORDER = dict([
+    (value_type, rank) for value_type, rank in _TYPE_ORDER.items() if rank not in [4, 5]
+])
+
+_CONTAINERS = (dict, list)
+
+# Greater than the sort key of any value
+_MAX_KEY = (99,)
+
+_TYPE_NAMES = {
+    "double": (float,),
+    "string": (str,),
+    "object": (dict,),
+    "array": (list,),
+    "objectId": (ObjectId,),
+    "bool": (bool,),
+    "date": (datetime.datetime,),
+    "null": (type(None),),
+    "int": (int,),
+    "long": (int,),
+    "number": (int, float),
+}
+
+
+def _sort_key(value):
+    """
+    Key that orders and compares values of any type in the same way as
+    MongoDB, with null before numbers, strings, objects, arrays, binary data,
+    ObjectIds, booleans and dates. Numbers of any type compare equal.
+    """
+    rank = _TYPE_ORDER.get(value.__class__)
+    if rank is None:
+        if value is None or value is _MISSING:
+            return (1,)
+        if isinstance(value, bool):
+            rank = 8
+        else:
+            for value_type, value_rank in _TYPE_ORDER.items():
+                if isinstance(value, value_type):
+                    rank = value_rank
+                    break
+            else:
+                return (10, repr(value))
+    if rank == 4:
+        return (4, tuple([(key, _sort_key(item)) for key, item in value.items()]))
+    if rank == 5:
+        return (5, tuple([_sort_key(item) for item in value]))
+    return (rank, value)
+
+
+def _copy(value):
+    """
+    Copy of a document. Only the dicts and lists need to be copied, all other
+    BSON types are immutable.
+    """
+    if value.__class__ is dict:
+        return {
+            key: _copy(item) if item.__class__ in _CONTAINERS else item
+            for key, item in value.items()
+        }
+    if value.__class__ is list:
+        return [_copy(item) if item.__class__ in _CONTAINERS else item for item in value]
+    if isinstance(value, dict):
+        return dict([(key, _copy(item)) for key, item in value.items()])
+    if isinstance(value, list):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _get_parts(document, parts):
+    value = document
+    for key in parts:
+        if isinstance(value, dict) and key in value:
+            value = value[key]
+        else:
+            return _MISSING
+    return value
+
+
+def _get_field(document, path):
+    """
+    Value at a dotted path within a document, or _MISSING
+    """
+    return _get_parts(document, path.split("."))
+
+
+def _set_field(document, path, value):
+    keys = path.split(".")
+    target = document
+    for key in keys[:-1]:
+        if not isinstance(target.get(key), dict):
+            target[key] = {}
+        target = target[key]
+    target[keys[-1]] = value
+
+
+def _unset_field(document, path):
+    keys = path.split(".")
+    target = _get_parts(document, keys[:-1])
+    if isinstance(target, dict):
+        target.pop(keys[-1], None)
+
+
+def _candidates(value):
+    """
+    Values that a condition is tested against. An array matches on itself and
+    on each of its elements.
+    """
+    if isinstance(value, list):
+        return [value] + value
+    return [value]
+
+
+def _is_operator(condition):
+    if not isinstance(condition, dict) or not condition:
+        return False
+    return next(iter(condition)).startswith("$")
+
+
+def _match_in(value, targets):
+    keys = set([_sort_key(target) for target in targets])
+    if value is _MISSING:
+        return (1,) in keys
+    return any([_sort_key(item) in keys for item in _candidates(value)])
+
+
+def _match_compare(value, target, compare):
+    if value is _MISSING:
+        return False
+    target_key = _sort_key(target)
+    for item in _candidates(value):
+        item_key = _sort_key(item)
+        if item_key[0] == target_key[0] and compare(item_key, target_key):
+            return True
+    return False
+
+
+def _match_type(value, type_names):
+    if value is _MISSING:
+        return False
+    if not isinstance(type_names, list):
+        type_names = [type_names]
+    for type_name in type_names:
+        types = _TYPE_NAMES.get(type_name)
+        if types is None:
+            raise OperationFailure("Unknown type name alias: " + str(type_name))
+        items = [value] + value if isinstance(value, list) else [value]
+        for item in items:
+            if isinstance(item, bool) and bool not in types:
+                continue
+            if isinstance(item, types):
+                return True
+    return False
+
+
+_OPERATORS = {
+    "$eq": lambda value, target: _match_in(value, [target]),
+    "$ne": lambda value, target: not _match_in(value, [target]),
+    "$in": _match_in,
+    "$nin": lambda value, targets: not _match_in(value, targets),
+    "$gt": lambda value, target: _match_compare(value, target, lambda a, b: a > b),
+    "$gte": lambda value, target: _match_compare(value, target, lambda a, b: a >= b),
+    "$lt": lambda value, target: _match_compare(value, target, lambda a, b: a < b),
+    "$lte": lambda value, target: _match_compare(value, target, lambda a, b: a <= b),
+    "$exists": lambda value, exists: (value is not _MISSING) == bool(exists),
+    "$type": _match_type,
+    "$size": lambda value, size: isinstance(value, list) and len(value) == size,
+    "$not": lambda value, condition: not _match_condition(value, condition),
+}
+
+
+def _match_condition(value, condition):
+    if not _is_operator(condition):
+        return _match_in(value, [condition])
+    for operator, argument in condition.items():
+        if operator not in _OPERATORS:
+            raise OperationFailure("unknown operator: " + operator)
+        if not _OPERATORS[operator](value, argument):
+            return False
+    return True
+
+
+def _match(document, row_filter):
+    """
+    Test whether a document matches a query filter
+    """
+    for key, condition in row_filter.items():
+        if key == "$or":
+            if not any([_match(document, sub_filter) for sub_filter in condition]):
+                return False
+        elif key == "$and":
+            if not all([_match(document, sub_filter) for sub_filter in condition]):
+                return False
+        elif key == "$nor":
+            if any([_match(document, sub_filter) for sub_filter in condition]):
+                return False
+        elif key.startswith("$"):
+            raise OperationFailure("unknown top level operator: " + key)
+        elif not _match_condition(_get_field(document, key), condition):
+            return False
+    return True
+
+
+def _project(document, projection):
+    """
+    Apply an inclusion or exclusion projection to a copy of a document
+    """
+    if not projection:
+        return document
+    if isinstance(projection, (list, tuple)):
+        projection = dict([(field, 1) for field in projection])
+
+    include_id = bool(projection.get("_id", True))
+    fields = dict([
+        (field, value) for field, value in projection.items() if field != "_id"])
+
+    if not fields:
+        if include_id and "_id" in projection:
+            return {"_id": document["_id"]} if "_id" in document else {}
+        if not include_id:
+            document.pop("_id", None)
+        return document
+
+    if all([bool(value) for value in fields.values()]):
+        result = {}
+        if include_id and "_id" in document:
+            result["_id"] = document["_id"]
+        for field in fields:
+            value = _get_field(document, field)
+            if value is not _MISSING:
+                _set_field(result, field, value)
+        return result
+
+    for field in fields:
+        _unset_field(document, field)
+    if not include_id:
+        document.pop("_id", None)
+    return document
+
+
+def _apply_update(document, update, inserting=False):
+    """
+    Apply an update document to a document in place. Replacement documents
+    are returned as a new document with the same `_id`.
+    """
+    if not _is_operator(update):
+        replaced = _copy(update)
+        replaced["_id"] = document["_id"]
+        return replaced
+
+    for operator, fields in update.items():
+        for path, value in fields.items():
+            if operator == "$set":
+                _set_field(document, path, _copy(value))
+            elif operator == "$setOnInsert":
+                if inserting:
+                    _set_field(document, path, _copy(value))
+            elif operator == "$unset":
+                _unset_field(document, path)
+            elif operator == "$inc":
+                current = _get_field(document, path)
+                _set_field(document, path, (0 if current is _MISSING else current) + value)
+            elif operator == "$push":
+                current = _get_field(document, path)
+                _set_field(
+                    document, path, ([] if current is _MISSING else current) + [_copy(value)])
+            elif operator == "$addToSet":
+                current = _get_field(document, path)
+                current = [] if current is _MISSING else current
+                if _sort_key(value) not in [_sort_key(item) for item in current]:
+                    _set_field(document, path, current + [_copy(value)])
+            else:
+                raise OperationFailure("Unknown modifier: " + operator)
+    return document
+
+
+def _sort_documents(documents, sort):
+    """
+    Sort a list of documents on a list of (field, direction) pairs
+    """
+    for field, direction in reversed(sort):
+        parts = field.split(".")
+        documents.sort(
+            key=lambda document, parts=parts: _sort_key(_get_parts(document, parts)),
+            reverse=direction < 0)
+    return documents
+
+
+def _evaluate(document, expression):
+    """
+    Evaluate an aggregation expression made of field paths, objects and
+    constants
+    """
+    if isinstance(expression, str) and expression.startswith("$"):
+        value = _get_field(document, expression[1:])
+        return None if value is _MISSING else value
+    if isinstance(expression, dict):
+        return dict([(key, _evaluate(document, item)) for key, item in expression.items()])
+    return expression
+
+
+class _index(object):  # pylint: disable=invalid-name
+    """
+    Index on one or more fields of a collection
+    """
+
+    def __init__(self, name, keys, unique=False):
+        self.name = name
+        self.keys = keys
+        self.fields = [field for field, direction in keys]
+        self.unique = unique
+        self.multikey = False
+        self._parts = [field.split(".") for field in self.fields]
+        self._buckets = {}
+        self._unsorted = set()
+        self._first_keys = None
+
+    def index_keys(self, document):
+        """
+        Keys of a document within the index. Arrays are indexed on each of
+        their elements, so a document can have several keys.
+        """
+        per_field = []
+        single = True
+        for parts in self._parts:
+            value = document
+            for part in parts:
+                value = value.get(part, _MISSING) if value.__class__ is dict else _MISSING
+            rank = _SCALAR_ORDER.get(value.__class__)
+            if rank is not None:
+                per_field.append((rank, value))
+            elif isinstance(value, list) and value:
+                self.multikey = True
+                single = False
+                per_field.append(list(set([_sort_key(item) for item in value])))
+            else:
+                per_field.append(_sort_key(value))
+        if single:
+            return [tuple(per_field)]
+        return list(itertools.product(*[
+            keys if isinstance(keys, list) else [keys] for keys in per_field]))
+
+    def _bucket(self, first_key):
+        bucket = self._buckets.get(first_key)
+        if bucket is not None and first_key in self._unsorted:
+            bucket.sort()
+            self._unsorted.discard(first_key)
+        return bucket
+
+    def add(self, document, id_key):
+        """
+        Add the keys of a document to the index
+        """
+        doc_id = document["_id"]
+        for key in self.index_keys(document):
+            first_key = key[0]
+            bucket = self._buckets.get(first_key)
+            if bucket is None:
+                self._buckets[first_key] = [(key[1:], id_key, doc_id)]
+                self._first_keys = None
+            else:
+                bucket.append((key[1:], id_key, doc_id))
+                self._unsorted.add(first_key)
+
+    def remove(self, document, id_key):
+        """
+        Remove the keys of a document from the index
+        """
+        for key in self.index_keys(document):
+            bucket = self._bucket(key[0])
+            if bucket is None:
+                continue
+            position = bisect.bisect_left(bucket, (key[1:], id_key))
+            if position < len(bucket) and bucket[position][:2] == (key[1:], id_key):
+                del bucket[position]
+            if not bucket:
+                del self._buckets[key[0]]
+                if self._first_keys is not None:
+                    position = bisect.bisect_left(self._first_keys, key[0])
+                    del self._first_keys[position]
+
+    def contains(self, key, id_key):
+        """
+        Check whether a key is held in the index for a document other than
+        the one with `id_key`
+        """
+        bucket = self._bucket(key[0])
+        if bucket is None:
+            return False
+        position = bisect.bisect_left(bucket, (key[1:],))
+        while position < len(bucket) and bucket[position][0] == key[1:]:
+            if bucket[position][1] != id_key:
+                return True
+            position += 1
+        return False
+
+    def lookup(self, prefix):
+        """
+        Ids of the documents with an equality match on the leading fields of
+        the index, in index order
+
+        Parameters
+        ----------
+        prefix : tuple
+            Sort keys for the first len(prefix) fields of the index
+        """
+        return [entry[2] for entry in self.lookup_entries(prefix)]
+
+    def lookup_entries(self, prefix):
+        """
+        Index entries, (keys after the first field, id key, _id), that match
+        a prefix (see `lookup`)
+        """
+        bucket = self._bucket(prefix[0])
+        if bucket is None:
+            return []
+        if len(prefix) > 1:
+            low = bisect.bisect_left(bucket, (prefix[1:],))
+            high = bisect.bisect_left(bucket, (prefix[1:] + (_MAX_KEY,),))
+            bucket = bucket[low:high]
+        return bucket
+
+    def scan_range(self, low, high):
+        """
+        Ids of the documents with the first field within a range of sort keys
+
+        Parameters
+        ----------
+        low : tuple
+            (sort key, inclusive)
+        high : tuple
+            (sort key, inclusive)
+        """
+        if self._first_keys is None:
+            self._first_keys = sorted(self._buckets.keys())
+        if low[1]:
+            start = bisect.bisect_left(self._first_keys, low[0])
+        else:
+            start = bisect.bisect_right(self._first_keys, low[0])
+        if high[1]:
+            end = bisect.bisect_right(self._first_keys, high[0])
+        else:
+            end = bisect.bisect_left(self._first_keys, high[0])
+
+        ids = []
+        for first_key in self._first_keys[start:end]:
+            ids += [entry[2] for entry in self._bucket(first_key)]
+        return ids
+
+    def info(self):
+        """
+        Description of the index as returned by index_information()
+        """
+        info = {"key": list(self.keys), "v": 2}
+        if self.unique:
+            info["unique"] = True
+        return info
+
+
+def _range_bounds(condition):
+    """
+    Bounds of the sort keys that satisfy the range operators of a condition,
+    or None if it has no range operators of a single type
+    """
+    low = None
+    high = None
+    for operator in ["$gt", "$gte", "$lt", "$lte"]:
+        if operator not in condition:
+            continue
+        key = _sort_key(condition[operator])
+        if operator in ["$gt", "$gte"]:
+            low = (key, operator == "$gte")
+        else:
+            high = (key, operator == "$lte")
+    if low is None and high is None:
+        return None
+    if low is None:
+        low = ((high[0][0],), True)
+    if high is None:
+        high = ((low[0][0] + 1,), False)
+    if low[0][0] != high[0][0]:
+        return None
+    return (low, high)
+
+
+class memory_cursor(object):  # pylint: disable=invalid-name
+    """
+    Cursor over the results of `memory_collection.find`
+    """
+
+    def __init__(self, collection, row_filter=None, projection=None):
+        self._collection = collection
+        self._filter = row_filter or {}
+        self._projection = projection
+        self._sort = None
+        self._limit = 0
+        self._skip = 0
+        self._results = None
+
+    def sort(self, key_or_list, direction=None):
+        """
+        Order the results on a field, or a list of (field, direction) pairs
+        """
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, 1 if direction is None else direction)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def limit(self, limit):
+        """
+        Maximum number of results to return, 0 for no limit
+        """
+        self._limit = int(limit)
+        return self
+
+    def skip(self, skip):
+        """
+        Number of results to skip
+        """
+        self._skip = int(skip)
+        return self
+
+    def batch_size(self, batch_size):  # pylint: disable=unused-argument
+        """
+        Accepted for compatibility, there are no round trips to batch
+        """
+        return self
+
+    def explain(self):
+        """
+        Description of the plan used for the query, in the same form as
+        the queryPlanner section of the MongoDB explain output
+        """
+        with self._collection._lock:  # pylint: disable=protected-access
+            plan, ids, ordered = self._collection._plan(  # pylint: disable=protected-access
+                self._filter, self._sort)
+        if self._sort and not ordered:
+            plan = {"stage": "SORT", "sortPattern": dict(self._sort), "inputStage": plan}
+        return {
+            "queryPlanner": {
+                "namespace": self._collection.full_name,
+                "parsedQuery": self._filter,
+                "winningPlan": plan,
+                "rejectedPlans": []
+            },
+            "executionStats": {"nReturned": len(ids) if ids is not None else None}
+        }
+
+    def _execute(self):
+        collection = self._collection
+        with collection._lock:  # pylint: disable=protected-access
+            plan, ids, ordered = collection._plan(  # pylint: disable=protected-access
+                self._filter, self._sort)
+            if ids is None:
+                ids = list(collection._documents.keys())  # pylint: disable=protected-access
+
+        documents = collection._documents  # pylint: disable=protected-access
+        if self._sort and not ordered:
+            matched = []
+            for doc_id in ids:
+                document = documents.get(doc_id)
+                if document is not None and _match(document, self._filter):
+                    matched.append(document)
+            matched = _sort_documents(matched, self._sort)
+            results = iter(matched)
+        else:
+            results = (
+                documents.get(doc_id) for doc_id in ids
+                if doc_id in documents and _match(documents[doc_id], self._filter)
+            )
+
+        if self._skip or self._limit:
+            results = itertools.islice(
+                results, self._skip, self._skip + self._limit if self._limit else None)
+
+        for document in results:
+            if document is not None:
+                yield _project(_copy(document), self._projection)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._results is None:
+            self._results = self._execute()
+        return next(self._results)
+
+    next = __next__
+
+    def close(self):
+        """
+        Release the results
+        """
+        self._results = iter([])
+
+
+class memory_collection(object):  # pylint: disable=invalid-name,too-many-public-methods
+    """
+    In-memory collection with the pymongo Collection interface
+    """
+
+    # The methods take the same arguments as pymongo, including `filter` and
+    # the options that do not apply to an in-memory store
+    # pylint: disable=redefined-builtin,unused-argument
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+        self.full_name = database.name + "." + name
+        self._lock = threading.RLock()
+        self._documents = {}
+        self._indexes = {}
+
+    # Query planning
+
+    def _plan(self, row_filter, sort=None):
+        """
+        Choose how to find the documents that match a filter
+
+        Returns
+        -------
+        tuple
+            (plan, ids, ordered). `ids` is the list of candidate `_id` values,
+            or None if every document needs to be scanned. `ordered` is True if
+            the candidates are already in the requested sort order.
+        """
+        equalities = {}
+        ranges = {}
+        for field, condition in row_filter.items():
+            if field.startswith("$"):
+                continue
+            if _is_operator(condition):
+                if "$eq" in condition:
+                    values = [condition["$eq"]]
+                elif "$in" in condition:
+                    values = condition["$in"]
+                else:
+                    bounds = _range_bounds(condition)
+                    if bounds is not None:
+                        ranges[field] = bounds
+                    continue
+            else:
+                values = [condition]
+            if all([not isinstance(value, (dict, list)) for value in values]):
+                equalities[field] = values
+
+        if "_id" in equalities:
+            ids = [doc_id for doc_id in equalities["_id"] if doc_id in self._documents]
+            return (
+                self._fetch_plan(row_filter, ["_id"], "_id_", [("_id", 1)], True),
+                ids, len(ids) < 2)
+
+        best = None
+        for index in self._indexes.values():
+            prefix = 0
+            for field in index.fields:
+                if field not in equalities:
+                    break
+                prefix += 1
+            if prefix == 0 and index.fields[0] not in ranges:
+                continue
+            provides_sort = bool(sort) and prefix > 0 and [
+                field for field, direction in sort] == index.fields[prefix:prefix + len(sort)]
+            score = (prefix, provides_sort, prefix == len(index.fields), -len(index.fields))
+            if best is None or score > best[0]:
+                best = (score, index, prefix)
+
+        if best is None:
+            plan = {"stage": "COLLSCAN", "direction": "forward"}
+            if row_filter:
+                plan["filter"] = row_filter
+            return (plan, None, False)
+
+        score, index, prefix = best
+        ordered = False
+        merged = False
+        if sort and prefix > 0 and not index.multikey:
+            directions = set([direction for field, direction in sort])
+            ordered = (
+                [field for field, direction in sort] == index.fields[prefix:prefix + len(sort)]
+                and len(directions) == 1
+            )
+
+        if prefix == 0:
+            ids = index.scan_range(*ranges[index.fields[0]])
+            covered = [index.fields[0]]
+        else:
+            covered = index.fields[:prefix]
+            combinations = list(itertools.product(*[
+                [_sort_key(value) for value in equalities[field]] for field in covered]))
+            runs = [index.lookup_entries(combination) for combination in combinations]
+            if ordered and len(runs) > 1:
+                # Each run is in sort order, so they only need to be merged
+                # as for the SORT_MERGE stage of MongoDB
+                offset = prefix - 1
+                merged = True
+                ids = [
+                    entry[2] for entry in heapq.merge(
+                        *runs, key=lambda entry: (entry[0][offset:], entry[1]))
+                ]
+            else:
+                ids = [entry[2] for run in runs for entry in run]
+                if len(runs) > 1:
+                    ordered = False
+            if index.multikey or (len(runs) > 1 and not merged):
+                ids = list(dict.fromkeys(ids))
+
+        if ordered and directions == set([-1]):
+            ids.reverse()
+
+        plan = self._fetch_plan(row_filter, covered, index.name, index.keys, index.unique)
+        plan["inputStage"]["isMultiKey"] = index.multikey
+        if merged:
+            plan["inputStage"] = {
+                "stage": "SORT_MERGE", "sortPattern": dict(sort),
+                "inputStages": [plan["inputStage"]]
+            }
+        return (plan, ids, ordered)
+
+    @staticmethod
+    def _fetch_plan(row_filter, covered, name, keys, unique):
+        residual = dict([
+            (field, condition) for field, condition in row_filter.items()
+            if field not in covered
+        ])
+        plan = {
+            "stage": "FETCH",
+            "inputStage": {
+                "stage": "IXSCAN", "indexName": name, "keyPattern": dict(keys),
+                "isUnique": unique
+            }
+        }
+        if residual:
+            plan["filter"] = residual
+        return plan
+
+    # Writes
+
+    def _check_unique(self, document, id_key):
+        for index in self._indexes.values():
+            if not index.unique:
+                continue
+            for key in index.index_keys(document):
+                if index.contains(key, id_key):
+                    raise DuplicateKeyError(
+                        "E11000 duplicate key error collection: " + self.full_name +
+                        " index: " + index.name, 11000)
+
+    def _insert(self, document):
+        if "_id" not in document:
+            document["_id"] = ObjectId()
+        stored = _copy(document)
+        with self._lock:
+            if stored["_id"] in self._documents:
+                raise DuplicateKeyError(
+                    "E11000 duplicate key error collection: " + self.full_name +
+                    " index: _id_ dup key: " + str(stored["_id"]), 11000)
+            id_key = _sort_key(stored["_id"])
+            self._check_unique(stored, id_key)
+            self._documents[stored["_id"]] = stored
+            for index in self._indexes.values():
+                index.add(stored, id_key)
+        return stored["_id"]
+
+    def _replace(self, old, new):
+        id_key = _sort_key(old["_id"])
+        self._check_unique(new, id_key)
+        for index in self._indexes.values():
+            index.remove(old, id_key)
+            index.add(new, id_key)
+        self._documents[new["_id"]] = new
+
+    def _remove(self, document):
+        id_key = _sort_key(document["_id"])
+        for index in self._indexes.values():
+            index.remove(document, id_key)
+        del self._documents[document["_id"]]
+
+    def _matching(self, row_filter, sort=None):
+        """
+        Stored documents that match a filter. These are not copies.
+        """
+        plan, ids, ordered = self._plan(row_filter, sort)
+        if ids is None:
+            ids = list(self._documents.keys())
+        documents = [
+            self._documents[doc_id] for doc_id in ids
+            if doc_id in self._documents and _match(self._documents[doc_id], row_filter)
+        ]
+        if sort and not ordered:
+            documents = _sort_documents(documents, sort)
+        return documents
+
+    def _update(self, row_filter, update, multi=False, upsert=False):
+        """
+        Returns
+        -------
+        tuple
+            (matched, modified, upserted _id or None)
+        """
+        with self._lock:
+            documents = self._matching(row_filter)
+            if not multi:
+                documents = documents[:1]
+
+            if not documents:
+                if not upsert:
+                    return (0, 0, None)
+                document = {}
+                for field, condition in row_filter.items():
+                    if not field.startswith("$") and not _is_operator(condition):
+                        _set_field(document, field, _copy(condition))
+                if _is_operator(update):
+                    document = _apply_update(document, update, inserting=True)
+                else:
+                    replacement = _copy(update)
+                    if "_id" in document:
+                        replacement.setdefault("_id", document["_id"])
+                    document = replacement
+                return (0, 0, self._insert(document))
+
+            modified = 0
+            for old in documents:
+                new = _apply_update(_copy(old), update)
+                if new != old:
+                    self._replace(old, new)
+                    modified += 1
+            return (len(documents), modified, None)
+
+    @staticmethod
+    def _update_result(matched, modified, upserted_id):
+        raw_result = {"n": matched or (1 if upserted_id is not None else 0),
+                      "nModified": modified, "updatedExisting": matched > 0}
+        if upserted_id is not None:
+            raw_result["upserted"] = upserted_id
+        return UpdateResult(raw_result, True)
+
+    def insert_one(self, document, **kwargs):
+        """
+        See pymongo.collection.Collection.insert_one
+        """
+        return InsertOneResult(self._insert(document), True)
+
+    def insert_many(self, documents, ordered=True, **kwargs):
+        """
+        See pymongo.collection.Collection.insert_many
+        """
+        inserted_ids = []
+        write_errors = []
+        for position, document in enumerate(documents):
+            try:
+                inserted_ids.append(self._insert(document))
+            except DuplicateKeyError as err:
+                write_errors.append({
+                    "index": position, "code": 11000, "errmsg": str(err), "op": document})
+                if ordered:
+                    break
+        if write_errors:
+            raise BulkWriteError({
+                "writeErrors": write_errors, "writeConcernErrors": [],
+                "nInserted": len(inserted_ids), "nUpserted": 0, "nMatched": 0,
+                "nModified": 0, "nRemoved": 0, "upserted": []
+            })
+        return InsertManyResult(inserted_ids, True)
+
+    def update_one(self, filter, update, upsert=False, **kwargs):
+        """
+        See pymongo.collection.Collection.update_one
+        """
+        return self._update_result(*self._update(filter, update, False, upsert))
+
+    def update_many(self, filter, update, upsert=False, **kwargs):
+        """
+        See pymongo.collection.Collection.update_many
+        """
+        return self._update_result(*self._update(filter, update, True, upsert))
+
+    def replace_one(self, filter, replacement, upsert=False, **kwargs):
+        """
+        See pymongo.collection.Collection.replace_one
+        """
+        if _is_operator(replacement):
+            raise ValueError("replacement can not include $ operators")
+        return self._update_result(*self._update(filter, replacement, False, upsert))
+
+    def _delete(self, row_filter, multi):
+        with self._lock:
+            documents = self._matching(row_filter)
+            if not multi:
+                documents = documents[:1]
+            for document in documents:
+                self._remove(document)
+        return len(documents)
+
+    def delete_one(self, filter, **kwargs):
+        """
+        See pymongo.collection.Collection.delete_one
+        """
+        return DeleteResult({"n": self._delete(filter, False)}, True)
+
+    def delete_many(self, filter, **kwargs):
+        """
+        See pymongo.collection.Collection.delete_many
+        """
+        return DeleteResult({"n": self._delete(filter, True)}, True)
+
+    def find_one_and_update(  # pylint: disable=too-many-arguments
+            self, filter, update, projection=None, sort=None, upsert=False,
+            return_document=ReturnDocument.BEFORE, **kwargs):
+        """
+        See pymongo.collection.Collection.find_one_and_update
+        """
+        with self._lock:
+            documents = self._matching(filter, sort)
+            if not documents:
+                if upsert:
+                    matched, modified, upserted_id = self._update(filter, update, False, True)
+                    if return_document == ReturnDocument.AFTER:
+                        return _project(
+                            _copy(self._documents[upserted_id]), projection)
+                return None
+            old = documents[0]
+            new = _apply_update(_copy(old), update)
+            if new != old:
+                self._replace(old, new)
+            result = new if return_document == ReturnDocument.AFTER else old
+            return _project(_copy(result), projection)
+
+    def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        """
+        See pymongo.collection.Collection.find_one_and_delete
+        """
+        with self._lock:
+            documents = self._matching(filter, sort)
+            if not documents:
+                return None
+            self._remove(documents[0])
+            return _project(_copy(documents[0]), projection)
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """
+        See pymongo.collection.Collection.bulk_write. Supports InsertOne,
+        UpdateOne, UpdateMany, ReplaceOne, DeleteOne and DeleteMany.
+        """
+        result = {
+            "nInserted": 0, "nUpserted": 0, "nMatched": 0, "nModified": 0, "nRemoved": 0,
+            "upserted": [], "writeErrors": [], "writeConcernErrors": []
+        }
+        self._bulk_write(requests, ordered, result)
+        if result["writeErrors"]:
+            raise BulkWriteError(result)
+        return BulkWriteResult(result, True)
+
+    def _bulk_write(self, requests, ordered, result):
+        # The pymongo request classes have no public accessors
+        # pylint: disable=protected-access
+        for position, request in enumerate(requests):
+            operation = request.__class__.__name__
+            try:
+                if operation == "InsertOne":
+                    self._insert(request._doc)
+                    result["nInserted"] += 1
+                elif operation in ["UpdateOne", "UpdateMany", "ReplaceOne"]:
+                    matched, modified, upserted_id = self._update(
+                        request._filter, request._doc,
+                        operation == "UpdateMany", request._upsert)
+                    result["nMatched"] += matched
+                    result["nModified"] += modified
+                    if upserted_id is not None:
+                        result["nUpserted"] += 1
+                        result["upserted"].append({"index": position, "_id": upserted_id})
+                elif operation in ["DeleteOne", "DeleteMany"]:
+                    result["nRemoved"] += self._delete(
+                        request._filter, operation == "DeleteMany")
+                else:
+                    raise TypeError(operation + " is not supported by bulk_write")
+            except DuplicateKeyError as err:
+                result["writeErrors"].append({
+                    "index": position, "code": 11000, "errmsg": str(err)})
+                if ordered:
+                    break
+
+    # Reads
+
+    def find(  # pylint: disable=too-many-arguments
+            self, filter=None, projection=None, sort=None, limit=0, skip=0, **kwargs):
+        """
+        See pymongo.collection.Collection.find
+        """
+        cursor = memory_cursor(self, filter, projection)
+        if sort is not None:
+            cursor.sort(sort)
+        return cursor.limit(limit).skip(skip)
+
+    def find_one(self, filter=None, *args, **kwargs):  # pylint: disable=keyword-arg-before-vararg
+        """
+        See pymongo.collection.Collection.find_one
+        """
+        if filter is not None and not isinstance(filter, dict):
+            filter = {"_id": filter}
+        for document in self.find(filter, *args, **kwargs).limit(1):
+            return document
+        return None
+
+    def count_documents(self, filter, **kwargs):
+        """
+        See pymongo.collection.Collection.count_documents
+        """
+        with self._lock:
+            return len(self._matching(filter))
+
+    def estimated_document_count(self, **kwargs):
+        """
+        See pymongo.collection.Collection.estimated_document_count
+        """
+        return len(self._documents)
+
+    def distinct(self, key, filter=None, **kwargs):
+        """
+        See pymongo.collection.Collection.distinct
+        """
+        values = {}
+        with self._lock:
+            for document in self._matching(filter or {}):
+                value = _get_field(document, key)
+                if value is _MISSING:
+                    continue
+                for item in (value if isinstance(value, list) else [value]):
+                    values.setdefault(_sort_key(item), item)
+        return list(values.values())
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        See pymongo.collection.Collection.aggregate. Supports the $match,
+        $project, $group, $sort, $skip, $limit, $count and $graphLookup
+        stages.
+        """
+        if pipeline and "$match" in pipeline[0]:
+            documents = list(self.find(pipeline[0]["$match"]))
+            pipeline = pipeline[1:]
+        else:
+            documents = list(self.find())
+
+        for stage in pipeline:
+            name, spec = next(iter(stage.items()))
+            if name == "$match":
+                documents = [document for document in documents if _match(document, spec)]
+            elif name == "$project":
+                documents = [_project(document, spec) for document in documents]
+            elif name == "$group":
+                documents = self._group(documents, spec)
+            elif name == "$sort":
+                documents = _sort_documents(documents, list(spec.items()))
+            elif name == "$skip":
+                documents = documents[spec:]
+            elif name == "$limit":
+                documents = documents[:spec]
+            elif name == "$count":
+                documents = [{spec: len(documents)}] if documents else []
+            elif name == "$graphLookup":
+                for document in documents:
+                    self._graph_lookup(document, spec)
+            else:
+                raise OperationFailure("Unrecognized pipeline stage name: " + name)
+
+        return iter(documents)
+
+    @staticmethod
+    def _group(documents, spec):
+        groups = {}
+        accumulators = [(field, spec[field]) for field in spec if field != "_id"]
+        for document in documents:
+            group_id = _evaluate(document, spec["_id"])
+            group = groups.get(_sort_key(group_id))
+            if group is None:
+                group = {"_id": group_id}
+                groups[_sort_key(group_id)] = group
+                for field, accumulator in accumulators:
+                    operator = next(iter(accumulator))
+                    group[field] = 0 if operator in ["$sum", "$avg"] else (
+                        [] if operator == "$push" else _MISSING)
+                    if operator == "$avg":
+                        group[field] = [0, 0]
+            for field, accumulator in accumulators:
+                operator, expression = next(iter(accumulator.items()))
+                value = _evaluate(document, expression)
+                numeric = isinstance(value, (int, float)) and not isinstance(value, bool)
+                if operator == "$sum":
+                    group[field] += value if numeric else 0
+                elif operator == "$avg":
+                    if numeric:
+                        group[field] = [group[field][0] + value, group[field][1] + 1]
+                elif operator == "$push":
+                    group[field].append(value)
+                elif operator == "$first":
+                    if group[field] is _MISSING:
+                        group[field] = value
+                elif operator == "$last":
+                    group[field] = value
+                elif operator in ["$min", "$max"]:
+                    if value is None:
+                        continue
+                    current = group[field]
+                    if current is _MISSING or (
+                            (_sort_key(value) < _sort_key(current)) == (operator == "$min")):
+                        group[field] = value
+                else:
+                    raise OperationFailure("unknown group operator: " + operator)
+
+        results = []
+        for group in groups.values():
+            for field, accumulator in accumulators:
+                if next(iter(accumulator)) == "$avg":
+                    total, count = group[field]
+                    group[field] = float(total) / count if count else None
+                elif group[field] is _MISSING:
+                    group[field] = None
+            results.append(group)
+        return results
+
+    def _graph_lookup(self, document, spec):
+        collection = self.database[spec["from"]]
+        start = _evaluate(document, spec["startWith"])
+        values = [
+            value for value in (start if isinstance(start, list) else [start])
+            if value is not None
+        ]
+        seen = set([_sort_key(value) for value in values])
+        max_depth = spec.get("maxDepth")
+
+        found = {}
+        depth = 0
+        while values and (max_depth is None or depth <= max_depth):
+            query = dict(spec.get("restrictSearchWithMatch", {}))
+            query[spec["connectToField"]] = {"$in": values}
+            values = []
+            for match in collection.find(query):
+                id_key = _sort_key(match["_id"])
+                if id_key in found:
+                    continue
+                if "depthField" in spec:
+                    match[spec["depthField"]] = depth
+                found[id_key] = match
+                connect = _get_field(match, spec["connectFromField"])
+                for value in (connect if isinstance(connect, list) else [connect]):
+                    if value is _MISSING or value is None:
+                        continue
+                    if _sort_key(value) not in seen:
+                        seen.add(_sort_key(value))
+                        values.append(value)
+            depth += 1
+
+        document[spec["as"]] = list(found.values())
+
+    # Indexes
+
+    def create_index(self, keys, name=None, unique=False, **kwargs):
+        """
+        See pymongo.collection.Collection.create_index
+        """
+        if isinstance(keys, str):
+            keys = [(keys, 1)]
+        keys = [(field, direction) for field, direction in keys]
+        if name is None:
+            name = "_".join([field + "_" + str(direction) for field, direction in keys])
+
+        with self._lock:
+            if name in self._indexes:
+                existing = self._indexes[name]
+                if existing.keys == keys and existing.unique == bool(unique):
+                    return name
+                raise OperationFailure(
+                    "Index with name: " + name + " already exists with different options", 85)
+
+            index = _index(name, keys, bool(unique))
+            for document in self._documents.values():
+                id_key = _sort_key(document["_id"])
+                if index.unique:
+                    for key in index.index_keys(document):
+                        if index.contains(key, id_key):
+                            raise DuplicateKeyError(
+                                "E11000 duplicate key error collection: " + self.full_name +
+                                " index: " + name, 11000)
+                index.add(document, id_key)
+            self._indexes[name] = index
+        return name
+
+    def drop_index(self, index_or_name):
+        """
+        See pymongo.collection.Collection.drop_index
+        """
+        name = index_or_name
+        if not isinstance(name, str):
+            name = "_".join([field + "_" + str(direction) for field, direction in name])
+        with self._lock:
+            if name not in self._indexes:
+                raise OperationFailure("index not found with name [" + name + "]", 27)
+            del self._indexes[name]
+
+    def drop_indexes(self):
+        """
+        See pymongo.collection.Collection.drop_indexes
+        """
+        with self._lock:
+            self._indexes = {}
+
+    def index_information(self):
+        """
+        See pymongo.collection.Collection.index_information
+        """
+        info = {"_id_": {"key": [("_id", 1)], "v": 2}}
+        for name, index in self._indexes.items():
+            info[name] = index.info()
+        return info
+
+    def drop(self):
+        """
+        Remove all documents and indexes
+        """
+        with self._lock:
+            self._documents = {}
+            self._indexes = {}
+
+    def watch(self, *args, **kwargs):  # pylint: disable=no-self-use
+        """
+        Change streams are not supported
+        """
+        raise OperationFailure(
+            "The $changeStream stage is only supported on replica sets", 40573)
+
+
+class memory_database(object):  # pylint: disable=invalid-name
+    """
+    In-memory database with the pymongo Database interface
+    """
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._collections = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = memory_collection(self, name)
+            return self._collections[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_collection(self, name, **kwargs):  # pylint: disable=unused-argument
+        """
+        See pymongo.database.Database.get_collection
+        """
+        return self[name]
+
+    def list_collection_names(self, **kwargs):  # pylint: disable=unused-argument
+        """
+        See pymongo.database.Database.list_collection_names
+        """
+        return list(self._collections.keys())
+
+    def drop_collection(self, name):
+        """
+        See pymongo.database.Database.drop_collection
+        """
+        with self._lock:
+            self._collections.pop(getattr(name, "name", name), None)
+
+
+class memory_client(object):  # pylint: disable=invalid-name
+    """
+    In-memory replacement for a pymongo MongoClient
+
+    Example
+    -------
+    .. code-block:: python
+       :linenos:
+
+       from dmp.memory import memory_client
+       db_handle = memory_client()["dmp"]
+       db_handle.entries.create_index([("user_id", 1)])
+       db_handle.entries.insert_one({"user_id": "adam"})
+    """
+
+    def __init__(self, *args, **kwargs):  # pylint: disable=unused-argument
+        self._databases = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._databases:
+                self._databases[name] = memory_database(self, name)
+            return self._databases[name]
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return self[name]
+
+    def get_database(self, name, **kwargs):  # pylint: disable=unused-argument
+        """
+        See pymongo.MongoClient.get_database
+        """
+        return self[name]
+
+    def list_database_names(self):
+        """
+        See pymongo.MongoClient.list_database_names
+        """
+        return list(self._databases.keys())
+
+    def drop_database(self, name):
+        """
+        See pymongo.MongoClient.drop_database
+        """
+        with self._lock:
+            self._databases.pop(getattr(name, "name", name), None)
+
+    def close(self):
+        """
+        Nothing to release
+        """
+        pass
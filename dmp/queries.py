@@ -0,0 +1,760 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Queries, document layout and validation shared by `dmp` and `async_dmp`.
+
+Nothing in this module talks to the database. Each helper either builds the
+query for a request, or works out the next step from the documents that were
+returned, so that the synchronous and the asyncio clients only differ in how
+they make the round trips.
+"""
+
+from __future__ import print_function, unicode_literals
+
+import copy
+import datetime
+
+import pymongo
+import bson
+from bson.objectid import ObjectId
+
+# Defined list of accepted file types with the fields that they require
+# within the meta_data. Each dmp object can accept extra file types, with
+# dmp.register_file_types or the `file_types` parameter in the configuration
+# file, without changing this table.
+FILE_TYPES = {
+    "amb": ("assembly",),
+    "ann": ("assembly",),
+    "bam": ("assembly",),
+    "bb": ("assembly",),
+    "bed": ("assembly",),
+    "bt2": ("assembly",),
+    "bw": ("assembly",),
+    "bwt": ("assembly",),
+    "cpt": (),
+    "csv": (),
+    "dcd": (),
+    "fa": (),
+    "fasta": ("assembly",),  # This might not always be true and might need to be reviewed
+    "fastq": (),
+    "gem": ("assembly",),
+    "gff3": ("assembly",),
+    "gz": (),
+    "hdf5": ("assembly",),
+    "json": (),
+    "lif": (),
+    "pac": ("assembly",),
+    "pdb": (),
+    "pdf": (),
+    "png": (),
+    "prmtop": (),
+    "sa": ("assembly",),
+    "tbi": ("assembly",),
+    "tif": (),
+    "tpr": (),
+    "trj": (),
+    "tsv": (),
+    "txt": (),
+    "wig": ("assembly",)
+}
+
+PATH_TYPES = frozenset(["file", "dir", "link"])
+
+# Named projections for the get_files_by_* methods. "full" and "rest" are the
+# fields returned by default, without and with `rest=True`.
+PROJECTIONS = {
+    "full": (
+        "file_path", "path_type", "file_type", "size", "parent_dir", "data_type",
+        "taxon_id", "source_id", "meta_data", "creation_time"),
+    "rest": (
+        "file_type", "size", "data_type", "taxon_id", "source_id", "meta_data",
+        "creation_time"),
+    "summary": (
+        "file_path", "path_type", "file_type", "size", "data_type", "taxon_id",
+        "creation_time"),
+}
+
+# Top level fields of the stored file documents (see build_entry)
+ENTRY_FIELDS = frozenset([
+    "user_id", "file_path", "path_type", "parent_dir", "file_type", "size", "data_type",
+    "taxon_id", "compressed", "source_id", "meta_data", "creation_time", "ancestors"
+])
+
+# Marker for a field that is missing, or that is being removed
+UNSET = object()
+
+# Fields that validate_file depends on. Updates are only applied while these
+# are unchanged from the document that the change was validated against.
+VALIDATED_PATHS = (
+    'user_id', 'file_path', 'path_type', 'file_type', 'size', 'taxon_id', 'source_id',
+    'meta_data.assembly', 'meta_data.tool'
+)
+
+# Number of times that an update is retried when the file is changed by
+# another request between it being read and written
+UPDATE_ATTEMPTS = 3
+
+
+class file_type_table(object):  # pylint: disable=invalid-name
+    """
+    Lookup tables used by validate_file for a set of accepted file types
+    """
+
+    def __init__(self, file_types):
+        """
+        Parameters
+        ----------
+        file_types : dict
+            Map of each accepted file type to the fields that it requires
+            within the meta_data
+        """
+        self.file_types = dict(
+            [(file_type, tuple(required)) for file_type, required in file_types.items()])
+        self.valid = frozenset(self.file_types)
+        self.assembly_required = frozenset([
+            file_type for file_type, required in self.file_types.items()
+            if "assembly" in required
+        ])
+        self.error = "File type must be one of the valid file types: " + ','.join(self.file_types)
+
+    def extend(self, file_types):
+        """
+        New table that also accepts the given file types
+
+        Parameters
+        ----------
+        file_types : dict
+            Map of each new file type to the fields that it requires, as
+            returned by `parse_file_types`
+        """
+        combined = dict(self.file_types)
+        combined.update(file_types)
+        return file_type_table(combined)
+
+
+# The file types accepted when no others have been registered
+DEFAULT_FILE_TYPES = file_type_table(FILE_TYPES)
+
+
+def parse_file_types(value):
+    """
+    Parse the `file_types` parameter from the configuration file
+
+    Parameters
+    ----------
+    value : str
+        Comma separated list of file types, each optionally followed by the
+        colon separated fields that it requires in the meta_data, eg
+        ``vcf:assembly, xml``
+
+    Returns
+    -------
+    dict
+        Map of each file type to the tuple of required fields
+    """
+    file_types = {}
+    for item in value.split(","):
+        fields = [field.strip() for field in item.split(":") if field.strip()]
+        if fields:
+            file_types[fields[0]] = tuple(fields[1:])
+    return file_types
+
+
+def iter_entry_errors(entry, file_types=None):
+    """
+    Generate the (exception class, message) for each of the problems with an
+    entry, in the order that validate_file checks for them. The file type
+    must be one of `file_types`, a `file_type_table`, or of the
+    `DEFAULT_FILE_TYPES` if it is None.
+    """
+    if file_types is None:
+        file_types = DEFAULT_FILE_TYPES
+
+    # Check the user_id is not empty:
+    if entry.get('user_id') is None or entry['user_id'] == '':
+        yield ValueError, 'User ID must be specified for all entries'
+
+    # Check the file_id is not empty:
+    if entry.get('file_path') is None or entry['file_path'] == '':
+        yield ValueError, 'User ID must be specified for all entries'
+
+    if entry.get('path_type') not in PATH_TYPES:
+        yield ValueError, 'Path type must be of value file|dir|link'
+
+    # Check all files match the defined types
+    file_type = entry.get('file_type')
+    if file_type not in file_types.valid:
+        yield ValueError, file_types.error
+
+    if isinstance(entry.get('size'), int) is False:
+        yield TypeError, 'Size must be an integer'
+
+    # Check all files have a matching Taxon ID
+    if entry.get('taxon_id') is None:
+        yield ValueError, 'Taxon ID must be specified for all entries'
+
+    # Require assembly in the meta_data
+    meta_data = entry.get('meta_data') or {}
+    if str(file_type).lower() in file_types.assembly_required and 'assembly' not in meta_data:
+        yield ValueError, 'Matching assembly ID is required within the meta_data field'
+
+    if entry.get('source_id') is not None and 'tool' not in meta_data:
+        yield ValueError, 'Matching Tool name is required within the meta_data field'
+
+
+def check_entry(entry, file_types=None):
+    """
+    Raise the first of the problems with an entry (see dmp.validate_file)
+    """
+    for error, message in iter_entry_errors(entry, file_types):
+        raise error(message)
+
+
+def build_entry(  # pylint: disable=too-many-arguments
+        user_id, file_path, path_type, file_type="", size=0, parent_dir="",
+        data_type="", taxon_id="", compressed=None, source_id=None, meta_data=None,
+        **kwargs):
+    """
+    Create the document for a new file as it is stored in the entries
+    collection. See `dmp.set_file` for the parameters.
+    """
+    if meta_data is None:
+        meta_data = {}
+
+    entry = {
+        "user_id": user_id,
+        "file_path": file_path,
+        "path_type": path_type,
+        "parent_dir": parent_dir,
+        "file_type": file_type,
+        "size": size,
+        "data_type": data_type,
+        "taxon_id": taxon_id,
+        "compressed": compressed,
+        "source_id": source_id,
+        "meta_data": meta_data,
+        "creation_time": datetime.datetime.utcnow()
+    }
+    date_delta = datetime.timedelta(days=84)  # 12 weeks
+    entry["meta_data"]["expiration_date"] = entry["creation_time"] + date_delta
+    entry.update(kwargs)
+
+    if entry["source_id"] is not None:
+        entry["source_id"] = [to_object_id(s_id) for s_id in entry["source_id"]]
+
+    return entry
+
+
+def to_object_id(file_id):
+    """
+    Convert a file_id to an ObjectId where it is a valid ObjectId string so
+    that it can be matched against `_id`. Other values are returned
+    unchanged.
+    """
+    if isinstance(file_id, ObjectId):
+        return file_id
+    if isinstance(file_id, str) and ObjectId.is_valid(file_id):
+        return ObjectId(file_id)
+    return file_id
+
+
+def row_query(  # pylint: disable=too-many-arguments
+        user_id, key=None, value=None, rest=False, limit=None, after=None, sort=None,
+        fields=None, exclude=None, owners=None):
+    """
+    Build the query for `dmp._iter_rows`
+
+    Returns
+    -------
+    tuple
+        (filter, projection, sort specification or None, limit or None)
+    """
+    query = row_filter(owner_match(user_id, owners), key, value)
+
+    # The files of several owners are merged in the same order as the
+    # pages so that the listing is stable
+    paged = (
+        limit is not None or after is not None or sort is not None
+        or isinstance(query["user_id"], dict))
+    if sort is None:
+        sort = pymongo.ASCENDING
+
+    if after is not None:
+        query.update(keyset_filter(after, sort))
+
+    fields = projection(rest, fields, exclude)
+
+    if paged is False:
+        return (query, fields, None, None)
+
+    order = [("creation_time", sort), ("_id", sort)]
+    return (query, fields, order, None if limit is None else int(limit))
+
+
+def owner_match(user_id, owners=None):
+    """
+    Value to match the `user_id` on for the files of a user, or for the
+    files of each of a list of owners with a single `$in` query that uses
+    the (user_id, ...) indexes. Repeated owners are only matched once.
+    """
+    if owners is None:
+        return user_id
+    owners = list(dict.fromkeys([str(owner) for owner in owners]))
+    if not owners:
+        raise ValueError('At least one owner must be given')
+    if len(owners) == 1:
+        return owners[0]
+    return {"$in": owners}
+
+
+def projection(rest=False, fields=None, exclude=None):
+    """
+    Build the projection for the files returned by `dmp._iter_rows`
+
+    Parameters
+    ----------
+    rest : bool
+        Use the "rest" projection when no `fields` are given
+    fields : list or str
+        Fields to include, or the name of one of the `PROJECTIONS`. The
+        `_id` is always returned.
+    exclude : list
+        Fields to leave out. MongoDB cannot leave out part of an included
+        field, so excluding a nested field (eg "meta_data.tool_params")
+        lists the other stored fields to leave out instead.
+
+    Returns
+    -------
+    dict
+        MongoDB projection
+    """
+    if fields is None:
+        fields = "rest" if rest is True else "full"
+    if isinstance(fields, str):
+        if fields not in PROJECTIONS:
+            raise ValueError(
+                "Projection must be one of: " + ", ".join(sorted(PROJECTIONS)))
+        fields = PROJECTIONS[fields]
+
+    exclude = set(exclude or [])
+    include = [field for field in fields if field != "_id" and field not in exclude]
+    nested = sorted(
+        field for field in exclude if "." in field and field.split(".", 1)[0] in include)
+
+    if not nested:
+        if not include:
+            return {"_id": 1}
+        return dict.fromkeys(include, 1)
+
+    if any("." in field for field in include):
+        raise ValueError("Nested fields cannot be both included and excluded")
+    excluded = dict.fromkeys(sorted(ENTRY_FIELDS.difference(include)), 0)
+    excluded.update(dict.fromkeys(nested, 0))
+    return excluded
+
+
+def projection_key(rest=False, fields=None, exclude=None):
+    """
+    Part of the `get_file_by_id` cache key that identifies the projection
+    """
+    if fields is None and exclude is None:
+        return rest
+    if fields is not None and not isinstance(fields, str):
+        fields = tuple(fields)
+    return (rest, fields, tuple(sorted(exclude or [])))
+
+
+def row_filter(user_id, key=None, value=None):
+    """
+    Query for the files of a user, optionally matching a single field
+    """
+    query = {"user_id": user_id}
+    if (
+            key is not None
+            and isinstance(str(key), str)
+            and isinstance(value, (str, int, float, bson.objectid.ObjectId))
+    ):
+        query[key] = value
+    return query
+
+
+def keyset_filter(after, sort):
+    """
+    Filter to select the rows that come after a row in (`creation_time`,
+    `_id`) order
+
+    Parameters
+    ----------
+    after : tuple
+        (`creation_time`, `_id`) of the last row of the previous page, as
+        returned by the `get_files_by_*` methods
+    sort : int
+        pymongo.ASCENDING or pymongo.DESCENDING
+    """
+    creation_time, last_id = after
+    if not isinstance(creation_time, datetime.datetime):
+        time_format = "%Y-%m-%d %H:%M:%S"
+        if "." in str(creation_time):
+            time_format += ".%f"
+        creation_time = datetime.datetime.strptime(str(creation_time), time_format)
+    last_id = ObjectId(str(last_id))
+
+    operator = "$gt" if sort == pymongo.ASCENDING else "$lt"
+    return {
+        "$or": [
+            {"creation_time": {operator: creation_time}},
+            {"creation_time": creation_time, "_id": {operator: last_id}}
+        ]
+    }
+
+
+def format_entry(entry):
+    """
+    Convert the non-JSON types within a document to strings. Fields that
+    were left out by the projection are skipped.
+    """
+    entry["_id"] = str(entry["_id"])
+    if "creation_time" in entry:
+        entry["creation_time"] = str(entry["creation_time"])
+    if entry.get("source_id"):
+        entry["source_id"] = [
+            str(source_id) if isinstance(source_id, ObjectId) else source_id
+            for source_id in entry["source_id"]
+        ]
+    if "expiration_date" in entry.get("meta_data", {}):
+        entry["meta_data"]["expiration_date"] = str(entry["meta_data"]["expiration_date"])
+    return entry
+
+
+def graph_pipeline(user_id, file_id, max_depth=None):
+    """
+    Aggregation pipeline that finds all of the parents of a file with
+    `$graphLookup` on the `source_id` links
+    """
+    pipeline = [
+        {"$match": {"user_id": user_id, "_id": ObjectId(str(file_id))}},
+        {"$project": {"source_id": 1}}
+    ]
+    if max_depth is None or max_depth > 1:
+        graph_lookup = {
+            "from": "entries",
+            "startWith": "$source_id",
+            "connectFromField": "source_id",
+            "connectToField": "_id",
+            "as": "ancestors",
+            "restrictSearchWithMatch": {"user_id": user_id}
+        }
+        if max_depth is not None:
+            # Parents found at depth n provide the links of generation n+2
+            graph_lookup["maxDepth"] = max_depth - 2
+        pipeline.append({"$graphLookup": graph_lookup})
+    return pipeline
+
+
+def graph_links(file_id, file_obj):
+    """
+    [child, parent] pairs from a document returned by `graph_pipeline`
+    """
+    parent_files = []
+    for source_id in file_obj.get("source_id") or []:
+        parent_files.append([str(file_id), str(source_id)])
+    for ancestor in file_obj.get("ancestors", []):
+        for source_id in ancestor.get("source_id") or []:
+            parent_files.append([str(ancestor["_id"]), str(source_id)])
+    return parent_files
+
+
+def unique_links(parent_files):
+    """
+    Remove repeated [child, parent] pairs, keeping the first of each
+    """
+    unique_data = []
+    seen = set()
+    for link in parent_files:
+        if tuple(link) not in seen:
+            seen.add(tuple(link))
+            unique_data.append(link)
+    return unique_data
+
+
+class parent_walk(object):  # pylint: disable=invalid-name
+    """
+    Breadth first walk up the `source_id` links from a file, for backends
+    without `$graphLookup`, with a single `$in` query per generation
+
+    Each query from `next_query` is run by the caller and the documents that
+    it returns are passed to `add`, until `next_query` returns None. The
+    [child, parent] pairs are then in `links`.
+    """
+
+    def __init__(self, user_id, file_id, max_depth=None):
+        """
+        Parameters
+        ----------
+        user_id : str
+        file_id : str
+            File ID for leaf file
+        max_depth : int
+            Maximum number of generations of parents to return
+        """
+        self.user_id = user_id
+        self.max_depth = max_depth
+        self.links = []
+        self._frontier = [ObjectId(str(file_id))]
+        self._seen = set(self._frontier)
+        self._depth = 0
+
+    def next_query(self):
+        """
+        (filter, projection) for the documents of the next generation, or
+        None once the walk is complete
+        """
+        if not self._frontier:
+            return None
+        if self.max_depth is not None and self._depth >= self.max_depth:
+            return None
+
+        query = ({"user_id": self.user_id, "_id": {"$in": self._frontier}}, {"source_id": 1})
+        self._frontier = []
+        self._depth += 1
+        return query
+
+    def add(self, file_obj):
+        """
+        Record the [child, parent] pairs for the `source_id` links of a
+        document. Parents that have not been seen before are added to the
+        next generation.
+        """
+        for source_id in file_obj.get("source_id") or []:
+            self.links.append([str(file_obj["_id"]), str(source_id)])
+            source_oid = to_object_id(source_id)
+            if source_oid not in self._seen:
+                self._seen.add(source_oid)
+                self._frontier.append(source_oid)
+
+
+def parent_query(user_id, parent_dir):
+    """
+    (filter, projection) for the parent directory of a new entry, or None if
+    `parent_dir` is not the id of an entry
+    """
+    parent_oid = to_object_id(parent_dir)
+    if not isinstance(parent_oid, ObjectId):
+        return None
+    return ({"user_id": user_id, "_id": parent_oid}, {"ancestors": 1})
+
+
+def child_ancestors(parent):
+    """
+    Materialised path for an entry within a directory. This is the list of
+    the `_id` of every directory from the root down to and including the
+    parent directory, or empty if the directory was not found.
+    """
+    if parent is None:
+        return []
+    return parent.get("ancestors", []) + [parent["_id"]]
+
+
+def subtree_query(user_id, file_id):
+    """
+    (filter, projection) for the entries below a directory
+    """
+    return ({"user_id": user_id, "ancestors": ObjectId(str(file_id))}, {"ancestors": 1})
+
+
+def move_requests(file_id, ancestors, below):
+    """
+    Updates for the materialised paths of an entry, and of the entries
+    `below` it from `subtree_query`, after it has been moved to a directory
+    with the path `ancestors`
+    """
+    file_oid = ObjectId(str(file_id))
+    requests = [
+        pymongo.UpdateOne({"_id": file_oid}, {"$set": {"ancestors": ancestors}})
+    ]
+    for entry in below:
+        position = entry["ancestors"].index(file_oid)
+        requests.append(pymongo.UpdateOne(
+            {"_id": entry["_id"]},
+            {"$set": {"ancestors": ancestors + entry["ancestors"][position:]}}
+        ))
+    return requests
+
+
+def column_value(key, value):
+    """
+    Value to store for a change to a top level field with `modify_column`
+    """
+    if str(key) in ['size', 'taxon_id']:
+        return int(value)
+    return value
+
+
+def check_move(file_id, ancestors):
+    """
+    Check that an entry is not being moved to a directory with the path
+    `ancestors` below itself
+    """
+    if ObjectId(str(file_id)) in ancestors:
+        raise ValueError('A directory cannot be moved inside itself')
+
+
+class field_update(object):  # pylint: disable=invalid-name
+    """
+    Change to a single field of a file that is validated against the current
+    document before anything is written, and is then only applied if none of
+    the fields that the validation depended on have been changed since the
+    document was read
+
+    .. code-block:: python
+
+       change = field_update(user_id, file_id, path, value, file_types)
+       for row_filter in change.attempts():
+           guard = change.guard(entries.find_one(row_filter))
+           if entries.update_one(guard, change.update).matched_count == 1:
+               return change.old_value
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self, user_id, file_id, path, value, file_types=None):
+        """
+        Parameters
+        ----------
+        user_id : str
+        file_id : str
+        path : str
+            Dotted path of the field that is being changed
+        value
+            New value for the path, or `UNSET` if it is being removed
+        file_types : file_type_table (Optional)
+            File types accepted by the validation
+        """
+        self.row_filter = {'user_id': user_id, '_id': ObjectId(str(file_id))}
+        self.path = path
+        self.value = value
+        self.file_types = file_types
+        if value is UNSET:
+            self.update = {'$unset': {path: ''}}
+        else:
+            self.update = {'$set': {path: value}}
+        self.old_value = None
+
+    def attempts(self):
+        """
+        Generate the filter to read the current document with for each
+        attempt. If another request changed the file every time then a
+        ValueError is raised.
+        """
+        for _ in range(UPDATE_ATTEMPTS):
+            yield self.row_filter
+        raise ValueError('The file was changed by another request, the update was not applied')
+
+    def guard(self, entry):
+        """
+        Validate the change against the current document
+
+        Returns
+        -------
+        dict
+            Filter that only matches the document while it is unchanged. The
+            value of the path before the change, or None if it was not set,
+            is kept in `old_value`.
+        """
+        if entry is None:
+            raise ValueError('No file found for the given user_id and file_id')
+
+        guard, old_value = prepare_update(
+            entry, self.row_filter, self.path, self.value, self.file_types)
+        self.old_value = None if old_value is UNSET else old_value
+        return guard
+
+
+def guard_filter(query, entry, paths):
+    """
+    Filter that only matches the document if each of the paths still has
+    the value that it has in `entry`
+    """
+    guard = dict(query)
+    for path in paths:
+        current = get_path(entry, path)
+        guard[path] = {'$exists': False} if current is UNSET else current
+    return guard
+
+
+def prepare_update(  # pylint: disable=too-many-arguments
+        entry, query, path, value, file_types=None):
+    """
+    Validate a change to a path against the current document
+
+    Parameters
+    ----------
+    entry : dict
+        Current document
+    query : dict
+        Filter for the document
+    path : str
+        Dotted path of the field that is being changed
+    value
+        New value for the path, or `UNSET` if it is being removed
+    file_types : file_type_table (Optional)
+        File types accepted by the validation
+
+    Returns
+    -------
+    tuple
+        (filter that only matches the document while it is unchanged, the
+        current value of the path or `UNSET`)
+
+    If the change would make the entry invalid then a ValueError or
+    TypeError is raised.
+    """
+    paths = list(VALIDATED_PATHS)
+    if path not in paths:
+        paths.append(path)
+    guard = guard_filter(query, entry, paths)
+
+    old_value = get_path(entry, path)
+    changed = copy.deepcopy(entry)
+    apply_path(changed, path, value)
+    check_entry(changed, file_types)
+
+    return (guard, old_value)
+
+
+def get_path(entry, path):
+    """
+    Value at a dotted path within a document, or `UNSET` if it is missing
+    """
+    value = entry
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return UNSET
+        value = value[key]
+    return value
+
+
+def apply_path(entry, path, value):
+    """
+    Apply a change to a dotted path within a local copy of a document
+    """
+    keys = path.split('.')
+    target = entry
+    for key in keys[:-1]:
+        target = target.setdefault(key, {})
+    if value is UNSET:
+        target.pop(keys[-1], None)
+    else:
+        target[keys[-1]] = value
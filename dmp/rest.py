@@ -18,9 +18,9 @@
 from __future__ import print_function
 
 import sys
-import configparser
 import pymongo
-from pymongo import MongoClient, ReadPreference
+
+from dmp.connection import connection_manager
 
 
 class rest(object):  # pylint: disable=invalid-name
@@ -28,31 +28,28 @@ class rest(object):  # pylint: disable=invalid-name
     API for management of files within the VRE
     """
 
-    def __init__(self, cnf_loc='', test=False):
+    def __init__(self, cnf_loc='', test=False, backend="memory"):
         """
         Initialise the module and set basic defaults
-        """
 
-        config = configparser.RawConfigParser()
-        config.read(cnf_loc)
+        Parameters
+        ----------
+        cnf_loc : str
+            Location of the configuration file
+        test : bool
+            Use an in-memory test database loaded with sample services
+        backend : str (Optional)
+            Storage backend for the test database, "memory" (default) or
+            "mongomock"
+        """
 
         if test is True:
-            import mongomock
-            self.client = mongomock.MongoClient()
+            self.client = connection_manager.create_client(backend)
             self.db_handle = self.client["rest"]
-            self._test_loading_dataset()
         else:
-            host = config.get("rest", "host")
-            port = config.getint("rest", "port")
-            user = config.get("rest", "user")
-            password = config.get("rest", "pass")
-            db_name = config.get("rest", "db")
-
             try:
-                self.client = MongoClient(
-                    host, port, read_preference=ReadPreference.SECONDARY_PREFERRED)
-                self.client.admin.authenticate(user, password)
-                self.db_handle = self.client[db_name]
+                self.client = connection_manager.get_client(cnf_loc, "rest")
+                self.db_handle = connection_manager.get_database(cnf_loc, "rest")
             except RuntimeError:
                 err = sys.exc_info()[0]
                 print("Error: %s" % err)
@@ -62,6 +59,9 @@ class rest(object):  # pylint: disable=invalid-name
         self.db_handle.entries.create_index([('name', pymongo.ASCENDING)], unique=True)
         self.db_handle.entries.create_index([('status', pymongo.ASCENDING)], unique=False)
 
+        if test is True:
+            self._test_loading_dataset()
+
     def _test_loading_dataset(self):
         self.add_service("service", "Root API service", "/api", "up")
         self.add_service("dmp", "DMP API - Lists static tracks", "/api/dmp", "up")
@@ -0,0 +1,565 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Index management for the DMP collections.
+
+The indexes are versioned by `SCHEMA_VERSION` and a record of the version that
+has been applied is kept in the `schema` collection. `check_version` is called
+when a dmp object is created. It only reads the stored version, the first time
+that it is called for a database within a process, and logs a warning if the
+database is behind.
+
+Changes to the layout of stored documents are applied by the functions listed
+in `MIGRATIONS`, keyed on the schema version that they upgrade to. The
+migrations, the new indexes and the removal of `OBSOLETE_INDEXES` are only
+applied by `upgrade`, as an explicit deployment step:
+
+.. code-block:: none
+   :linenos:
+
+   python -m dmp.schema --config dmp.cnf
+
+Adding ``--unique-file-path`` makes the (user_id, file_path) index unique.
+While an upgrade runs it holds a lock document in the `schema` collection so
+that only one process can upgrade a database at a time.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import logging
+import os
+import socket
+import threading
+import uuid
+
+import pymongo
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+SCHEMA_VERSION = 8
+
+FILE_PATH_INDEX = "user_id_1_file_path_1"
+
+ENTRIES_INDEXES = [
+    # The listings are ordered on (creation_time, _id) so that they can be
+    # paged with a keyset cursor
+    {
+        "name": "user_id_1_creation_time_1__id_1",
+        "keys": [
+            ("user_id", pymongo.ASCENDING), ("creation_time", pymongo.ASCENDING),
+            ("_id", pymongo.ASCENDING)
+        ],
+        "unique": False
+    },
+    {
+        "name": "user_id_1_file_type_1_creation_time_1__id_1",
+        "keys": [
+            ("user_id", pymongo.ASCENDING), ("file_type", pymongo.ASCENDING),
+            ("creation_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)
+        ],
+        "unique": False
+    },
+    {
+        "name": "user_id_1_data_type_1_creation_time_1__id_1",
+        "keys": [
+            ("user_id", pymongo.ASCENDING), ("data_type", pymongo.ASCENDING),
+            ("creation_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)
+        ],
+        "unique": False
+    },
+    {
+        "name": "user_id_1_taxon_id_1_creation_time_1__id_1",
+        "keys": [
+            ("user_id", pymongo.ASCENDING), ("taxon_id", pymongo.ASCENDING),
+            ("creation_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)
+        ],
+        "unique": False
+    },
+    {
+        "name": "user_id_1_meta_data.assembly_1_creation_time_1__id_1",
+        "keys": [
+            ("user_id", pymongo.ASCENDING), ("meta_data.assembly", pymongo.ASCENDING),
+            ("creation_time", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)
+        ],
+        "unique": False
+    },
+    {
+        # Can be made unique with ensure_indexes(unique_file_path=True)
+        "name": FILE_PATH_INDEX,
+        "keys": [("user_id", pymongo.ASCENDING), ("file_path", pymongo.ASCENDING)],
+        "unique": False
+    },
+    {
+        "name": "user_id_1_parent_dir_1",
+        "keys": [("user_id", pymongo.ASCENDING), ("parent_dir", pymongo.ASCENDING)],
+        "unique": False
+    },
+    {
+        # Multikey index on the materialised path of each entry, for
+        # recursive directory listings and sizes
+        "name": "user_id_1_ancestors_1",
+        "keys": [("user_id", pymongo.ASCENDING), ("ancestors", pymongo.ASCENDING)],
+        "unique": False
+    },
+    {
+        # Multikey index for finding the files derived from a file
+        "name": "user_id_1_source_id_1",
+        "keys": [("user_id", pymongo.ASCENDING), ("source_id", pymongo.ASCENDING)],
+        "unique": False
+    },
+    {
+        # Used by dmp.purge_expired. This is deliberately not a TTL index so
+        # that removal of expired files stays under the control of the API.
+        "name": "meta_data.expiration_date_1",
+        "keys": [("meta_data.expiration_date", pymongo.ASCENDING)],
+        "unique": False
+    },
+]
+
+# Indexes from earlier versions that are prefixes of the current indexes
+OBSOLETE_INDEXES = [
+    "user_id_1",
+    "user_id_1_file_type_1",
+    "user_id_1_data_type_1",
+    "user_id_1_taxon_id_1",
+]
+
+# Id of the lock document in the schema collection, and the number of
+# seconds after which a lock that was not released is ignored
+UPGRADE_LOCK = "upgrade_lock"
+UPGRADE_LOCK_TTL = 3600
+
+_LOCK = threading.RLock()
+_CHECKED = set()
+_KNOWN_INDEXES = {}
+
+logger = logging.getLogger("dmp.schema")  # pylint: disable=invalid-name
+
+
+def _db_key(db_handle):
+    return (id(db_handle.client), db_handle.name)
+
+
+def _migrate_source_ids(db_handle):
+    """
+    Version 2: store the `source_id` links as ObjectId so that they can be
+    matched against `_id` by `$graphLookup`
+    """
+    entries = db_handle.entries
+    updates = []
+    for entry in entries.find({"source_id": {"$type": "string"}}, {"source_id": 1}):
+        source_ids = [
+            ObjectId(source_id) if ObjectId.is_valid(source_id) else source_id
+            for source_id in entry["source_id"]
+        ]
+        updates.append(
+            pymongo.UpdateOne({"_id": entry["_id"]}, {"$set": {"source_id": source_ids}}))
+        if len(updates) >= 1000:
+            entries.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        entries.bulk_write(updates, ordered=False)
+
+
+def _migrate_ancestors(db_handle):
+    """
+    Version 7: add the materialised path of directory ids, `ancestors`, to
+    each entry. Entries are updated one level of the directory tree at a time
+    starting from those without a parent directory.
+    """
+    entries = db_handle.entries
+    entries.update_many(
+        {"ancestors": {"$exists": False}}, {"$set": {"ancestors": []}})
+
+    frontier = dict([
+        (entry["_id"], [])
+        for entry in entries.find(
+            {"path_type": "dir", "parent_dir": {"$in": [None, ""]}}, {"_id": 1})
+    ])
+    while frontier:
+        parent_ids = list(frontier.keys())
+        children = entries.find(
+            {"parent_dir": {"$in": parent_ids + [str(p_id) for p_id in parent_ids]}},
+            {"parent_dir": 1, "path_type": 1}
+        )
+        updates = []
+        next_frontier = {}
+        for child in children:
+            parent_id = ObjectId(str(child["parent_dir"]))
+            ancestors = frontier[parent_id] + [parent_id]
+            updates.append(
+                pymongo.UpdateOne({"_id": child["_id"]}, {"$set": {"ancestors": ancestors}}))
+            if child.get("path_type") == "dir":
+                next_frontier[child["_id"]] = ancestors
+        if updates:
+            entries.bulk_write(updates, ordered=False)
+        frontier = next_frontier
+
+
+def rebuild_usage(db_handle, user_ids=None):
+    """
+    Recalculate the per user counters in the `usage` collection from the
+    entries collection. This is also version 8 of the schema.
+
+    Parameters
+    ----------
+    db_handle : Database
+        Handle for the DMP database
+    user_ids : list (Optional)
+        Users to recalculate. By default all users are recalculated.
+    """
+    pipeline = []
+    if user_ids is not None:
+        pipeline.append({"$match": {"user_id": {"$in": user_ids}}})
+    pipeline.append(
+        {"$group": {"_id": "$user_id", "files": {"$sum": 1}, "size": {"$sum": "$size"}}})
+
+    totals = dict([
+        (group["_id"], group) for group in db_handle.entries.aggregate(pipeline)
+    ])
+    if user_ids is None:
+        db_handle.usage.delete_many({"_id": {"$nin": list(totals.keys())}})
+    else:
+        for user_id in user_ids:
+            if user_id not in totals:
+                db_handle.usage.delete_one({"_id": user_id})
+
+    for user_id, group in totals.items():
+        db_handle.usage.replace_one(
+            {"_id": user_id}, {"files": group["files"], "size": group["size"]}, upsert=True)
+
+
+MIGRATIONS = {
+    2: _migrate_source_ids,
+    7: _migrate_ancestors,
+    8: rebuild_usage,
+}
+
+
+def ensure_indexes(db_handle, unique_file_path=False):
+    """
+    Create any of the indexes in `ENTRIES_INDEXES` that are missing from the
+    entries collection.
+
+    Parameters
+    ----------
+    db_handle : Database
+        Handle for the DMP database
+    unique_file_path : bool
+        Require each `file_path` to be unique for a user. An existing
+        non-unique index is rebuilt, as long as there are no duplicate
+        paths.
+
+    Returns
+    -------
+    list
+        Names of the indexes that were created
+
+    Raises
+    ------
+    ValueError
+        If a unique index is requested for fields that have duplicate values.
+        The existing index is left in place.
+    """
+    entries = db_handle.entries
+    index_info = entries.index_information()
+    existing = set(index_info.keys())
+
+    created = []
+    for index in ENTRIES_INDEXES:
+        unique = index["unique"] or (index["name"] == FILE_PATH_INDEX and unique_file_path)
+        if index["name"] in existing:
+            if not unique or index_info[index["name"]].get("unique"):
+                continue
+            _rebuild_unique(entries, index)
+        else:
+            entries.create_index(
+                index["keys"], name=index["name"], unique=unique,
+                background=True, **index.get("options", {}))
+        existing.add(index["name"])
+        created.append(index["name"])
+
+    with _LOCK:
+        _KNOWN_INDEXES[_db_key(db_handle)] = frozenset(existing)
+
+    return created
+
+
+def find_duplicates(entries, keys, limit=5):
+    """
+    Values of the keys that are shared by more than one document
+
+    Parameters
+    ----------
+    entries : Collection
+    keys : list
+        Index keys as (field, direction) tuples
+    limit : int
+        Maximum number of duplicates to return
+
+    Returns
+    -------
+    list
+        dict of the field values for each duplicate
+    """
+    pipeline = [
+        {"$group": {
+            "_id": dict([(field.replace(".", "_"), "$" + field) for field, _ in keys]),
+            "count": {"$sum": 1}
+        }},
+        {"$match": {"count": {"$gt": 1}}},
+        {"$limit": limit},
+    ]
+    return [group["_id"] for group in entries.aggregate(pipeline)]
+
+
+def _rebuild_unique(entries, index):
+    """
+    Replace a non-unique index with a unique index on the same keys. The
+    collection is checked for duplicates before the index is dropped, and if
+    the unique index still cannot be built, eg because duplicates were added
+    in the meantime, then the non-unique index is restored.
+    """
+    duplicates = find_duplicates(entries, index["keys"])
+    if duplicates:
+        raise ValueError(
+            "Cannot make the " + index["name"] + " index unique, there are duplicate "
+            "values: " + str(duplicates))
+
+    entries.drop_index(index["name"])
+    try:
+        entries.create_index(
+            index["keys"], name=index["name"], unique=True,
+            background=True, **index.get("options", {}))
+    except (DuplicateKeyError, OperationFailure):
+        entries.create_index(
+            index["keys"], name=index["name"], unique=False,
+            background=True, **index.get("options", {}))
+        raise
+
+
+def drop_obsolete_indexes(db_handle):
+    """
+    Drop the indexes in `OBSOLETE_INDEXES`. This should only be run once the
+    indexes that replace them are in place.
+
+    Returns
+    -------
+    list
+        Names of the indexes that were dropped
+    """
+    entries = db_handle.entries
+    existing = set(entries.index_information().keys())
+
+    dropped = []
+    for index_name in OBSOLETE_INDEXES:
+        if index_name in existing:
+            entries.drop_index(index_name)
+            existing.discard(index_name)
+            dropped.append(index_name)
+
+    with _LOCK:
+        _KNOWN_INDEXES[_db_key(db_handle)] = frozenset(existing)
+
+    return dropped
+
+
+def acquire_upgrade_lock(db_handle, ttl=UPGRADE_LOCK_TTL):
+    """
+    Take the lock document that only allows one upgrade of a database at a
+    time. A lock that is older than `ttl` seconds is assumed to have been
+    left by a process that failed and is replaced.
+
+    Returns
+    -------
+    str
+        Owner of the lock, to pass to `release_upgrade_lock`
+
+    Raises
+    ------
+    RuntimeError
+        If another process holds the lock
+    """
+    owner = "{0}:{1}:{2}".format(socket.gethostname(), os.getpid(), uuid.uuid4().hex)
+    now = datetime.datetime.utcnow()
+    lock = {
+        "_id": UPGRADE_LOCK,
+        "owner": owner,
+        "acquired": now,
+        "expires": now + datetime.timedelta(seconds=ttl)
+    }
+
+    db_handle.schema.delete_one({"_id": UPGRADE_LOCK, "expires": {"$lt": now}})
+    try:
+        db_handle.schema.insert_one(lock)
+    except DuplicateKeyError:
+        current = db_handle.schema.find_one({"_id": UPGRADE_LOCK}) or {}
+        raise RuntimeError(
+            "The schema is already being upgraded by " + str(current.get("owner")) +
+            " since " + str(current.get("acquired")))
+
+    return owner
+
+
+def release_upgrade_lock(db_handle, owner):
+    """
+    Release the lock taken by `acquire_upgrade_lock`, if it is still held by
+    the owner
+    """
+    db_handle.schema.delete_one({"_id": UPGRADE_LOCK, "owner": owner})
+
+
+def upgrade(db_handle, unique_file_path=False):
+    """
+    Apply any outstanding migrations, create missing indexes, drop the
+    obsolete indexes and record the new schema version. The upgrade holds
+    the lock from `acquire_upgrade_lock` while it runs.
+
+    Parameters
+    ----------
+    db_handle : Database
+        Handle for the DMP database
+    unique_file_path : bool
+        See `ensure_indexes`
+
+    Returns
+    -------
+    list
+        Names of the indexes that were created
+
+    Raises
+    ------
+    RuntimeError
+        If another process is upgrading the database
+    """
+    owner = acquire_upgrade_lock(db_handle)
+    try:
+        version = get_version(db_handle)
+
+        for migration_version in sorted(MIGRATIONS):
+            if version < migration_version <= SCHEMA_VERSION:
+                logger.info("Applying schema migration %d", migration_version)
+                MIGRATIONS[migration_version](db_handle)
+
+        created = ensure_indexes(db_handle, unique_file_path)
+        drop_obsolete_indexes(db_handle)
+
+        db_handle.schema.update_one(
+            {"_id": "entries"}, {"$set": {"version": SCHEMA_VERSION}}, upsert=True)
+    finally:
+        release_upgrade_lock(db_handle, owner)
+
+    with _LOCK:
+        _CHECKED.discard(_db_key(db_handle))
+
+    return created
+
+
+def get_version(db_handle):
+    """
+    Schema version that has been applied to a database, 0 if it has never
+    been upgraded
+    """
+    schema_doc = db_handle.schema.find_one({"_id": "entries"})
+    return 0 if schema_doc is None else schema_doc.get("version", 0)
+
+
+def check_version(db_handle, key=None):
+    """
+    Check that the schema of a database is current. This only reads the
+    stored version, the first time that it is called for a given key within a
+    process. Nothing is changed in the database; if it is behind then a
+    warning is logged asking for `python -m dmp.schema` to be run.
+
+    Parameters
+    ----------
+    db_handle : Database
+        Handle for the DMP database
+    key : tuple
+        Identifier for the database within the process. Defaults to the
+        identity of the client and the name of the database.
+
+    Returns
+    -------
+    bool
+        True if the schema is current, or had already been checked, and False
+        if the database needs to be upgraded
+    """
+    if key is None:
+        key = _db_key(db_handle)
+
+    with _LOCK:
+        if key in _CHECKED:
+            return True
+        _CHECKED.add(key)
+
+    version = get_version(db_handle)
+    if version < SCHEMA_VERSION:
+        logger.warning(
+            "The DMP schema of database %s is at version %d but version %d is required. "
+            "Run `python -m dmp.schema --config <dmp.cnf>` to upgrade it.",
+            db_handle.name, version, SCHEMA_VERSION)
+        return False
+
+    return True
+
+
+def get_known_indexes(db_handle):
+    """
+    List the names of the indexes on the entries collection that are known
+    to exist from the last call to `ensure_indexes` or
+    `drop_obsolete_indexes`, without querying the database.
+
+    Parameters
+    ----------
+    db_handle : Database
+        Handle for the DMP database
+
+    Returns
+    -------
+    frozenset
+        Index names. Empty if `ensure_indexes` has not been run in this
+        process.
+    """
+    with _LOCK:
+        return _KNOWN_INDEXES.get(_db_key(db_handle), frozenset())
+
+
+def main():
+    """
+    Command line entry point for upgrading the DMP schema and indexes
+    """
+    from dmp.connection import connection_manager
+
+    parser = argparse.ArgumentParser(description="Upgrade the DMP schema and indexes")
+    parser.add_argument("--config", required=True, help="Location of the dmp.cnf file")
+    parser.add_argument(
+        "--unique-file-path", action="store_true",
+        help="Require each file_path to be unique for a user")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    db_handle = connection_manager.get_database(args.config, "dmp")
+    print("Current schema version:", get_version(db_handle))
+    created = upgrade(db_handle, args.unique_file_path)
+    print("Schema version:", SCHEMA_VERSION)
+    print("Created indexes:", ", ".join(created) if created else "none")
+
+
+if __name__ == "__main__":
+    main()
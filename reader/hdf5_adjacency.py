@@ -15,6 +15,8 @@
    limitations under the License.
 """
 
+import functools
+import io
 import os
 import h5py
 import numpy as np
@@ -23,10 +25,169 @@ from dmp import dmp
 from dm_generator.GenerateSampleAdjacency import GenerateSampleAdjacency
 
 
+# Formats that get_range can return the results in
+OUTPUT_FORMATS = ("entries", "columnar", "npz")
+
+
+def _downcast(values):
+    """
+    Store integer positions as int32 when they fit
+    """
+    info = np.iinfo(np.int32)
+    if values.size == 0 or (values.min() >= info.min and values.max() <= info.max):
+        return values.astype(np.int32)
+    return values.astype(np.int64)
+
+
+def _dense_block(dset, row_start, row_end, col_start, col_end):
+    """
+    Non-zero cells within a block of a dense matrix
+
+    Returns
+    -------
+    tuple
+        (rows, cols, values) numpy arrays with the rows and columns relative
+        to the start of the block, in row major order
+    """
+    result = dset[row_start:row_end, col_start:col_end]
+    rows, cols = np.nonzero(result)
+    return (rows, cols, result[rows, cols])
+
+
+def _upper_triangle_block(  # pylint: disable=too-many-arguments,too-many-locals
+        read, size, row_start, row_end, col_start, col_end):
+    """
+    Non-zero cells within a block of a symmetric matrix where only the upper
+    triangle is stored. Cells of the block below the diagonal are read from
+    their mirror above the diagonal.
+
+    Parameters
+    ----------
+    read : function
+        Reads the non-zero (rows, cols, values) of a block of the stored
+        matrix, eg `_dense_block` or `_sparse_matrix.block`
+    size : int
+        Number of bins in the matrix
+
+    Returns
+    -------
+    tuple
+        (rows, cols, values) numpy arrays with the rows and columns relative
+        to the start of the block, in row major order
+    """
+    row_start, row_end = [min(max(i, 0), size) for i in (row_start, row_end)]
+    col_start, col_end = [min(max(i, 0), size) for i in (col_start, col_end)]
+    parts = []
+
+    # Cells on or above the diagonal
+    upper_start = max(col_start, row_start)
+    if row_start < row_end and upper_start < col_end:
+        rows, cols, values = read(row_start, row_end, upper_start, col_end)
+        keep = rows + row_start <= cols + upper_start
+        parts.append((rows[keep], cols[keep] + (upper_start - col_start), values[keep]))
+
+    # Cells below the diagonal, from the transposed block
+    lower_end = min(col_end, row_end)
+    if col_start < lower_end and row_start < row_end:
+        rows, cols, values = read(col_start, lower_end, row_start, row_end)
+        keep = rows + col_start < cols + row_start
+        parts.append((cols[keep], rows[keep], values[keep]))
+
+    if not parts:
+        empty = np.zeros(0, dtype=np.int64)
+        return (empty, empty, np.zeros(0, dtype=np.int32))
+
+    rows = np.concatenate([part[0] for part in parts])
+    cols = np.concatenate([part[1] for part in parts])
+    values = np.concatenate([part[2] for part in parts])
+    order = np.lexsort((cols, rows))
+    return (rows[order], cols[order], values[order])
+
+
+class _sparse_matrix(object):  # pylint: disable=invalid-name
+    """
+    Read access to an adjacency matrix stored in the sparse layout. Each
+    resolution is a group with the non-zero cells in CSR form, as used by
+    cooler:
+
+    bin1_offset : int64, number of bins + 1
+        Position in bin2_id and count of the first cell of each row
+    bin2_id : int64
+        Column of each cell, sorted within each row
+    count : int32
+        Value of each cell
+
+    The group attributes hold the `chromosomes`, as for the dense datasets,
+    the `shape` of the matrix and `layout` set to "sparse".
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.attrs = group.attrs
+        self.shape = tuple(int(i) for i in group.attrs["shape"])
+
+    def _row_cells(self, row_start, row_end):
+        """
+        Offsets, columns and values of the cells in a band of rows
+        """
+        offsets = self.group["bin1_offset"][row_start:row_end + 1]
+        cells_start, cells_end = int(offsets[0]), int(offsets[-1])
+        return (
+            offsets,
+            self.group["bin2_id"][cells_start:cells_end],
+            self.group["count"][cells_start:cells_end]
+        )
+
+    def block(self, row_start, row_end, col_start, col_end):
+        """
+        Non-zero cells within a block of the matrix. Only the cells of the
+        rows in the block are read from the file.
+
+        Returns
+        -------
+        tuple
+            (rows, cols, values) numpy arrays with the rows and columns
+            relative to the start of the block, in row major order
+        """
+        row_start, row_end = [min(max(i, 0), self.shape[0]) for i in (row_start, row_end)]
+        col_start, col_end = [min(max(i, 0), self.shape[1]) for i in (col_start, col_end)]
+        if row_end <= row_start or col_end <= col_start:
+            empty = np.zeros(0, dtype=np.int64)
+            return (empty, empty, np.zeros(0, dtype=self.group["count"].dtype))
+
+        offsets, cols, values = self._row_cells(row_start, row_end)
+        rows = np.repeat(np.arange(row_end - row_start), np.diff(offsets))
+
+        keep = (cols >= col_start) & (cols < col_end) & (values != 0)
+        return (rows[keep], cols[keep] - col_start, values[keep])
+
+    def __getitem__(self, index):
+        """
+        Value of a single cell, with index as (row, column)
+        """
+        row, col = [int(i) for i in index]
+        if row < 0 or row >= self.shape[0] or col < 0 or col >= self.shape[1]:
+            raise IndexError("Index (" + str(row) + ", " + str(col) + ") is out of range")
+
+        _, cols, values = self._row_cells(row, row + 1)
+        position = np.searchsorted(cols, col)
+        if position < len(cols) and cols[position] == col:
+            return values[position]
+        return values.dtype.type(0)
+
+
 class adjacency(object):  # pylint: disable=invalid-name
     """
     Class related to handling the functions for interacting directly with the
     HDF5 files. All required information should be passed to this class.
+
+    Each resolution is either a dense genome x genome dataset or a group in
+    the sparse layout (see `_sparse_matrix`). The layout is detected when the
+    resolution is opened and the same functions work for both.
+
+    Either layout can store only the upper triangle of a symmetric matrix, in
+    which case the dataset or group has the attribute `triangle` set to
+    "upper". Queries that cross the diagonal are mirrored when they are read.
     """
 
     def __init__(self, user_id, file_id, resolution=None, cnf_loc=''):
@@ -65,13 +226,15 @@ class adjacency(object):  # pylint: disable=invalid-name
         self.resolutions = [int(i) for i in self.hdf5_handle.keys()]
 
         if resolution is None:
-            self.dset = self.hdf5_handle[str(self.resolutions[0])]
             self.resolution = self.resolutions[0]
         else:
-            self.dset = self.hdf5_handle[str(resolution)]
             self.resolution = resolution
+        self.dset = self._open_matrix(self.resolution)
+        self.symmetric = self._is_upper_triangle(self.dset)
 
         self.chr_param = self._calculate_chr_param(self.resolutions, self.dset.attrs["chromosomes"])
+        self.chr_ids, self.chr_offsets = self._calculate_chr_offsets(
+            self.chr_param, self.resolutions)
 
     def close(self):
         """
@@ -103,9 +266,48 @@ class adjacency(object):  # pylint: disable=invalid-name
 
         self.resolution = resolution
 
-        self.dset = self.hdf5_handle[str(self.resolution)]
+        self.dset = self._open_matrix(self.resolution)
+        self.symmetric = self._is_upper_triangle(self.dset)
         chromosomes = self.dset.attrs['chromosomes']
-        self.chr_param = self._calculate_chr_param(self.resolution, chromosomes)
+        self.chr_param = self._calculate_chr_param(self.resolutions, chromosomes)
+        self.chr_ids, self.chr_offsets = self._calculate_chr_offsets(
+            self.chr_param, self.resolutions)
+
+    def _open_matrix(self, resolution):
+        """
+        Matrix for a resolution. Resolutions stored in the sparse layout are
+        groups rather than datasets and are read with `_sparse_matrix`.
+        """
+        node = self.hdf5_handle[str(resolution)]
+        if isinstance(node, h5py.Group):
+            return _sparse_matrix(node)
+        return node
+
+    @staticmethod
+    def _is_upper_triangle(matrix):
+        """
+        Only the upper triangle of the matrix is stored. Matrices without the
+        `triangle` attribute store both triangles.
+        """
+        triangle = matrix.attrs.get("triangle")
+        if isinstance(triangle, bytes):
+            triangle = triangle.decode('utf-8')
+        return triangle == "upper"
+
+    def _read_block(self, row_start, row_end, col_start, col_end):
+        """
+        Non-zero cells within a block of the matrix for the current
+        resolution, for either layout
+        """
+        if isinstance(self.dset, _sparse_matrix):
+            read = self.dset.block
+        else:
+            read = functools.partial(_dense_block, self.dset)
+
+        if self.symmetric:
+            return _upper_triangle_block(
+                read, self.dset.shape[0], row_start, row_end, col_start, col_end)
+        return read(row_start, row_end, col_start, col_end)
 
     def get_details(self):
         """
@@ -172,7 +374,7 @@ class adjacency(object):  # pylint: disable=invalid-name
     def get_range(
             self, chr_id, start, end,
             limit_chr=None, limit_start=None, limit_end=None,
-            value_url='/api/getValue', no_links=None):
+            value_url='/api/getValue', no_links=None, output="entries"):
         """
         Get the interactions that happen within a defined region on a specific
         chromosome. Returns inter and intra interactions with the defined
@@ -200,6 +402,10 @@ class adjacency(object):  # pylint: disable=invalid-name
            adjacency matrix. In cases where this generates a large number of
            points it is possible to turn off generating these links. Set this
            value to 1.
+        output : str (Optional)
+           `entries` (default) returns a dict for each cell. `columnar`
+           returns parallel numpy arrays and `npz` returns them as the bytes of
+           an NPZ file (see `columns_to_npz`).
 
         Returns
         -------
@@ -207,7 +413,15 @@ class adjacency(object):  # pylint: disable=invalid-name
            log : list
               List of messages about the state for debugging
            results : list
-              List of values for given positions within the adjacency matrix
+              List of values for given positions within the adjacency matrix.
+              For the `columnar` output a dict with:
+
+              chr_ids : list
+                 Chromosome ids that the chrB codes refer to
+              chrA : str
+              chrB : numpy.ndarray
+                 Index of the chromosome of each cell in chr_ids
+              startA, startB, value, pos_x, pos_y : numpy.ndarray
 
         Example
         -------
@@ -220,51 +434,50 @@ class adjacency(object):  # pylint: disable=invalid-name
            value = r.get_range(2000000, 1000000)
         """
 
+        if output not in OUTPUT_FORMATS:
+            raise ValueError("output must be one of: " + ", ".join(OUTPUT_FORMATS))
+
         # Defines columns to get extracted from the array
         x_pos = int(np.floor(float(start) / float(self.resolution)))
         y_pos = int(np.ceil(float(end) / float(self.resolution)))
 
         # xy_offset for the chromosome in the super array
-        print(self.chr_param.keys())
         xy_offset = self.chr_param[chr_id]["bins"][self.resolution][1]
 
-        dset = self.hdf5_handle[str(self.resolution)]
-
         start2 = 0
         end2 = 0
+        col_offset = 0
         if limit_chr is not None:
             if limit_start is not None and limit_end is not None:
                 start2 = int(np.floor(float(limit_start) / float(self.resolution)))
                 end2 = int(np.ceil(float(limit_end) / float(self.resolution)))
                 xy2_offset = self.chr_param[limit_chr]["bins"][self.resolution][1]
+                col_offset = start2 + xy2_offset
 
-                result = dset[
-                    (x_pos + xy_offset):(y_pos + xy_offset),
-                    (start2 + xy2_offset):(end2 + xy2_offset)
-                ]
+                cells = self._read_block(
+                    x_pos + xy_offset, y_pos + xy_offset,
+                    start2 + xy2_offset, end2 + xy2_offset
+                )
             else:
                 start2 = self.chr_param[limit_chr]["bins"][self.resolution][1]
                 end2 = start2 + self.chr_param[limit_chr]["bins"][self.resolution][0]
+                col_offset = start2
 
-                result = dset[
-                    (x_pos + xy_offset):(y_pos + xy_offset),
-                    start2:end2
-                ]
+                cells = self._read_block(
+                    x_pos + xy_offset, y_pos + xy_offset, start2, end2)
         else:
-            result = dset[(x_pos + xy_offset):(y_pos + xy_offset), :]
+            cells = self._read_block(
+                x_pos + xy_offset, y_pos + xy_offset, 0, self.dset.shape[1])
 
-        # Iterate through slice and extract results greater than zero
-        results = []
-        log_text = []
+        columns = self._range_columns(cells, x_pos, xy_offset, col_offset)
 
-        r_index = np.transpose(np.nonzero(result))
-        log_text.append(
+        log_text = [
             {
                 "coord": {
                     "x0": (x_pos + xy_offset),
                     "x1": (y_pos + xy_offset)
                 },
-                "r_index": len(r_index),
+                "r_index": len(columns["value"]),
                 "param": {
                     "start": start,
                     "x": x_pos,
@@ -279,38 +492,167 @@ class adjacency(object):  # pylint: disable=invalid-name
                 },
                 'chr_param': self.chr_param
             }
-        )
+        ]
 
-        for i in r_index:
-            x_start = ((i[0] + x_pos) * int(self.resolution))
-            y_chr = self.get_chromosome_from_array_index(i[1] + start2)
-            if limit_chr is not None:
-                y_start = (i[1] + start2) * int(self.resolution)
-            else:
-                y_start = (
-                    i[1] - self.chr_param[y_chr]["bins"][self.resolution][1]
-                ) * int(self.resolution)
+        if output == "entries":
+            results = self._range_entries(chr_id, columns, value_url, no_links)
+        else:
+            results = columns
+            results["chrA"] = chr_id
+            if output == "npz":
+                results = self.columns_to_npz(results)
+
+        return {"log": log_text, "results": results}
+
+    @staticmethod
+    def columns_to_npz(columns, compressed=True):
+        """
+        Serialise the `columnar` results of `get_range` as a compact binary
+        frame. Chromosome codes are stored as int16 and positions as int32
+        when they fit.
+
+        Parameters
+        ----------
+        columns : dict
+            Results from `get_range(..., output="columnar")`
+        compressed : bool (Optional)
+            Compress the arrays with zlib
+
+        Returns
+        -------
+        bytes
+            Contents of an NPZ file that can be read with numpy.load or
+            `columns_from_npz`
+        """
+        arrays = {
+            "chr_ids": np.array(columns["chr_ids"], dtype=np.str_),
+            "chrA": np.array(columns["chrA"], dtype=np.str_),
+        }
+        if len(columns["chr_ids"]) < np.iinfo(np.int16).max:
+            arrays["chrB"] = columns["chrB"].astype(np.int16)
+        else:
+            arrays["chrB"] = columns["chrB"].astype(np.int32)
+        for key in ["startA", "startB", "value", "pos_x", "pos_y"]:
+            arrays[key] = _downcast(columns[key])
+
+        frame = io.BytesIO()
+        if compressed:
+            np.savez_compressed(frame, **arrays)
+        else:
+            np.savez(frame, **arrays)
+        return frame.getvalue()
+
+    @staticmethod
+    def columns_from_npz(frame):
+        """
+        Load the columns from a frame created by `columns_to_npz`
+
+        Parameters
+        ----------
+        frame : bytes
+
+        Returns
+        -------
+        dict
+            The `columnar` results of `get_range`
+        """
+        with np.load(io.BytesIO(frame), allow_pickle=False) as data:
+            columns = dict([(key, data[key]) for key in data.files])
+        columns["chr_ids"] = columns["chr_ids"].tolist()
+        columns["chrA"] = str(columns["chrA"])
+        return columns
+
+    def _range_columns(self, cells, x_pos, xy_offset, col_offset):
+        """
+        Coordinates and values of the non-zero cells in a slice of the
+        adjacency matrix, computed over the whole slice with numpy.
 
-            entry = {
+        Parameters
+        ----------
+        cells : tuple
+            (rows, cols, values) of the cells from `_read_block`
+        x_pos : int
+            First bin of the rows within the chromosome
+        xy_offset : int
+            First bin of the chromosome of the rows in the array
+        col_offset : int
+            Column of the array at the start of the slice
+
+        Returns
+        -------
+        dict
+            chr_ids : list
+                Chromosome ids that the chrB codes refer to
+            chrB : numpy.ndarray
+                Index into chr_ids of the chromosome of each cell, or -1 if
+                the bin is beyond the last chromosome
+            startA, startB, value, pos_x, pos_y : numpy.ndarray
+                As for the entries returned by `get_range`
+        """
+        rows, cols, values = cells
+        resolution = int(self.resolution)
+
+        y_index = cols + col_offset
+        chr_b = self.get_chromosomes_from_array_indexes(y_index, codes=True)
+
+        chr_starts = self.chr_offsets[resolution][0]
+        start_b = (y_index - np.where(chr_b >= 0, chr_starts[chr_b], 0)) * resolution
+
+        return {
+            "chr_ids": self.chr_ids,
+            "chrB": chr_b,
+            "startA": (rows + x_pos) * resolution,
+            "startB": start_b,
+            "value": values.astype(np.int64),
+            "pos_x": rows + (x_pos + xy_offset),
+            "pos_y": y_index
+        }
+
+    def _range_entries(self, chr_id, columns, value_url, no_links):
+        """
+        Convert the columns from `_range_columns` into the list of entries
+        returned by `get_range`
+        """
+        chr_names = columns["chr_ids"] + [None]
+        chr_b = [chr_names[code] for code in columns["chrB"].tolist()]
+        pos_x = columns["pos_x"].tolist()
+        pos_y = columns["pos_y"].tolist()
+
+        rows = zip(
+            columns["startA"].tolist(), chr_b, columns["startB"].tolist(),
+            columns["value"].tolist(), pos_x, pos_y)
+
+        if no_links is not None:
+            return [
+                {
+                    "chrA": chr_id,
+                    "startA": start_a,
+                    "chrB": y_chr,
+                    "startB": start_b,
+                    "value": value,
+                    "pos_x": x,
+                    "pos_y": y
+                }
+                for start_a, y_chr, start_b, value, x, y in rows
+            ]
+
+        url = "{url_root}?file_id={fid}&res={res}&pos_x=%d&pos_y=%d".format(
+            url_root=value_url.replace("%", "%%"), fid=str(self.file_id).replace("%", "%%"),
+            res=str(self.resolution))
+        results = [
+            {
                 "chrA": chr_id,
-                "startA": x_start,
+                "startA": start_a,
                 "chrB": y_chr,
-                "startB": y_start,
-                "value": int(result[i[0], i[1]]),
-                "pos_x": i[0] + x_pos + xy_offset,
-                "pos_y": i[1]
+                "startB": start_b,
+                "value": value,
+                "pos_x": x,
+                "pos_y": y,
+                "_links": {"self": url % (x, y)}
             }
-            if no_links is None:
-                url = "{url_root}?file_id={fid}&res={res}&pos_x={x}&pos_y={y}"
-                entry['_links'] = {
-                    'self': url.format(
-                        url_root=value_url, fid=str(self.file_id), res=str(self.resolution),
-                        x=str(i[0] + x_pos + xy_offset), y=str(i[1])
-                    )
-                }
-            results.append(entry)
-
-        return {"log": log_text, "results": results}
+            for start_a, y_chr, start_b, value, x, y in rows
+        ]
+        return results
 
     def get_value(self, bin_i, bin_j):
         """
@@ -339,7 +681,10 @@ class adjacency(object):  # pylint: disable=invalid-name
            value = r.get_value(2000000, 1000000)
 
         """
-        value = self.dset[int(bin_i), int(bin_j)]
+        bin_i, bin_j = int(bin_i), int(bin_j)
+        if self.symmetric and bin_i > bin_j:
+            bin_i, bin_j = bin_j, bin_i
+        value = self.dset[bin_i, bin_j]
         return value
 
     def _calculate_chr_param(self, bin_sizes, chromosomes):
@@ -395,10 +740,79 @@ class adjacency(object):  # pylint: disable=invalid-name
 
         return chr_param
 
+    @staticmethod
+    def _calculate_chr_offsets(chr_param, bin_sizes):
+        """
+        Sorted arrays of the first and last bin of each chromosome for each
+        resolution, so that bins can be resolved to chromosomes with a binary
+        search.
+
+        Returns
+        -------
+        tuple
+            (list of the chromosome ids in array order, dict of resolution to
+            (numpy array of start bins, numpy array of end bins))
+        """
+        chr_ids = [chr_id for chr_id in chr_param if chr_id != "meta"]
+
+        chr_offsets = {}
+        for bin_size in bin_sizes:
+            bins = [chr_param[chr_id]["bins"][bin_size] for chr_id in chr_ids]
+            chr_offsets[int(bin_size)] = (
+                np.array([chr_bins[1] for chr_bins in bins], dtype=np.int64),
+                np.array([chr_bins[2] for chr_bins in bins], dtype=np.int64)
+            )
+
+        return (chr_ids, chr_offsets)
+
+    def get_chromosomes_from_array_indexes(self, indexes, codes=False):
+        """
+        Identify the chromosomes for an array of x or y coordinates in the
+        array in a single call.
+
+        Parameters
+        ----------
+        indexes : list or numpy.ndarray
+            Locations within the array
+        codes : bool (Optional)
+            Return the position of each chromosome in `chr_ids` rather than
+            its identity, with -1 for locations outside of the chromosomes
+
+        Returns
+        -------
+        numpy.ndarray
+            Identity of the chromosome for each location, or None if the
+            location is outside of the chromosomes
+
+        Example
+        -------
+
+        .. code-block:: python
+           :linenos:
+
+           from reader import adjacency
+           r = adjacency('test', '', 10000)
+           cids = r.get_chromosomes_from_array_indexes([0, 3200, 7000])
+
+        """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        chr_starts, chr_ends = self.chr_offsets[int(self.resolution)]
+
+        # Each chromosome covers the bins from its start up to, but not
+        # including, its end bin, which is the start bin of the next
+        chr_codes = np.searchsorted(chr_starts, indexes, side="right") - 1
+        outside = (chr_codes < 0) | (indexes >= chr_ends[np.maximum(chr_codes, 0)])
+        chr_codes[outside] = -1
+
+        if codes is True:
+            return chr_codes
+        return np.array(self.chr_ids + [None], dtype=object)[chr_codes]
+
     def get_chromosome_from_array_index(self, index):
         """
         Identify the chromosome based on either the x or y coordinate in the
-        array.
+        array. Use `get_chromosomes_from_array_indexes` to identify the
+        chromosomes for many locations at once.
 
         Parameters
         ----------
@@ -421,11 +835,4 @@ class adjacency(object):  # pylint: disable=invalid-name
            cid = r.get_chromosome_from_array_index(1234567890)
 
         """
-        for chr_id in self.chr_param.keys():
-            if chr_id == "meta":
-                continue
-            # print(self.chr_param[chr_id]["bins"], type(self.chr_param[chr_id]["bins"]))
-            chr_end = self.chr_param[chr_id]["bins"][int(self.resolution)][2]
-            chr_start = self.chr_param[chr_id]["bins"][int(self.resolution)][1]
-            if index >= chr_start and index <= chr_end:
-                return chr_id
+        return self.get_chromosomes_from_array_indexes([index])[0]
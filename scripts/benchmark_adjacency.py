@@ -0,0 +1,274 @@
+#!/usr/bin/python
+
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Benchmark for adjacency.get_range on the generated sample_adjacency.hdf5
+against the previous implementation that looped over each non-zero cell, and
+of the chromosome lookup for the bins of an assembly with many scaffolds. The
+sizes of the serialised results are compared for each of the output formats,
+and the queries are repeated on a copy of the matrix in the sparse layout.
+Run it as a module from the root of the repository so that the `reader` and
+`dm_generator` packages can be imported:
+
+.. code-block:: none
+   :linenos:
+
+   python -m scripts.benchmark_adjacency --chr chr1 --start 0 --end 4000000
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import h5py
+import numpy as np
+
+from dm_generator.GenerateSampleAdjacency import GenerateSampleAdjacency
+from reader.hdf5_adjacency import adjacency
+
+
+def legacy_chromosome_from_array_index(reader, index):
+    """
+    Copy of get_chromosome_from_array_index before it used a binary search,
+    with the end bin of each chromosome excluded as in the current version
+    """
+    for chr_id in reader.chr_param.keys():
+        if chr_id == "meta":
+            continue
+        chr_end = reader.chr_param[chr_id]["bins"][int(reader.resolution)][2]
+        chr_start = reader.chr_param[chr_id]["bins"][int(reader.resolution)][1]
+        if index >= chr_start and index < chr_end:
+            return chr_id
+    return None
+
+
+def legacy_get_range(  # pylint: disable=too-many-arguments,too-many-locals
+        reader, chr_id, start, end, limit_chr=None, limit_start=None, limit_end=None,
+        value_url='/api/getValue', no_links=None):
+    """
+    Copy of the results loop of get_range before it was vectorised. The
+    chromosome and position of the columns are taken from their position in
+    the whole array, as in the current version.
+    """
+    x_pos = int(np.floor(float(start) / float(reader.resolution)))
+    y_pos = int(np.ceil(float(end) / float(reader.resolution)))
+    xy_offset = reader.chr_param[chr_id]["bins"][reader.resolution][1]
+    dset = reader.hdf5_handle[str(reader.resolution)]
+
+    col_offset = 0
+    if limit_chr is not None:
+        if limit_start is not None and limit_end is not None:
+            start2 = int(np.floor(float(limit_start) / float(reader.resolution)))
+            end2 = int(np.ceil(float(limit_end) / float(reader.resolution)))
+            xy2_offset = reader.chr_param[limit_chr]["bins"][reader.resolution][1]
+            col_offset = start2 + xy2_offset
+            result = dset[
+                (x_pos + xy_offset):(y_pos + xy_offset),
+                (start2 + xy2_offset):(end2 + xy2_offset)
+            ]
+        else:
+            start2 = reader.chr_param[limit_chr]["bins"][reader.resolution][1]
+            end2 = start2 + reader.chr_param[limit_chr]["bins"][reader.resolution][0]
+            col_offset = start2
+            result = dset[(x_pos + xy_offset):(y_pos + xy_offset), start2:end2]
+    else:
+        result = dset[(x_pos + xy_offset):(y_pos + xy_offset), :]
+
+    results = []
+    r_index = np.transpose(np.nonzero(result))
+    for i in r_index:
+        x_start = ((i[0] + x_pos) * int(reader.resolution))
+        y_index = i[1] + col_offset
+        y_chr = legacy_chromosome_from_array_index(reader, y_index)
+        y_start = (
+            y_index - reader.chr_param[y_chr]["bins"][reader.resolution][1]
+        ) * int(reader.resolution)
+
+        entry = {
+            "chrA": chr_id,
+            "startA": x_start,
+            "chrB": y_chr,
+            "startB": y_start,
+            "value": int(result[i[0], i[1]]),
+            "pos_x": i[0] + x_pos + xy_offset,
+            "pos_y": y_index
+        }
+        if no_links is None:
+            url = "{url_root}?file_id={fid}&res={res}&pos_x={x}&pos_y={y}"
+            entry['_links'] = {
+                'self': url.format(
+                    url_root=value_url, fid=str(reader.file_id), res=str(reader.resolution),
+                    x=str(i[0] + x_pos + xy_offset), y=str(y_index)
+                )
+            }
+        results.append(entry)
+
+    return {"results": results}
+
+
+def best_of(func, repeat):
+    """
+    Shortest wall time of `repeat` calls, and the result of the last call
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.time()
+        result = func()
+        timings.append(time.time() - start)
+    return min(timings), result
+
+
+def sparse_copy(reader, filename):
+    """
+    Reader for a copy of the current resolution in the sparse layout
+    """
+    matrix = reader.hdf5_handle[str(reader.resolution)]
+    with h5py.File(filename, "w") as hdf5_handle:
+        values = matrix[:]
+        bin1, bin2 = np.nonzero(values)
+        GenerateSampleAdjacency.create_sparse_dataset(
+            hdf5_handle, str(reader.resolution), bin1, bin2, values[bin1, bin2],
+            values.shape[0], matrix.attrs["chromosomes"])
+
+    sparse = adjacency('test', '', reader.resolution)
+    sparse.hdf5_handle.close()
+    sparse.hdf5_handle = h5py.File(filename, "r")
+    sparse.set_resolution(reader.resolution)
+    return sparse
+
+
+def main():  # pylint: disable=too-many-locals,too-many-statements
+    """
+    Time both implementations for a set of windows and check that they return
+    the same results
+    """
+    parser = argparse.ArgumentParser(description="Benchmark adjacency.get_range")
+    parser.add_argument("--resolution", type=int, default=10000)
+    parser.add_argument("--chr", default="chr1", help="Chromosome of the row band")
+    parser.add_argument("--start", type=int, default=0)
+    parser.add_argument("--end", type=int, default=2000000)
+    parser.add_argument("--limit-chr", default="chr2", help="Chromosome for the limited query")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timings")
+    parser.add_argument(
+        "--scaffolds", type=int, default=2000, help="Scaffolds for the lookup benchmark")
+    args = parser.parse_args()
+
+    reader = adjacency('test', '', args.resolution)
+
+    queries = [
+        ("genome wide", {}),
+        ("genome wide, no links", {"no_links": 1}),
+        ("limit_chr", {"limit_chr": args.limit_chr}),
+        ("limit_chr window", {
+            "limit_chr": args.limit_chr, "limit_start": args.start, "limit_end": args.end}),
+    ]
+
+    print("{0:<24} {1:>10} {2:>12} {3:>12} {4:>8}".format(
+        "query", "cells", "legacy (s)", "numpy (s)", "speedup"))
+    for name, kwargs in queries:
+        legacy_time, legacy = best_of(
+            lambda: legacy_get_range(reader, args.chr, args.start, args.end, **kwargs),
+            args.repeat)
+        new_time, new = best_of(
+            lambda: reader.get_range(args.chr, args.start, args.end, **kwargs), args.repeat)
+
+        assert new["results"] == legacy["results"], "Results differ for " + name
+        print("{0:<24} {1:>10} {2:>12.3f} {3:>12.3f} {4:>7.1f}x".format(
+            name, len(new["results"]), legacy_time, new_time, legacy_time / new_time))
+
+    # Size and time of each output format for the genome wide query
+    print("")
+    print("{0:<26} {1:>10} {2:>12} {3:>12}".format("output", "cells", "time (s)", "bytes"))
+    for name, kwargs in [
+            ("entries as JSON", {}),
+            ("entries as JSON, no links", {"no_links": 1}),
+            ("columnar", {"output": "columnar"}),
+            ("npz", {"output": "npz"})]:
+        new_time, new = best_of(
+            lambda: reader.get_range(args.chr, args.start, args.end, **kwargs), args.repeat)
+        if "output" not in kwargs:
+            size = len(json.dumps(new["results"]))
+            cells = len(new["results"])
+        elif kwargs["output"] == "npz":
+            size = len(new["results"])
+            cells = len(adjacency.columns_from_npz(new["results"])["value"])
+        else:
+            size = sum(
+                column.nbytes for column in new["results"].values()
+                if isinstance(column, np.ndarray))
+            cells = len(new["results"]["value"])
+        print("{0:<26} {1:>10} {2:>12.3f} {3:>12}".format(name, cells, new_time, size))
+
+    # The same queries on a copy of the matrix in the sparse layout
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        sparse = sparse_copy(reader, os.path.join(tmp_dir, "sparse_adjacency.hdf5"))
+        print("")
+        print("{0:<24} {1:>10} {2:>12} {3:>12} {4:>8}".format(
+            "layout", "cells", "dense (s)", "sparse (s)", "ratio"))
+        for name, kwargs in queries:
+            dense_time, dense = best_of(
+                lambda: reader.get_range(args.chr, args.start, args.end, **kwargs),
+                args.repeat)
+            sparse_time, result = best_of(
+                lambda: sparse.get_range(args.chr, args.start, args.end, **kwargs),
+                args.repeat)
+            assert result["results"] == dense["results"], "Sparse results differ for " + name
+            print("{0:<24} {1:>10} {2:>12.3f} {3:>12.3f} {4:>7.1f}x".format(
+                name, len(result["results"]), dense_time, sparse_time,
+                dense_time / sparse_time))
+
+        dset = reader.hdf5_handle[str(reader.resolution)]
+        dense_bytes = dset.id.get_storage_size()
+        sparse_bytes = sum(
+            sparse.dset.group[name].id.get_storage_size() for name in sparse.dset.group)
+        print("{0:<24} {1:>10} {2:>12} {3:>12}".format(
+            "storage (bytes)", "", dense_bytes, sparse_bytes))
+        sparse.close()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    # Assembly with many scaffolds, resolved one bin at a time and in a
+    # single batch
+    resolution = 1000
+    chromosomes = [
+        [("scaffold_" + str(i)).encode(), 20000 + 997 * (i % 50)] for i in range(args.scaffolds)]
+    reader.resolution = resolution
+    reader.chr_param = reader._calculate_chr_param(  # pylint: disable=protected-access
+        [resolution], chromosomes)
+    reader.chr_ids, reader.chr_offsets = reader._calculate_chr_offsets(  # pylint: disable=protected-access
+        reader.chr_param, [resolution])
+    bins = np.arange(0, reader.chr_param["meta"]["totalBinCount"][resolution][1], 7)
+
+    legacy_time, legacy = best_of(
+        lambda: [legacy_chromosome_from_array_index(reader, i) for i in bins.tolist()], 1)
+    new_time, new = best_of(lambda: reader.get_chromosomes_from_array_indexes(bins), args.repeat)
+    assert new.tolist() == legacy, "Chromosome lookups differ"
+    print("{0:<24} {1:>10} {2:>12.3f} {3:>12.3f} {4:>7.1f}x".format(
+        str(args.scaffolds) + " scaffold lookup", len(bins), legacy_time, new_time,
+        legacy_time / new_time))
+
+    reader.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Benchmark suite for the DMP catalogue.
+
+A catalogue of N users with M files each is generated, in the same shapes as
+``dmp._test_loading_dataset``. Each file is the root or a derived file of a
+lineage chain (fastq -> bam -> bed -> ...). The suite then times:
+
+- single inserts with `set_file`
+- bulk loading with `set_files`
+- each of the `get_file*` lookups
+- `get_file_history` for chains of increasing depth
+- the meta data edits
+
+The results are written as JSON so that runs can be compared across commits
+and backends. Run it as a module from the root of the repository so that the
+`dmp` package can be imported:
+
+.. code-block:: none
+   :linenos:
+
+   python -m scripts.benchmark_catalog --backend memory --users 10 --files 1000 \\
+       --output memory.json
+   python -m scripts.benchmark_catalog --backend mongomock --output mongomock.json \\
+       --compare memory.json
+   python -m scripts.benchmark_catalog --config dmp.cnf --output mongod.json
+
+With ``--config`` the backend is the one set in the configuration file, eg a
+local mongod. The users created by the run are removed afterwards.
+"""
+
+from __future__ import print_function
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+
+from bson.objectid import ObjectId
+
+from dmp import dmp
+
+# Order of the file types along a lineage chain, with the tool that
+# generated each from the previous file
+CHAIN = [
+    ("fastq", None), ("bam", "bwa_aligner"), ("bed", "macs2"), ("bb", "bedToBigBed"),
+    ("wig", "bam2wig"), ("bw", "wigToBigWig"), ("tsv", "summary"), ("gz", "gzip"),
+]
+DATA_TYPES = ['RNA-seq', 'MNase-Seq', 'ChIP-seq', 'WGBS', 'HiC']
+TAXON_IDS = [9606, 10090, 7227]
+ASSEMBLIES = ['GCA_0123456789', 'GCA_000001405.22', 'GCA_000001635.7']
+
+
+def _record(user_id, index, position, source_id, data_type, taxon_id, assembly):
+    """
+    A set_file record for the file at a position in a lineage chain
+    """
+    file_type, tool = CHAIN[position % len(CHAIN)]
+    meta_data = {"assembly": assembly}
+    if tool is not None:
+        meta_data["tool"] = tool
+    return {
+        "_id": ObjectId(),
+        "user_id": user_id,
+        "file_path": "/tmp/bench/" + user_id + "/" + data_type + "/file_" + str(index) +
+                     "." + file_type,
+        "path_type": "file",
+        "file_type": file_type,
+        "size": random.randint(1000, 10000000),
+        "data_type": data_type,
+        "taxon_id": taxon_id,
+        "compressed": random.choice([None, 'gzip', 'zip']),
+        "source_id": source_id,
+        "meta_data": meta_data
+    }
+
+
+def make_chain(user_id, start, length):
+    """
+    Generate the records for a lineage chain of files
+
+    Parameters
+    ----------
+    user_id : str
+    start : int
+        Number of the first file, used in the file paths
+    length : int
+        Number of files in the chain
+
+    Returns
+    -------
+    list
+        Records in the order that they need to be loaded
+    """
+    data_type = random.choice(DATA_TYPES)
+    taxon_id = random.choice(TAXON_IDS)
+    assembly = random.choice(ASSEMBLIES)
+
+    records = []
+    source_id = None
+    for position in range(length):
+        record = _record(
+            user_id, start + position, position, source_id, data_type, taxon_id, assembly)
+        records.append(record)
+        source_id = [record["_id"]]
+    return records
+
+
+def make_catalog(users, files, chain_length):
+    """
+    Generate the records for a catalogue of `users` x `files`
+    """
+    records = []
+    for user_id in users:
+        index = 0
+        while index < files:
+            length = min(chain_length, files - index)
+            records += make_chain(user_id, index, length)
+            index += length
+    return records
+
+
+def summarise(timings):
+    """
+    Statistics for a list of timings in seconds
+    """
+    timings = sorted(timings)
+    count = len(timings)
+    return {
+        "n": count,
+        "total_s": sum(timings),
+        "mean_ms": 1000.0 * sum(timings) / count,
+        "median_ms": 1000.0 * timings[count // 2],
+        "p95_ms": 1000.0 * timings[min(count - 1, int(count * 0.95))],
+        "min_ms": 1000.0 * timings[0],
+        "max_ms": 1000.0 * timings[-1],
+    }
+
+
+def timed(func, calls):
+    """
+    Time each call of a function
+
+    Parameters
+    ----------
+    func : function
+        Called with each of the items in `calls` as its arguments
+    calls : list
+        List of argument tuples
+    """
+    timings = []
+    for args in calls:
+        start = time.time()
+        func(*args)
+        timings.append(time.time() - start)
+    return summarise(timings)
+
+
+def git_commit():
+    """
+    Current commit of the repository, if it can be found
+    """
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(dm_handle, args):  # pylint: disable=too-many-locals
+    """
+    Run each of the benchmarks
+
+    Returns
+    -------
+    dict
+        Summary of the timings for each benchmark
+    """
+    run_id = str(ObjectId())[-8:]
+    users = ["bench_" + run_id + "_" + str(i) for i in range(args.users)]
+    results = {}
+
+    records = make_catalog(users, args.files, args.chain_length)
+
+    start = time.time()
+    load = dm_handle.set_files(records, batch_size=args.batch_size)
+    elapsed = time.time() - start
+    if load["errors"]:
+        raise RuntimeError("Failed to load the catalogue: " + str(load["errors"][:5]))
+    results["set_files"] = {
+        "n": len(records), "total_s": elapsed,
+        "files_per_s": len(records) / elapsed if elapsed else None
+    }
+
+    singles = make_catalog([users[0]], args.samples, args.chain_length)
+    results["set_file"] = timed(
+        lambda record: dm_handle.set_file(**record), [(record,) for record in singles])
+
+    sample = random.sample(records, min(args.samples, len(records)))
+    lookups = [
+        ("get_file_by_id", dm_handle.get_file_by_id, "_id"),
+        ("get_file_by_file_path", dm_handle.get_file_by_file_path, "file_path"),
+        ("get_files_by_file_type", dm_handle.get_files_by_file_type, "file_type"),
+        ("get_files_by_data_type", dm_handle.get_files_by_data_type, "data_type"),
+        ("get_files_by_taxon_id", dm_handle.get_files_by_taxon_id, "taxon_id"),
+    ]
+    for name, func, field in lookups:
+        results[name] = timed(
+            func, [(record["user_id"], str(record[field])) for record in sample])
+    results["get_files_by_assembly"] = timed(
+        dm_handle.get_files_by_assembly,
+        [(record["user_id"], record["meta_data"]["assembly"]) for record in sample])
+    results["get_files_by_user"] = timed(
+        dm_handle.get_files_by_user, [(user_id,) for user_id in users] * args.repeat)
+    results["get_files_by_user_page"] = timed(
+        lambda user_id: dm_handle.get_files_by_user(user_id, limit=100),
+        [(user_id,) for user_id in users] * args.repeat)
+
+    history_user = "bench_" + run_id + "_history"
+    users.append(history_user)
+    for depth in args.depths:
+        chain = make_chain(history_user, depth * 1000, depth + 1)
+        dm_handle.set_files(chain)
+        results["get_file_history_depth_" + str(depth)] = timed(
+            dm_handle.get_file_history, [(history_user, str(chain[-1]["_id"]))] * args.repeat)
+
+    edits = [(record["user_id"], str(record["_id"])) for record in sample]
+    results["add_file_metadata"] = timed(
+        lambda user_id, file_id: dm_handle.add_file_metadata(
+            user_id, file_id, "benchmark", run_id), edits)
+    results["remove_file_metadata"] = timed(
+        lambda user_id, file_id: dm_handle.remove_file_metadata(
+            user_id, file_id, "benchmark"), edits)
+    results["modify_column"] = timed(
+        lambda user_id, file_id: dm_handle.modify_column(
+            user_id, file_id, "data_type", "WGBS"), edits)
+
+    start = time.time()
+    dm_handle.bulk_update_metadata([
+        {"user_id": user_id, "file_id": file_id, "key": "benchmark", "value": run_id}
+        for user_id, file_id in edits
+    ])
+    results["bulk_update_metadata"] = {"n": len(edits), "total_s": time.time() - start}
+
+    if args.config:
+        dm_handle.db_handle.entries.delete_many({"user_id": {"$in": users}})
+        dm_handle.rebuild_usage(users)
+
+    return results
+
+
+def compare(results, baseline):
+    """
+    Print the change in the mean time of each benchmark against a previous
+    run
+    """
+    print("{0:<32} {1:>12} {2:>12} {3:>8}".format("benchmark", "baseline", "current", "ratio"))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        key = "mean_ms" if "mean_ms" in results[name] else "total_s"
+        old = baseline[name].get(key)
+        new = results[name].get(key)
+        if old is None or new is None:
+            continue
+        print("{0:<32} {1:>12.3f} {2:>12.3f} {3:>8.2f}".format(
+            name, old, new, new / old if old else float("nan")))
+
+
+def main():
+    """
+    Command line entry point
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the DMP catalogue")
+    parser.add_argument(
+        "--backend", default="memory",
+        help="Test backend to use when no --config is given (memory or mongomock)")
+    parser.add_argument("--config", help="dmp.cnf for the backend to benchmark")
+    parser.add_argument("--users", type=int, default=10, help="Number of users")
+    parser.add_argument("--files", type=int, default=1000, help="Number of files per user")
+    parser.add_argument("--chain-length", type=int, default=4, help="Files per lineage chain")
+    parser.add_argument(
+        "--depths", default="1,2,4,8,16,32",
+        help="Comma separated lineage depths for get_file_history")
+    parser.add_argument(
+        "--samples", type=int, default=200, help="Number of files to time each lookup on")
+    parser.add_argument("--repeat", type=int, default=5, help="Repeats of the listings")
+    parser.add_argument("--batch-size", type=int, default=1000, help="set_files batch size")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--output", help="File to write the JSON results to")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    args = parser.parse_args()
+    args.depths = [int(depth) for depth in args.depths.split(",")]
+
+    random.seed(args.seed)
+
+    if args.config:
+        dm_handle = dmp(args.config)
+        backend = "config:" + os.path.basename(args.config)
+    else:
+        dm_handle = dmp(test=True, backend=args.backend, sample_data=False)
+        backend = args.backend
+
+    output = {
+        "meta": {
+            "backend": backend,
+            "users": args.users,
+            "files": args.files,
+            "chain_length": args.chain_length,
+            "samples": args.samples,
+            "seed": args.seed,
+            "commit": git_commit(),
+            "python": platform.python_version(),
+            "timestamp": datetime.datetime.utcnow().isoformat()
+        },
+        "results": run(dm_handle, args)
+    }
+
+    if args.output:
+        with open(args.output, "w") as f_out:
+            json.dump(output, f_out, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(output, indent=2, sort_keys=True))
+
+    if args.compare:
+        with open(args.compare) as f_in:
+            compare(output["results"], json.load(f_in)["results"])
+
+
+if __name__ == "__main__":
+    main()
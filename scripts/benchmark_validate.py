@@ -0,0 +1,122 @@
+#!/usr/bin/python
+
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+
+Micro-benchmark for dmp.validate_file against the previous implementation
+that rebuilt the table of file types on every call. Run it as a module from
+the root of the repository so that the `dmp` package can be imported:
+
+.. code-block:: none
+   :linenos:
+
+   python -m scripts.benchmark_validate --number 100000
+"""
+
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from dmp import dmp
+
+
+def legacy_validate_file(entry):
+    """
+    Copy of validate_file before the rule table was moved to the module
+    """
+    if 'user_id' not in entry or entry['user_id'] is None or entry['user_id'] == '':
+        raise ValueError('User ID must be specified for all entries')
+
+    if 'file_path' not in entry or entry['file_path'] is None or entry['file_path'] == '':
+        raise ValueError('User ID must be specified for all entries')
+
+    if entry['path_type'] not in ['file', 'dir', 'link']:
+        raise ValueError('Path type must be of value file|dir|link')
+
+    file_types = {
+        "amb": ["assembly"], "ann": ["assembly"], "bam": ["assembly"],
+        "bb": ["assembly"], "bed": ["assembly"], "bt2": ["assembly"],
+        "bw": ["assembly"], "bwt": ["assembly"], "cpt": [], "csv": [], "dcd": [],
+        "fa": [], "fasta": ["assembly"], "fastq": [], "gem": ["assembly"],
+        "gff3": ["assembly"], "gz": [], "hdf5": ["assembly"], "json": [],
+        'lif': [], "pac": ["assembly"], "pdb": [], "pdf": [], "png": [],
+        "prmtop": [], "sa": ["assembly"], "tbi": ["assembly"], "tif": [],
+        "tpr": [], "trj": [], "tsv": [], "txt": [], "wig": ["assembly"]
+    }
+
+    if (
+            'file_type' not in entry or
+            entry['file_type'] == "" or
+            entry['file_type'] not in file_types
+    ):
+        raise ValueError(
+            "File type must be one of the valid file types: " + ','.join(file_types)
+        )
+
+    if isinstance(entry['size'], int) is False:
+        raise TypeError('Size must be an integer')
+
+    if 'taxon_id' not in entry or entry['taxon_id'] is None:
+        raise ValueError('Taxon ID must be specified for all entries')
+
+    ft_assembly_required = [k for k in file_types if "assembly" in file_types[k]]
+    if str.lower(str(entry['file_type'])) in ft_assembly_required:
+        if 'assembly' not in entry['meta_data']:
+            raise ValueError('Matching assembly ID is required within the meta_data field')
+
+    if 'source_id' in entry and entry['source_id'] is not None:
+        if 'tool' not in entry['meta_data']:
+            raise ValueError('Matching Tool name is required within the meta_data field')
+
+    return True
+
+
+ENTRY = {
+    "user_id": "test", "file_path": "/tmp/sample.bam", "path_type": "file",
+    "file_type": "bam", "size": 64000, "data_type": "RNA-seq", "taxon_id": 9606,
+    "source_id": ["5a0c1e7a4e4c2c3b5c000000"],
+    "meta_data": {"assembly": "GCA_000001405.22", "tool": "bwa_aligner"}
+}
+
+
+def main():
+    """
+    Time each of the implementations on a valid entry
+    """
+    parser = argparse.ArgumentParser(description="Benchmark dmp.validate_file")
+    parser.add_argument("--number", type=int, default=100000, help="Calls per timing")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timings")
+    args = parser.parse_args()
+
+    records = [ENTRY] * args.number
+    timings = [
+        ("legacy validate_file", lambda: legacy_validate_file(ENTRY), args.number),
+        ("validate_file", lambda: dmp.validate_file(ENTRY), args.number),
+        ("validate_files", lambda: dmp.validate_files(records), 1),
+    ]
+
+    results = {}
+    for name, func, number in timings:
+        best = min(timeit.repeat(func, number=number, repeat=args.repeat))
+        results[name] = best
+        print("{0:<22} {1:8.3f} us/entry".format(name, best * 1e6 / args.number))
+
+    print("Speedup: {0:.2f}x".format(results["legacy validate_file"] / results["validate_file"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -45,4 +45,9 @@ setup(
     tests_require=[
         'pytest',
     ],
+
+    extras_require={
+        # Required by dmp.async_dmp when connecting to a server
+        'async': ['motor>=2.0'],
+    },
 )
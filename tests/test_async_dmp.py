@@ -0,0 +1,112 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import asyncio
+
+import pytest
+
+from dmp.async_dmp import async_dmp
+
+
+def _run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+def test_async_lookups():
+    """
+    Test that the async getters match the sample data set
+    """
+    async def lookups(dm_handle):
+        files = await dm_handle.get_files_by_user("adam")
+        bams = await dm_handle.get_files_by_file_type("adam", "bam")
+        first = await dm_handle.get_file_by_id("adam", files[0]["_id"])
+        page = await dm_handle.get_files_by_user("adam", limit=2)
+        streamed = [
+            file_obj["_id"] async for file_obj in dm_handle.iter_files("adam", batch_size=2)
+        ]
+        missing = await dm_handle.get_files_by_taxon_id("adam", 1)
+        return files, bams, first, page, streamed, missing
+
+    dm_handle = async_dmp(test=True)
+    files, bams, first, page, streamed, missing = _run(lookups(dm_handle))
+
+    assert isinstance(files, list) is True
+    assert all([file_obj["file_type"] == "bam" for file_obj in bams])
+    assert first["_id"] == files[0]["_id"]
+    assert len(page) == 2
+    assert sorted(streamed) == sorted([file_obj["_id"] for file_obj in files])
+    assert missing == {"msg": "No files found"}
+
+
+def test_async_set_file_history():
+    """
+    Test loading a chain of files and retrieving their history
+    """
+    async def load(dm_handle):
+        user = "async"
+        fastq = await dm_handle.set_file(
+            user, '/tmp/async/1.fastq', 'file', 'fastq', 64000, None, 'RNA-seq', 9606)
+        bam = await dm_handle.set_file(
+            user, '/tmp/async/1.bam', 'file', 'bam', 64000, None, 'RNA-seq', 9606,
+            source_id=[fastq], meta_data={'assembly': 'GCA_0123456789', 'tool': 'bwa'})
+        bed = await dm_handle.set_file(
+            user, '/tmp/async/1.bed', 'file', 'bed', 64000, None, 'RNA-seq', 9606,
+            source_id=[bam], meta_data={'assembly': 'GCA_0123456789', 'tool': 'macs2'})
+        history = await dm_handle.get_file_history(user, bed)
+        return (fastq, bam, bed), history
+
+    dm_handle = async_dmp(test=True)
+    (fastq, bam, bed), history = _run(load(dm_handle))
+    assert sorted(history) == sorted([[bed, bam], [bam, fastq]])
+
+    with pytest.raises(ValueError):
+        _run(dm_handle.set_file(
+            "async", '/tmp/async/2.bam', 'file', 'bam', 64000, None, 'RNA-seq', 9606))
+
+
+def test_async_metadata():
+    """
+    Test the meta data edits, including the rollback of an invalid change
+    """
+    user = "test"
+    file_id = "0123456789ab0123456789aa"
+
+    async def edit(dm_handle):
+        await dm_handle.add_file_metadata(user, file_id, 'test', 'An example string')
+        added = await dm_handle.get_file_by_id(user, file_id)
+        await dm_handle.remove_file_metadata(user, file_id, 'test')
+        removed = await dm_handle.get_file_by_id(user, file_id)
+        await dm_handle.modify_column(user, file_id, 'data_type', 'ChIP-seq')
+        modified = await dm_handle.get_file_by_id(user, file_id)
+        return added, removed, modified
+
+    dm_handle = async_dmp(test=True, cache_size=10)
+    added, removed, modified = _run(edit(dm_handle))
+    assert added['meta_data']['test'] == 'An example string'
+    assert 'test' not in removed['meta_data']
+    assert modified['data_type'] == 'ChIP-seq'
+
+    with pytest.raises(ValueError):
+        _run(dm_handle.remove_file_metadata(user, file_id, 'assembly'))
+    result = _run(dm_handle.get_file_by_id(user, file_id))
+    assert result['meta_data']['assembly'] == 'GCA_0123456789'
@@ -0,0 +1,260 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import time
+
+from bson.objectid import ObjectId
+from pymongo.errors import AutoReconnect
+
+from dmp import dmp
+from dmp.cache import file_cache
+
+
+def test_file_cache():
+    """
+    Test the LRU eviction, expiry and invalidation of cached records
+    """
+    cache = file_cache(max_size=2, ttl=60)
+
+    cache.set("adam", "a", {"file_path": "/tmp/a"})
+    cache.set("adam", "b", {"file_path": "/tmp/b"})
+    assert cache.get("adam", "a") == {"file_path": "/tmp/a"}
+
+    # "b" is now the least recently used
+    cache.set("adam", "c", {"file_path": "/tmp/c"})
+    assert cache.get("adam", "b") is None
+    assert cache.get("adam", "c") == {"file_path": "/tmp/c"}
+
+    cache.invalidate("c")
+    assert cache.get("adam", "c") is None
+
+    cache._handle_change({  # pylint: disable=protected-access
+        "operationType": "delete", "documentKey": {"_id": "a"}})
+    assert cache.get("adam", "a") is None
+
+    cache.ttl = -1
+    cache.set("adam", "d", {"file_path": "/tmp/d"})
+    assert cache.get("adam", "d") is None
+
+    stats = cache.get_stats()
+    assert stats["hits"] == 2
+    assert stats["misses"] == 4
+    assert stats["evictions"] == 1
+    assert stats["expirations"] == 1
+    assert stats["invalidations"] == 2
+    assert stats["size"] == 0
+
+
+def test_file_cache_generation():
+    """
+    Test that a record is not cached if the file was invalidated after it was
+    read from the database
+    """
+    cache = file_cache(max_size=2, ttl=60)
+
+    generation = cache.generation("a")
+    cache.invalidate("a")
+    cache.set("adam", "a", {"file_path": "/tmp/old"}, generation=generation)
+    assert cache.get("adam", "a") is None
+
+    generation = cache.generation("a")
+    cache.invalidate("b")
+    cache.set("adam", "a", {"file_path": "/tmp/a"}, generation=generation)
+    assert cache.get("adam", "a") == {"file_path": "/tmp/a"}
+
+    # Files that are no longer tracked, or a cleared cache, also count as a
+    # change of generation
+    generation = cache.generation("a")
+    cache.invalidate("c")
+    cache.invalidate("d")
+    cache.set("eve", "a", {"file_path": "/tmp/a"}, generation=generation)
+    assert cache.get("eve", "a") is None
+
+    generation = cache.generation("e")
+    cache.clear()
+    cache.set("adam", "e", {"file_path": "/tmp/e"}, generation=generation)
+    assert cache.get("adam", "e") is None
+
+
+def test_get_file_by_id_cache():
+    """
+    Test that get_file_by_id is served from the cache until the file changes
+    """
+    user = "test"
+    file_id = str(ObjectId(str("0123456789ab0123456789aa")))
+
+    dm_handle = dmp(test=True, cache_size=10)
+
+    result = dm_handle.get_file_by_id(user, file_id)
+    result['file_path'] = 'modified by the caller'
+    assert dm_handle.get_file_by_id(user, file_id)['file_path'] != 'modified by the caller'
+
+    stats = dm_handle.get_cache_stats()
+    assert stats["misses"] == 1
+    assert stats["hits"] == 1
+
+    dm_handle.remove_file(user, file_id)
+    assert dm_handle.get_file_by_id(user, file_id) == {"msg": "No files found"}
+
+
+def test_get_file_by_id_cache_race():
+    """
+    Test that a record is not cached when the file is modified while it is
+    being read
+    """
+    user = "test"
+    file_id = str(ObjectId(str("0123456789ab0123456789aa")))
+
+    dm_handle = dmp(test=True, cache_size=10)
+    get_rows = dm_handle._get_rows  # pylint: disable=protected-access
+
+    def _get_rows(*args, **kwargs):
+        rows = get_rows(*args, **kwargs)
+        dm_handle.cache.invalidate(file_id)
+        return rows
+
+    dm_handle._get_rows = _get_rows  # pylint: disable=protected-access
+    dm_handle.get_file_by_id(user, file_id)
+    assert dm_handle.get_cache_stats()["size"] == 0
+
+
+def test_no_cache():
+    """
+    Test that the cache is disabled by default
+    """
+    dm_handle = dmp(test=True)
+    assert dm_handle.get_cache_stats() == {}
+
+
+class _stream(object):  # pylint: disable=invalid-name
+    """
+    Change stream that returns a list of changes and then either fails or
+    has no further changes
+    """
+
+    def __init__(self, changes, fail, max_await_time_ms):
+        self.changes = list(changes)
+        self.fail = fail
+        self.max_await_time_ms = max_await_time_ms
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.closed = True
+        return False
+
+    def try_next(self):
+        """
+        Next change, or None if there is none within max_await_time_ms
+        """
+        if self.changes:
+            return self.changes.pop(0)
+        if self.fail:
+            raise AutoReconnect("connection lost")
+        time.sleep(self.max_await_time_ms / 1000.0)
+        return None
+
+
+class _collection(object):  # pylint: disable=invalid-name
+    """
+    Collection with a change stream that fails the first time that it is
+    opened
+    """
+
+    def __init__(self):
+        self.resume_tokens = []
+        self.streams = []
+
+    def watch(self, pipeline, resume_after=None, max_await_time_ms=None):
+        # pylint: disable=unused-argument
+        self.resume_tokens.append(resume_after)
+        if len(self.resume_tokens) == 1:
+            stream = _stream(
+                [{"_id": {"token": 1}, "operationType": "delete", "documentKey": {"_id": "a"}}],
+                True, max_await_time_ms)
+        else:
+            stream = _stream([], False, max_await_time_ms)
+        self.streams.append(stream)
+        return stream
+
+
+def _wait_for(condition):
+    deadline = time.time() + 5
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+def test_cache_listener_restart():
+    """
+    Test that the change stream is reopened from the last change after it
+    fails, and that the cache is bypassed while it is not open
+    """
+    cache = file_cache(max_size=10, ttl=60)
+    cache.RETRY_DELAY = 0.2
+    collection = _collection()
+
+    cache.start_listener(collection)
+    _wait_for(lambda: len(collection.resume_tokens) == 1)
+    _wait_for(lambda: cache.get_stats()["stream_errors"] == 1)
+
+    # The stream is waiting to be reopened
+    cache.set("adam", "b", {"file_path": "/tmp/b"})
+    assert cache.get("adam", "b") is None
+    assert cache.get_stats()["bypassed"] == 1
+
+    _wait_for(lambda: cache.get_stats()["watching"])
+    assert collection.resume_tokens == [None, {"token": 1}]
+
+    cache.set("adam", "b", {"file_path": "/tmp/b"})
+    assert cache.get("adam", "b") == {"file_path": "/tmp/b"}
+
+    listener = cache.stop_listener(5)
+    assert listener.is_alive() is False
+
+
+def test_cache_listener_stop():
+    """
+    Test that stopping the listener closes the change stream without waiting
+    for a change, and that it can then be restarted with a single thread
+    """
+    cache = file_cache(max_size=10, ttl=60)
+    cache.RETRY_DELAY = 0.01
+    cache.MAX_AWAIT_TIME_MS = 50
+    collection = _collection()
+
+    cache.start_listener(collection)
+    _wait_for(lambda: len(collection.streams) == 2 and cache.get_stats()["watching"])
+
+    first = cache.stop_listener(5)
+    assert first.is_alive() is False
+    assert collection.streams[-1].closed
+    assert cache.get_stats()["watching"] is False
+    assert cache.stop_listener() is None
+
+    cache.start_listener(collection)
+    cache.start_listener(collection)
+    _wait_for(lambda: cache.get_stats()["watching"])
+    assert len(collection.streams) == 3
+
+    second = cache.stop_listener(5)
+    assert second is not first
+    assert second.is_alive() is False
@@ -0,0 +1,87 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+from dmp.connection import connection_manager, pool_stats
+
+
+def _write_config(tmpdir):
+    cnf_loc = tmpdir.join("dmp.cnf")
+    cnf_loc.write(
+        "[dmp]\n"
+        "host = localhost\n"
+        "port = 27017\n"
+        "user =\n"
+        "pass =\n"
+        "db = dmp_test\n"
+        "max_pool_size = 7\n"
+    )
+    return str(cnf_loc)
+
+
+def test_shared_client(tmpdir):
+    """
+    Test that requests for the same configuration share a client
+    """
+    cnf_loc = _write_config(tmpdir)
+
+    client = connection_manager.get_client(cnf_loc)
+    db_handle = connection_manager.get_database(cnf_loc)
+
+    assert connection_manager.get_client(cnf_loc) is client
+    assert db_handle.client is client
+    assert db_handle.name == "dmp_test"
+    assert client.options.pool_options.max_pool_size == 7
+    assert "checkouts" in connection_manager.get_pool_stats(cnf_loc)
+
+    connection_manager.close_all()
+
+
+def test_fork_reset(tmpdir):
+    """
+    Test that a forked process does not reuse the client of its parent
+    """
+    cnf_loc = _write_config(tmpdir)
+
+    client = connection_manager.get_client(cnf_loc)
+    connection_manager._pid = -1  # pylint: disable=protected-access
+    assert connection_manager.get_client(cnf_loc) is not client
+
+    connection_manager.close_all()
+
+
+def test_pool_stats():
+    """
+    Test the counting of connection pool events
+    """
+    stats = pool_stats()
+
+    stats.connection_created(None)
+    stats.connection_check_out_started(None)
+    stats.connection_check_out_started(None)
+    stats.connection_checked_out(None)
+    stats.connection_check_out_failed(None)
+    stats.connection_checked_in(None)
+
+    counters = stats.get_stats()
+    assert counters["open_sockets"] == 1
+    assert counters["checkouts"] == 1
+    assert counters["checkout_failures"] == 1
+    assert counters["waits"] == 1
+    assert counters["waiting"] == 0
+    assert counters["in_use"] == 0
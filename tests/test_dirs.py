@@ -0,0 +1,103 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import mongomock
+
+from dmp import dmp
+from dmp import schema
+
+
+def _load_tree(dm_handle, user):
+    """
+    Load a directory tree:
+    /root/a.txt, /root/sub/b.txt, /root/sub/c.txt
+    """
+    root = dm_handle.set_file(user, '/root', 'dir', 'txt', 0, None, 'data', 9606, meta_data={})
+    dm_handle.set_file(
+        user, '/root/a.txt', 'file', 'txt', 10, root, 'data', 9606, meta_data={})
+    sub = dm_handle.set_file(
+        user, '/root/sub', 'dir', 'txt', 0, root, 'data', 9606, meta_data={})
+    result = dm_handle.set_files([
+        {
+            'user_id': user, 'file_path': '/root/sub/' + name, 'path_type': 'file',
+            'file_type': 'txt', 'size': 100, 'parent_dir': sub, 'data_type': 'data',
+            'taxon_id': 9606
+        }
+        for name in ['b.txt', 'c.txt']
+    ])
+    assert result['errors'] == []
+    return root, sub
+
+
+def test_list_dir():
+    """
+    Test listing the contents of a directory
+    """
+    user = "dirs"
+    dm_handle = dmp(test=True)
+    root, sub = _load_tree(dm_handle, user)
+
+    assert sorted([f['file_path'] for f in dm_handle.list_dir(user, root)]) == [
+        '/root/a.txt', '/root/sub']
+    assert sorted([f['file_path'] for f in dm_handle.list_dir(user, root, True)]) == [
+        '/root/a.txt', '/root/sub', '/root/sub/b.txt', '/root/sub/c.txt']
+    assert len(dm_handle.list_dir(user, sub, True)) == 2
+
+    assert dm_handle.get_dir_usage(user, root) == {
+        'files': 3, 'dirs': 1, 'links': 0, 'size': 210}
+
+
+def test_move_dir():
+    """
+    Test that moving a directory moves everything below it
+    """
+    user = "dirs"
+    dm_handle = dmp(test=True)
+    root, sub = _load_tree(dm_handle, user)
+    other = dm_handle.set_file(user, '/other', 'dir', 'txt', 0, None, 'data', 9606, meta_data={})
+
+    dm_handle.modify_column(user, sub, 'parent_dir', other)
+
+    assert dm_handle.get_dir_usage(user, root)['size'] == 10
+    assert dm_handle.get_dir_usage(user, other) == {
+        'files': 2, 'dirs': 1, 'links': 0, 'size': 200}
+
+    try:
+        dm_handle.modify_column(user, other, 'parent_dir', sub)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_migrate_ancestors():
+    """
+    Test that the materialised paths are added to existing entries
+    """
+    db_handle = mongomock.MongoClient()["dmp"]
+    root = db_handle.entries.insert_one(
+        {"user_id": "adam", "path_type": "dir", "parent_dir": None}).inserted_id
+    sub = db_handle.entries.insert_one(
+        {"user_id": "adam", "path_type": "dir", "parent_dir": str(root)}).inserted_id
+    leaf = db_handle.entries.insert_one(
+        {"user_id": "adam", "path_type": "file", "parent_dir": str(sub)}).inserted_id
+
+    schema.upgrade(db_handle)
+
+    assert db_handle.entries.find_one({"_id": root})["ancestors"] == []
+    assert db_handle.entries.find_one({"_id": leaf})["ancestors"] == [root, sub]
@@ -17,6 +17,10 @@
 
 from __future__ import print_function
 
+import types
+
+import pymongo
+
 from dmp import dmp
 
 
@@ -46,3 +50,87 @@ def test_files_by_user_rest():
         results = dm_handle.get_files_by_user(user, True)
         for result in results:
             assert 'file_path' not in result
+
+
+def test_iter_files():
+    """
+    Test streaming the files for a user matches the list of files
+    """
+    users = ["adam", "ben", "chris", "denis", "eric", "test"]
+
+    dm_handle = dmp(test=True)
+
+    for user in users:
+        results = dm_handle.get_files_by_user(user)
+        streamed = dm_handle.iter_files(user, batch_size=2)
+        assert isinstance(streamed, types.GeneratorType) is True
+        assert list(streamed) == results
+
+    results = dm_handle.get_files_by_file_type("test", "hdf5")
+    assert list(dm_handle.iter_files("test", "file_type", "hdf5")) == results
+
+
+def test_files_by_user_paged():
+    """
+    Test paging through the files for a user with a keyset cursor
+    """
+    user = "test"
+
+    dm_handle = dmp(test=True)
+
+    results = dm_handle.get_files_by_user(user, sort=pymongo.ASCENDING)
+
+    pages = []
+    after = None
+    while True:
+        page = dm_handle.get_files_by_user(user, limit=2, after=after)
+        if not isinstance(page, list):
+            break
+        assert len(page) <= 2
+        pages += page
+        after = (page[-1]['creation_time'], page[-1]['_id'])
+
+    assert [f['_id'] for f in pages] == [f['_id'] for f in results]
+
+    reverse = dm_handle.get_files_by_user(user, sort=pymongo.DESCENDING)
+    assert [f['_id'] for f in reverse] == [f['_id'] for f in reversed(results)]
+
+    last = reverse[1]
+    page = dm_handle.get_files_by_user(
+        user, limit=1, after=(last['creation_time'], last['_id']), sort=pymongo.DESCENDING)
+    assert page[0]['_id'] == reverse[2]['_id']
+
+
+def test_files_by_owners():
+    """
+    Test retrieving the files of a user together with the common files
+    """
+    dm_handle = dmp(test=True)
+    dm_handle.set_file(
+        "common", "/tmp/common/genome.fa", "file", "fa", 64000, None, "Assembly", 9606, None)
+
+    own = dm_handle.get_files_by_user("test")
+    common = dm_handle.get_files_by_user("common")
+    merged = sorted(own + common, key=lambda f: (f['creation_time'], f['_id']))
+
+    results = dm_handle.get_files_by_user("test", owners=["test", "common", "test"])
+    assert [f['_id'] for f in results] == [f['_id'] for f in merged]
+
+    pages = []
+    after = None
+    while True:
+        page = dm_handle.get_files_by_user(
+            "test", owners=["test", "common"], limit=3, after=after)
+        if not isinstance(page, list):
+            break
+        pages += page
+        after = (page[-1]['creation_time'], page[-1]['_id'])
+    assert pages == results
+
+    streamed = dm_handle.iter_files("test", "file_type", "fa", owners=["test", "common"])
+    assert [f['file_path'] for f in streamed] == ["/tmp/common/genome.fa"]
+
+    plan = dm_handle.entries.find(
+        {"user_id": {"$in": ["test", "common"]}}).sort(
+            [("creation_time", 1), ("_id", 1)]).explain()["queryPlanner"]["winningPlan"]
+    assert plan["inputStage"]["stage"] == "SORT_MERGE"
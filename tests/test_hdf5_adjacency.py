@@ -19,9 +19,25 @@ from __future__ import print_function
 
 import os
 
+import h5py
+import numpy as np
+import pytest
+
+from dm_generator.GenerateSampleAdjacency import GenerateSampleAdjacency
 from reader.hdf5_adjacency import adjacency
 
 
+def _open_file(filename, resolution):
+    """
+    Reader for a generated file rather than the sample file
+    """
+    hdf5_handle = adjacency('test', '', resolution)
+    hdf5_handle.hdf5_handle.close()
+    hdf5_handle.hdf5_handle = h5py.File(filename, "r")
+    hdf5_handle.set_resolution(resolution)
+    return hdf5_handle
+
+
 def test_range():
     """
     Test the range function
@@ -34,3 +50,238 @@ def test_range():
     results_count = len(results['results'])
     assert 'results' in results
     assert results_count > 0
+
+
+def _expected_entries(  # pylint: disable=too-many-arguments,too-many-locals
+        hdf5_handle, chr_id, start, end, col_start, col_end, no_links):
+    """
+    Entries for the non-zero cells of a block of the matrix, built one cell
+    at a time from the chromosome parameters
+    """
+    resolution = hdf5_handle.resolution
+    chr_bins = dict(
+        (name, hdf5_handle.chr_param[name]["bins"][resolution]) for name in hdf5_handle.chr_ids)
+    row_start = chr_bins[chr_id][1] + start // resolution
+    row_end = chr_bins[chr_id][1] + -(-end // resolution)
+    block = hdf5_handle.hdf5_handle[str(resolution)][row_start:row_end, col_start:col_end]
+
+    expected = []
+    for i in range(block.shape[0]):
+        for j in range(block.shape[1]):
+            if block[i, j] == 0:
+                continue
+            pos_y = col_start + j
+            chr_b = [
+                name for name in hdf5_handle.chr_ids
+                if chr_bins[name][1] <= pos_y < chr_bins[name][2]][0]
+            entry = {
+                "chrA": chr_id,
+                "startA": (row_start + i - chr_bins[chr_id][1]) * resolution,
+                "chrB": chr_b,
+                "startB": (pos_y - chr_bins[chr_b][1]) * resolution,
+                "value": int(block[i, j]),
+                "pos_x": row_start + i,
+                "pos_y": pos_y
+            }
+            if no_links is None:
+                entry["_links"] = {
+                    "self": "/api/getValue?file_id=&res=" + str(resolution) +
+                            "&pos_x=" + str(row_start + i) + "&pos_y=" + str(pos_y)
+                }
+            expected.append(entry)
+    return expected
+
+
+def test_range_entries():
+    """
+    Test the entries returned by get_range against the cells of the matrix,
+    for the whole genome and limited to a chromosome, with and without links
+    """
+    hdf5_handle = adjacency('test', '', 100000)
+    chr_bins = hdf5_handle.chr_param["chr2"]["bins"][100000]
+    total_bins = hdf5_handle.chr_param["meta"]["totalBinCount"][100000][1]
+
+    queries = [
+        ({}, 0, total_bins),
+        ({"no_links": 1}, 0, total_bins),
+        ({"limit_chr": "chr2"}, chr_bins[1], chr_bins[2]),
+        ({"limit_chr": "chr2", "no_links": 1}, chr_bins[1], chr_bins[2]),
+        ({"limit_chr": "chr2", "limit_start": 1000000, "limit_end": 3000000},
+         chr_bins[1] + 10, chr_bins[1] + 30),
+    ]
+    for kwargs, col_start, col_end in queries:
+        results = hdf5_handle.get_range('chr1', 1000000, 2500000, **kwargs)["results"]
+        expected = _expected_entries(
+            hdf5_handle, 'chr1', 1000000, 2500000, col_start, col_end, kwargs.get("no_links"))
+        assert expected
+        assert results == expected
+
+
+def test_chromosomes_from_array_indexes():
+    """
+    Test that the batch chromosome lookup matches the bin offsets of each
+    chromosome, including the first and last bin of each chromosome
+    """
+    hdf5_handle = adjacency('test', '', 10000)
+
+    indexes = []
+    expected = []
+    for chr_id in hdf5_handle.chr_ids:
+        chr_bins = hdf5_handle.chr_param[chr_id]["bins"][10000]
+        indexes += [chr_bins[1], chr_bins[1] + 1, chr_bins[2] - 1]
+        expected += [chr_id, chr_id, chr_id]
+
+    total_bins = hdf5_handle.chr_param["meta"]["totalBinCount"][10000][1]
+    indexes += [0, 3200, total_bins - 1, total_bins, total_bins + 1, -1]
+    expected += ["chr1", "chr2", "X", None, None, None]
+
+    assert hdf5_handle.get_chromosomes_from_array_indexes(indexes).tolist() == expected
+    assert [hdf5_handle.get_chromosome_from_array_index(i) for i in indexes] == expected
+
+    codes = hdf5_handle.get_chromosomes_from_array_indexes(indexes, codes=True)
+    assert codes[-3:].tolist() == [-1, -1, -1]
+    assert [hdf5_handle.chr_ids[code] for code in codes[:-3]] == expected[:-3]
+
+
+def test_range_chromosome_boundaries():
+    """
+    Test that cells in the first bin of a chromosome are assigned to that
+    chromosome, and that the positions of the cells can be used with
+    get_value
+    """
+    hdf5_handle = adjacency('test', '', 10000)
+    chr_starts = dict(
+        (chr_id, hdf5_handle.chr_param[chr_id]["bins"][10000][1])
+        for chr_id in hdf5_handle.chr_ids)
+
+    queries = [
+        {"no_links": 1},
+        {"no_links": 1, "limit_chr": "chr2"},
+        {"no_links": 1, "limit_chr": "X", "limit_start": 0, "limit_end": 2000000},
+    ]
+    for kwargs in queries:
+        results = hdf5_handle.get_range('chr1', 0, 200000, **kwargs)["results"]
+        assert results
+        for entry in results:
+            assert entry["pos_y"] == chr_starts[entry["chrB"]] + entry["startB"] // 10000
+            assert hdf5_handle.get_value(entry["pos_x"], entry["pos_y"]) == entry["value"]
+            if "limit_chr" in kwargs:
+                assert entry["chrB"] == kwargs["limit_chr"]
+
+    results = hdf5_handle.get_range('chr1', 0, 2000000, no_links=1)["results"]
+    firsts = [entry for entry in results if entry["pos_y"] == chr_starts["chr2"]]
+    assert firsts
+    assert all(entry["chrB"] == "chr2" and entry["startB"] == 0 for entry in firsts)
+
+
+def test_range_columnar():
+    """
+    Test that the columnar and npz outputs hold the same cells as the entries
+    """
+    hdf5_handle = adjacency('test', '', 10000)
+    entries = hdf5_handle.get_range('chr1', 100000, 200000, limit_chr='chr2', no_links=1)
+    columnar = hdf5_handle.get_range(
+        'chr1', 100000, 200000, limit_chr='chr2', output='columnar')['results']
+
+    rows = [
+        {
+            "chrA": columnar["chrA"],
+            "startA": int(columnar["startA"][i]),
+            "chrB": columnar["chr_ids"][columnar["chrB"][i]],
+            "startB": int(columnar["startB"][i]),
+            "value": int(columnar["value"][i]),
+            "pos_x": int(columnar["pos_x"][i]),
+            "pos_y": int(columnar["pos_y"][i])
+        } for i in range(len(columnar["value"]))
+    ]
+    assert rows == entries["results"]
+
+    frame = hdf5_handle.get_range(
+        'chr1', 100000, 200000, limit_chr='chr2', output='npz')['results']
+    loaded = adjacency.columns_from_npz(frame)
+    assert loaded["chr_ids"] == columnar["chr_ids"]
+    assert loaded["chrA"] == "chr1"
+    for key in ["chrB", "startA", "startB", "value", "pos_x", "pos_y"]:
+        assert loaded[key].tolist() == columnar[key].tolist()
+
+    with pytest.raises(ValueError):
+        hdf5_handle.get_range('chr1', 100000, 200000, output='json')
+
+
+def test_sparse_layout(tmpdir):
+    """
+    Test that a matrix stored in the sparse layout returns the same results as
+    the dense matrix
+    """
+    dense = adjacency('test', '', 100000)
+
+    sparse_file = str(tmpdir.join("sparse_adjacency.hdf5"))
+    with h5py.File(sparse_file, "w") as hdf5_handle:
+        matrix = dense.hdf5_handle["100000"]
+        values = matrix[:]
+        bin1, bin2 = np.nonzero(values)
+        GenerateSampleAdjacency.create_sparse_dataset(
+            hdf5_handle, "100000", bin1, bin2, values[bin1, bin2], values.shape[0],
+            matrix.attrs["chromosomes"])
+
+    sparse = _open_file(sparse_file, 100000)
+
+    assert sparse.get_chromosomes() == dense.get_chromosomes()
+    for kwargs in [
+            {},
+            {"limit_chr": "chr2"},
+            {"limit_chr": "X", "limit_start": 1000000, "limit_end": 5000000}]:
+        assert sparse.get_range('chr1', 1000000, 9000000, **kwargs)["results"] == \
+            dense.get_range('chr1', 1000000, 9000000, **kwargs)["results"]
+
+    for bin_i, bin_j in [(0, 0), (10, 20), (729, 729), (350, 12)]:
+        assert sparse.get_value(bin_i, bin_j) == dense.get_value(bin_i, bin_j)
+
+    with pytest.raises(IndexError):
+        sparse.get_value(730, 0)
+
+
+def test_upper_triangle(tmpdir):
+    """
+    Test that symmetric matrices that only store the upper triangle return the
+    same results as the full matrix, in both layouts
+    """
+    sample = adjacency('test', '', 100000)
+    values = sample.hdf5_handle["100000"][:]
+    chromosomes = sample.hdf5_handle["100000"].attrs["chromosomes"]
+    values = np.triu(values) + np.triu(values, 1).T
+    bin1, bin2 = np.nonzero(values)
+
+    readers = {}
+    for name in ["full", "dense_upper", "sparse_upper"]:
+        filename = str(tmpdir.join(name + ".hdf5"))
+        with h5py.File(filename, "w") as hdf5_handle:
+            if name == "sparse_upper":
+                GenerateSampleAdjacency.create_sparse_dataset(
+                    hdf5_handle, "100000", bin1, bin2, values[bin1, bin2], values.shape[0],
+                    chromosomes, symmetric=True)
+            else:
+                GenerateSampleAdjacency.create_dense_dataset(
+                    hdf5_handle, "100000", values, chromosomes, symmetric=name != "full")
+        readers[name] = _open_file(filename, 100000)
+
+    assert readers["full"].symmetric is False
+    assert readers["dense_upper"].symmetric is True
+    assert readers["sparse_upper"].symmetric is True
+
+    queries = [
+        ('chr1', 1000000, 9000000, {}),
+        ('chr2', 0, 16000000, {"limit_chr": "chr1"}),
+        ('chr1', 1000000, 9000000, {"limit_chr": "chr1"}),
+        ('X', 2000000, 6000000, {"limit_chr": "X", "limit_start": 0, "limit_end": 4000000}),
+    ]
+    for chr_id, start, end, kwargs in queries:
+        expected = readers["full"].get_range(chr_id, start, end, **kwargs)["results"]
+        assert expected
+        for name in ["dense_upper", "sparse_upper"]:
+            assert readers[name].get_range(chr_id, start, end, **kwargs)["results"] == expected
+
+    for bin_i, bin_j in [(0, 0), (10, 20), (20, 10), (729, 3), (350, 12)]:
+        expected = readers["full"].get_value(bin_i, bin_j)
+        assert readers["dense_upper"].get_value(bin_i, bin_j) == expected
+        assert readers["sparse_upper"].get_value(bin_i, bin_j) == expected
@@ -33,3 +33,72 @@ def test_history():
         for result in results:
             history = dm_handle.get_file_history(user, result['_id'])
             assert isinstance(history, list) is True
+
+
+def _load_lineage(dm_handle, user):
+    """
+    Load a chain of files with two merged roots:
+    fastq_1, fastq_2 -> bam -> bed -> tsv
+    """
+    fastq_1 = dm_handle.set_file(
+        user, '/tmp/lineage/1.fastq', 'file', 'fastq', 64000, None, 'RNA-seq', 9606,
+        meta_data={})
+    fastq_2 = dm_handle.set_file(
+        user, '/tmp/lineage/2.fastq', 'file', 'fastq', 64000, None, 'RNA-seq', 9606,
+        meta_data={})
+    bam = dm_handle.set_file(
+        user, '/tmp/lineage/1.bam', 'file', 'bam', 64000, None, 'RNA-seq', 9606,
+        source_id=[fastq_1, fastq_2],
+        meta_data={'assembly': 'GCA_0123456789', 'tool': 'bwa_aligner'})
+    bed = dm_handle.set_file(
+        user, '/tmp/lineage/1.bed', 'file', 'bed', 64000, None, 'RNA-seq', 9606,
+        source_id=[bam], meta_data={'assembly': 'GCA_0123456789', 'tool': 'macs2'})
+    tsv = dm_handle.set_file(
+        user, '/tmp/lineage/1.tsv', 'file', 'tsv', 64000, None, 'RNA-seq', 9606,
+        source_id=[bed], meta_data={'tool': 'summary'})
+    return [fastq_1, fastq_2, bam, bed, tsv]
+
+
+def test_history_lineage():
+    """
+    Test that the aggregation and the batched fallback both resolve the full
+    history and honour max_depth.
+    """
+    user = "lineage"
+    dm_handle = dmp(test=True)
+    fastq_1, fastq_2, bam, bed, tsv = _load_lineage(dm_handle, user)
+
+    expected = [[tsv, bed], [bed, bam], [bam, fastq_1], [bam, fastq_2]]
+
+    history = dm_handle.get_file_history(user, tsv)
+    assert sorted(history) == sorted(expected)
+    assert dm_handle._graph_lookup is True  # pylint: disable=protected-access
+
+    assert dm_handle.get_file_history(user, tsv, max_depth=1) == [[tsv, bed]]
+    assert sorted(dm_handle.get_file_history(user, tsv, max_depth=2)) == sorted(
+        [[tsv, bed], [bed, bam]])
+
+    dm_handle._graph_lookup = False  # pylint: disable=protected-access
+    assert sorted(dm_handle.get_file_history(user, tsv)) == sorted(expected)
+    assert sorted(dm_handle.get_file_history(user, tsv, max_depth=2)) == sorted(
+        [[tsv, bed], [bed, bam]])
+
+    result = dm_handle.get_file_by_id(user, bam)
+    assert result['source_id'] == [fastq_1, fastq_2]
+
+
+def test_descendants():
+    """
+    Test finding and removing the files derived from a file
+    """
+    user = "lineage"
+    dm_handle = dmp(test=True)
+    fastq_1, fastq_2, bam, bed, tsv = _load_lineage(dm_handle, user)
+
+    assert dm_handle.get_file_descendants(user, fastq_1) == [bam, bed, tsv]
+    assert dm_handle.get_file_descendants(user, fastq_2, max_depth=2) == [bam, bed]
+    assert dm_handle.get_file_descendants(user, tsv) == []
+
+    dm_handle.remove_file(user, bam, cascade=True)
+    remaining = [f['_id'] for f in dm_handle.get_files_by_user(user)]
+    assert sorted(remaining) == sorted([fastq_1, fastq_2])
@@ -0,0 +1,121 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import json
+import logging
+
+import pytest
+
+from dmp import dmp
+from dmp.instrumentation import query_recorder, histogram_sink, prometheus_sink, log_sink
+
+
+class _records(logging.Handler):  # pylint: disable=invalid-name
+    """
+    Keep the messages that are logged
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def test_query_stats():
+    """
+    Test that the time, documents, bytes and round trips of each call are
+    recorded
+    """
+    metrics = prometheus_sink()
+    da = dmp(test=True, instrumentation=query_recorder([metrics], count_bytes=True))
+
+    files = da.get_files_by_user("test")
+    da.get_file_history("test", files[-1]["_id"])
+    assert len(list(da.iter_files("test"))) == len(files)
+
+    with pytest.raises(ValueError):
+        da.modify_column("test", "0123456789ab0123456789ff", "data_type", "HiC")
+
+    stats = da.get_query_stats()
+    assert stats["get_files_by_user"]["calls"] == 1
+    assert stats["get_files_by_user"]["documents"] == len(files)
+    assert stats["get_files_by_user"]["bytes"] > 0
+    assert stats["get_files_by_user"]["round_trips"] == 1
+    assert stats["get_files_by_user"]["buckets"][-1][1] == 1
+    assert stats["iter_files"]["documents"] == len(files)
+    assert stats["get_file_history"]["round_trips"] >= 1
+    assert stats["modify_column"]["errors"] == 1
+
+    text = metrics.exposition()
+    assert 'dmp_calls_total{method="get_files_by_user"} 1' in text
+    assert 'dmp_call_duration_seconds_bucket{method="iter_files",le="+Inf"} 1' in text
+    assert 'dmp_errors_total{method="modify_column"} 1' in text
+
+    assert dmp(test=True).get_query_stats() == {}
+
+    # The bytes are only counted when they are asked for
+    da = dmp(test=True, instrumentation=query_recorder())
+    files = da.get_files_by_user("test")
+    stats = da.get_query_stats()
+    assert stats["get_files_by_user"]["documents"] == len(files)
+    assert stats["get_files_by_user"]["bytes"] == 0
+
+
+def test_slow_query_log():
+    """
+    Test that slow calls are logged with their queries and plans, and that
+    the log sink records each call
+    """
+    handler = _records()
+    for name in ["dmp.slow_query", "dmp.queries"]:
+        logging.getLogger(name).addHandler(handler)
+        logging.getLogger(name).setLevel(logging.INFO)
+
+    try:
+        recorder = query_recorder([histogram_sink(), log_sink()], slow_query_ms=1e-6)
+        da = dmp(test=True, instrumentation=recorder)
+        da.get_files_by_file_type("test", "fastq")
+    finally:
+        for name in ["dmp.slow_query", "dmp.queries"]:
+            logging.getLogger(name).removeHandler(handler)
+
+    assert len(handler.messages) == 2
+    call = json.loads(handler.messages[0])
+    assert call["method"] == "get_files_by_file_type"
+    assert call["slow"] is True
+
+    slow = json.loads(handler.messages[1])
+    assert slow["queries"][0]["query"] == {"user_id": "test", "file_type": "fastq"}
+    assert slow["queries"][0]["explain"]["stage"] == "FETCH"
+    assert recorder.get_stats()["get_files_by_file_type"]["slow"] == 1
+
+
+def test_from_config():
+    """
+    Test that sinks are created from the configuration parameter
+    """
+    recorder = query_recorder.from_config("prometheus, log", 100)
+    assert isinstance(recorder.get_sink(prometheus_sink), prometheus_sink)
+    assert isinstance(recorder.get_sink(log_sink), log_sink)
+    assert recorder.slow_query_ms == 100
+
+    with pytest.raises(ValueError):
+        query_recorder.from_config("statsd")
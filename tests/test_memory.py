@@ -0,0 +1,185 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import datetime
+
+import pymongo
+import pytest
+from bson.objectid import ObjectId
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+from dmp import dmp, rest
+from dmp.memory import memory_client
+
+
+def _load(collection, count=20):
+    now = datetime.datetime(2018, 1, 1)
+    collection.create_index(
+        [("user_id", 1), ("file_type", 1), ("creation_time", 1), ("_id", 1)], name="by_type")
+    collection.create_index([("user_id", 1), ("ancestors", 1)], name="by_ancestor")
+    collection.create_index([("expires", 1)], name="by_expiry")
+    for i in range(count):
+        collection.insert_one({
+            "user_id": "user_" + str(i % 2), "file_type": "bed" if i % 3 == 0 else "bam",
+            "creation_time": now + datetime.timedelta(seconds=i), "ancestors": [i % 4, 9],
+            "expires": now + datetime.timedelta(days=i - 10), "size": i
+        })
+    return now
+
+
+def test_memory_indexes():
+    """
+    Test that queries are answered from the indexes and match a full scan
+    """
+    entries = memory_client()["dmp"].entries
+    now = _load(entries)
+
+    cursor = entries.find({"user_id": "user_0", "file_type": "bam"}).sort(
+        [("creation_time", pymongo.DESCENDING), ("_id", pymongo.DESCENDING)]).limit(3)
+    plan = cursor.explain()["queryPlanner"]["winningPlan"]
+    assert plan["stage"] == "FETCH" and "filter" not in plan
+    assert plan["inputStage"]["indexName"] == "by_type"
+    assert [entry["size"] for entry in cursor] == [16, 14, 10]
+
+    cursor = entries.find({"user_id": "user_1", "ancestors": 3})
+    assert cursor.explain()["queryPlanner"]["winningPlan"]["inputStage"]["isMultiKey"] is True
+    assert sorted([entry["size"] for entry in cursor]) == [3, 7, 11, 15, 19]
+
+    expired = {"expires": {"$lte": now}}
+    cursor = entries.find(expired, {"size": 1, "_id": 0})
+    assert cursor.explain()["queryPlanner"]["winningPlan"]["inputStage"]["indexName"] == "by_expiry"
+    assert sorted([entry["size"] for entry in cursor]) == list(range(11))
+
+    plan = entries.find({"size": 4}).explain()["queryPlanner"]["winningPlan"]
+    assert plan["stage"] == "COLLSCAN"
+
+
+def test_memory_sort_merge():
+    """
+    Test that an ordered listing for several users merges the index runs of
+    each user rather than sorting the results
+    """
+    dm_handle = dmp(test=True, backend="memory")
+    dm_handle.set_file(
+        "common", "/tmp/common/genome.fa", "file", "fa", 64000, None, "Assembly", 9606, None)
+
+    cursor = dm_handle.entries.find({"user_id": {"$in": ["test", "common"]}}).sort(
+        [("creation_time", 1), ("_id", 1)])
+    plan = cursor.explain()["queryPlanner"]["winningPlan"]
+    assert plan["inputStage"]["stage"] == "SORT_MERGE"
+
+    owners = dm_handle.get_files_by_user("test", owners=["test", "common"])
+    assert [entry["_id"] for entry in cursor] == [ObjectId(entry["_id"]) for entry in owners]
+
+
+def test_memory_writes():
+    """
+    Test that the indexes follow updates and deletes
+    """
+    entries = memory_client()["dmp"].entries
+    now = _load(entries)
+
+    result = entries.update_many(
+        {"user_id": "user_0", "file_type": "bed"}, {"$set": {"file_type": "wig"}})
+    assert result.matched_count == result.modified_count == 4
+    assert entries.count_documents({"user_id": "user_0", "file_type": "bed"}) == 0
+    assert entries.count_documents({"user_id": "user_0", "file_type": "wig"}) == 4
+
+    assert entries.delete_many({"expires": {"$lte": now}}).deleted_count == 11
+    assert entries.count_documents({"expires": {"$lte": now}}) == 0
+    assert entries.count_documents({}) == 9
+
+    result = entries.update_one({"_id": "counter"}, {"$inc": {"files": 2}}, upsert=True)
+    assert result.upserted_id == "counter"
+    entries.update_one({"_id": "counter"}, {"$inc": {"files": 2}}, upsert=True)
+    assert entries.find_one("counter") == {"_id": "counter", "files": 4}
+
+    entry = entries.find_one_and_update(
+        {"_id": "counter"}, {"$unset": {"files": ""}},
+        return_document=pymongo.ReturnDocument.AFTER)
+    assert entry == {"_id": "counter"}
+
+    groups = entries.aggregate([
+        {"$match": {"user_id": "user_1"}},
+        {"$group": {"_id": "$file_type", "count": {"$sum": 1}, "size": {"$sum": "$size"}}}
+    ])
+    assert dict([(group["_id"], group["count"]) for group in groups]) == {"bam": 4, "bed": 1}
+
+
+def test_memory_unique():
+    """
+    Test that unique indexes are enforced
+    """
+    entries = memory_client()["dmp"].entries
+    entries.create_index([("user_id", 1), ("file_path", 1)], unique=True)
+    entries.insert_one({"user_id": "adam", "file_path": "/a"})
+
+    with pytest.raises(DuplicateKeyError):
+        entries.insert_one({"user_id": "adam", "file_path": "/a"})
+
+    with pytest.raises(BulkWriteError) as err:
+        entries.insert_many([
+            {"user_id": "adam", "file_path": "/b"},
+            {"user_id": "adam", "file_path": "/a"},
+            {"user_id": "adam", "file_path": "/c"}
+        ], ordered=False)
+    assert err.value.details["nInserted"] == 2
+    assert [error["index"] for error in err.value.details["writeErrors"]] == [1]
+
+    with pytest.raises(DuplicateKeyError):
+        entries.update_one({"file_path": "/b"}, {"$set": {"file_path": "/c"}})
+    assert entries.count_documents({"file_path": "/b"}) == 1
+
+
+def test_memory_graph_lookup():
+    """
+    Test the $graphLookup stage used for the file history
+    """
+    entries = memory_client()["dmp"].entries
+    root = entries.insert_one({"user_id": "adam", "source_id": None}).inserted_id
+    middle = entries.insert_one({"user_id": "adam", "source_id": [root]}).inserted_id
+    leaf = entries.insert_one({"user_id": "adam", "source_id": [middle]}).inserted_id
+
+    results = list(entries.aggregate([
+        {"$match": {"_id": leaf}},
+        {"$graphLookup": {
+            "from": "entries", "startWith": "$source_id", "connectFromField": "source_id",
+            "connectToField": "_id", "as": "ancestors",
+            "restrictSearchWithMatch": {"user_id": "adam"}
+        }}
+    ]))
+    assert sorted([entry["_id"] for entry in results[0]["ancestors"]]) == sorted([root, middle])
+
+
+def test_backends():
+    """
+    Test selecting the backend for the test databases
+    """
+    dm_handle = dmp(test=True, sample_data=False)
+    assert dm_handle.get_files_by_user("adam") == {"msg": "No files found"}
+    assert all([plan["indexed"] for plan in dm_handle.check_query_plans().values()])
+
+    dm_handle = dmp(test=True, backend="mongomock")
+    assert isinstance(dm_handle.get_files_by_user("adam"), list) is True
+
+    rest_handle = rest(test=True)
+    assert rest_handle.is_service("dmp") is True
+
+    with pytest.raises(ValueError):
+        dmp(test=True, backend="unknown")
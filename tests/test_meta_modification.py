@@ -15,7 +15,7 @@
    limitations under the License.
 """
 
-from dmp import dmp
+from dmp import dmp, queries
 
 
 def test_files_by_user():
@@ -37,3 +37,105 @@ def test_files_by_user():
     dm_handle.remove_file_metadata(user, file_id, 'test')
     result = dm_handle.get_file_by_id(user, file_id)
     assert 'test' not in result['meta_data'].keys()
+
+
+def test_invalid_change_restored():
+    """
+    Test that a change that fails validation is not applied
+    """
+    user = "test"
+    file_id = "0123456789ab0123456789aa"
+
+    dm_handle = dmp(test=True)
+
+    try:
+        dm_handle.remove_file_metadata(user, file_id, 'assembly')
+        assert False
+    except ValueError:
+        pass
+    result = dm_handle.get_file_by_id(user, file_id)
+    assert result['meta_data']['assembly'] == 'GCA_0123456789'
+
+    try:
+        dm_handle.modify_column(user, file_id, 'file_type', 'unknown')
+        assert False
+    except ValueError:
+        pass
+    assert dm_handle.get_file_by_id(user, file_id)['file_type'] == 'bb'
+
+    dm_handle.modify_column(user, file_id, 'size', '128')
+    assert dm_handle.get_file_by_id(user, file_id)['size'] == 128
+
+
+def test_bulk_update_metadata():
+    """
+    Test adding meta data to many files in one call
+    """
+    user = "test"
+
+    dm_handle = dmp(test=True)
+
+    results = dm_handle.get_files_by_user(user)
+    updates = [
+        {'user_id': user, 'file_id': result['_id'], 'key': 'project', 'value': 'MuG'}
+        for result in results
+    ]
+
+    summary = dm_handle.bulk_update_metadata(updates, batch_size=3)
+    assert summary['matched'] == len(results)
+    assert summary['errors'] == []
+
+    for result in dm_handle.get_files_by_user(user):
+        assert result['meta_data']['project'] == 'MuG'
+
+
+def test_bulk_update_unmatched():
+    """
+    Test that changes for files that do not exist, or belong to another user,
+    are reported and that the other changes are applied
+    """
+    user = "test"
+
+    dm_handle = dmp(test=True)
+    file_id = dm_handle.get_files_by_user(user)[0]['_id']
+
+    summary = dm_handle.bulk_update_metadata([
+        {'user_id': user, 'file_id': file_id, 'key': 'project', 'value': 'MuG'},
+        {'user_id': user, 'file_id': file_id, 'key': 'group', 'value': 'IRB'},
+        {'user_id': user, 'file_id': '0123456789ab0123456789ff', 'key': 'project', 'value': 'MuG'},
+        {'user_id': 'adam', 'file_id': file_id, 'key': 'project', 'value': 'MuG'},
+    ])
+    assert summary['matched'] == 1
+    assert summary['unmatched'] == ['0123456789ab0123456789ff', file_id]
+    assert summary['errors'] == []
+
+    meta_data = dm_handle.get_file_by_id(user, file_id)['meta_data']
+    assert meta_data['project'] == 'MuG'
+    assert meta_data['group'] == 'IRB'
+
+
+def test_update_not_applied_after_concurrent_change():
+    """
+    Test that a change that was validated against a document is not written
+    once another request has changed the fields that it depends on
+    """
+    user = "test"
+    file_id = "0123456789ab0123456789aa"
+
+    dm_handle = dmp(test=True)
+    entries = dm_handle.db_handle.entries
+    row_filter = {'user_id': user, '_id': queries.to_object_id(file_id)}
+
+    entry = entries.find_one(row_filter)
+    guard, old_value = queries.prepare_update(
+        entry, row_filter, 'meta_data.assembly', 'GCA_000001405.22')
+    assert old_value == 'GCA_0123456789'
+
+    dm_handle.modify_column(user, file_id, 'file_type', 'bam')
+    assert entries.update_one(
+        guard, {'$set': {'meta_data.assembly': 'GCA_000001405.22'}}).matched_count == 0
+
+    dm_handle.add_file_metadata(user, file_id, 'assembly', 'GCA_000001405.22')
+    result = dm_handle.get_file_by_id(user, file_id)
+    assert result['meta_data']['assembly'] == 'GCA_000001405.22'
+    assert result['file_type'] == 'bam'
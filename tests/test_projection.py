@@ -0,0 +1,72 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import pytest
+
+from dmp import dmp
+
+
+def test_projection_presets():
+    """
+    Test that the named projections return the matching fields
+    """
+    da = dmp(test=True)
+
+    full = da.get_files_by_user("test")
+    assert full == da.get_files_by_user("test", fields="full")
+    assert da.get_files_by_user("test", rest=True) == da.get_files_by_user(
+        "test", fields="rest")
+
+    summary = da.get_files_by_user("test", fields="summary")
+    for file_obj in summary:
+        assert set(file_obj) == set(
+            ["_id", "file_path", "path_type", "file_type", "size", "data_type", "taxon_id",
+             "creation_time"])
+
+    with pytest.raises(ValueError):
+        da.get_files_by_user("test", fields="everything")
+
+
+def test_projection_fields():
+    """
+    Test that listed fields are returned and excluded fields are left out
+    """
+    da = dmp(test=True)
+    file_id = da.set_file(
+        "test", "/tmp/test/params.bam", "file", "bam", 64000, None, "RNA-seq", 9606, None,
+        meta_data={"assembly": "GCA_0123456789", "tool_params": {"k": "v" * 1000}})
+
+    file_obj = da.get_file_by_id("test", file_id, fields=["file_type"])
+    assert file_obj == {"_id": file_id, "file_type": "bam"}
+
+    file_obj = da.get_file_by_id("test", file_id, fields=["meta_data.assembly"])
+    assert file_obj["meta_data"] == {"assembly": "GCA_0123456789"}
+
+    file_obj = da.get_file_by_id("test", file_id, exclude=["meta_data.tool_params"])
+    assert "tool_params" not in file_obj["meta_data"]
+    assert "expiration_date" in file_obj["meta_data"]
+    assert "user_id" not in file_obj
+    assert file_obj["file_path"] == "/tmp/test/params.bam"
+
+    file_obj = da.get_file_by_id("test", file_id, fields="summary", exclude=["size"])
+    assert "size" not in file_obj
+    assert "meta_data" not in file_obj
+
+    files = list(da.iter_files("test", "file_type", "bam", exclude=["meta_data"]))
+    assert files and all("meta_data" not in file_obj for file_obj in files)
@@ -0,0 +1,48 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import datetime
+
+from dmp import dmp
+
+
+def test_purge_expired():
+    """
+    Test that only the expired files are removed, in batches
+    """
+    user = "adam"
+    expired = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+
+    dm_handle = dmp(test=True)
+
+    results = dm_handle.get_files_by_user(user)
+    total = len(dm_handle.get_files_by_user("test"))
+    for result in results:
+        dm_handle.add_file_metadata(user, result['_id'], 'expiration_date', expired)
+
+    summary = dm_handle.purge_expired(dry_run=True)
+    assert summary['files'] == len(results)
+    assert summary['bytes'] == sum([result['size'] for result in results])
+    assert len(dm_handle.get_files_by_user(user)) == len(results)
+
+    summary = dm_handle.purge_expired(batch_size=1)
+    assert summary['files'] == len(results)
+    assert summary['batches'] == len(results)
+    assert dm_handle.get_files_by_user(user) == {"msg": "No files found"}
+    assert len(dm_handle.get_files_by_user("test")) == total
@@ -0,0 +1,142 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import mongomock
+import pytest
+
+from dmp import dmp
+from dmp import schema
+
+
+def test_ensure_indexes():
+    """
+    Test that the indexes are created and that a second run is a no-op
+    """
+    dm_handle = dmp(test=True)
+
+    index_names = set(dm_handle.entries.index_information().keys())
+    for index in schema.ENTRIES_INDEXES:
+        assert index["name"] in index_names
+
+    assert dm_handle.ensure_indexes() == []
+    assert schema.get_known_indexes(dm_handle.db_handle) >= set(
+        [index["name"] for index in schema.ENTRIES_INDEXES])
+
+
+def test_check_version():
+    """
+    Test that the schema check only reads the version, once for a database,
+    and does not change the database
+    """
+    db_handle = mongomock.MongoClient()["dmp"]
+    db_handle.entries.insert_one({"user_id": "adam", "source_id": ["0123456789ab0123456789aa"]})
+
+    assert schema.check_version(db_handle) is False
+    assert db_handle.schema.find_one({"_id": "entries"}) is None
+    assert set(db_handle.entries.index_information().keys()) == set(["_id_"])
+    assert db_handle.entries.find_one()["source_id"] == ["0123456789ab0123456789aa"]
+
+    schema.upgrade(db_handle)
+    assert db_handle.schema.find_one({"_id": "entries"})["version"] == schema.SCHEMA_VERSION
+    assert schema.check_version(db_handle) is True
+
+    db_handle.entries.drop_indexes()
+    assert schema.check_version(db_handle) is True
+    assert "user_id_1_creation_time_1__id_1" not in db_handle.entries.index_information()
+
+
+def test_upgrade_lock():
+    """
+    Test that only one upgrade can run at a time, and that an expired lock is
+    replaced
+    """
+    db_handle = mongomock.MongoClient()["dmp"]
+    db_handle.entries.create_index([("user_id", 1)], name="user_id_1")
+
+    owner = schema.acquire_upgrade_lock(db_handle)
+    with pytest.raises(RuntimeError):
+        schema.upgrade(db_handle)
+    assert schema.get_version(db_handle) == 0
+    assert "user_id_1" in db_handle.entries.index_information()
+    schema.release_upgrade_lock(db_handle, owner)
+
+    schema.acquire_upgrade_lock(db_handle, ttl=-1)
+    schema.upgrade(db_handle)
+    assert schema.get_version(db_handle) == schema.SCHEMA_VERSION
+    assert "user_id_1" not in db_handle.entries.index_information()
+    assert db_handle.schema.find_one({"_id": schema.UPGRADE_LOCK}) is None
+
+
+def test_upgrade_source_ids():
+    """
+    Test that string source_id links are migrated to ObjectId
+    """
+    db_handle = mongomock.MongoClient()["dmp"]
+    parent_id = db_handle.entries.insert_one({"user_id": "adam", "source_id": None}).inserted_id
+    child_id = db_handle.entries.insert_one(
+        {"user_id": "adam", "source_id": [str(parent_id), "1"]}).inserted_id
+
+    schema.upgrade(db_handle)
+
+    child = db_handle.entries.find_one({"_id": child_id})
+    assert child["source_id"] == [parent_id, "1"]
+    assert db_handle.schema.find_one({"_id": "entries"})["version"] == schema.SCHEMA_VERSION
+
+
+def test_query_plans():
+    """
+    Test that every public getter is served by an index
+    """
+    dm_handle = dmp(test=True)
+
+    plans = dm_handle.check_query_plans()
+    for getter, plan in plans.items():
+        print(getter, plan)
+        assert plan["indexed"] is True
+
+    dm_handle.entries.drop_index("user_id_1_meta_data.assembly_1_creation_time_1__id_1")
+    plans = dm_handle.check_query_plans()
+    assert plans["get_files_by_assembly"]["indexed"] is False
+
+
+def test_unique_file_path():
+    """
+    Test that the file_path index can be made unique
+    """
+    dm_handle = dmp(test=True)
+
+    assert dm_handle.ensure_indexes(unique_file_path=True) == [schema.FILE_PATH_INDEX]
+    index_info = dm_handle.entries.index_information()
+    assert index_info[schema.FILE_PATH_INDEX]["unique"] is True
+
+
+def test_unique_file_path_duplicates():
+    """
+    Test that the file_path index is kept when there are duplicate paths
+    """
+    dm_handle = dmp(test=True)
+    entry = dm_handle.entries.find_one({"user_id": "adam"})
+    entry.pop("_id")
+    dm_handle.entries.insert_one(entry)
+
+    with pytest.raises(ValueError):
+        dm_handle.ensure_indexes(unique_file_path=True)
+    index_info = dm_handle.entries.index_information()
+    assert schema.FILE_PATH_INDEX in index_info
+    assert not index_info[schema.FILE_PATH_INDEX].get("unique")
@@ -0,0 +1,72 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+from bson.objectid import ObjectId
+
+from dmp import dmp
+
+
+def _records(user, count):
+    return [
+        {
+            "user_id": user, "file_path": "/tmp/bulk/test_" + str(i) + ".fastq",
+            "path_type": "file", "file_type": "fastq", "size": 64000,
+            "data_type": "RNA-seq", "taxon_id": 9606
+        }
+        for i in range(count)
+    ]
+
+
+def test_set_files():
+    """
+    Test the bulk loading of files in several batches
+    """
+    user = "bulk"
+    dm_handle = dmp(test=True)
+
+    result = dm_handle.set_files(_records(user, 25), batch_size=10)
+
+    assert result["errors"] == []
+    assert len(result["ids"]) == 25
+    files = dm_handle.get_files_by_user(user)
+    assert sorted(result["ids"]) == sorted([f["_id"] for f in files])
+
+
+def test_set_files_errors():
+    """
+    Test that bad records are reported without stopping the rest of the load
+    """
+    user = "bulk"
+    dm_handle = dmp(test=True)
+
+    records = _records(user, 5)
+    records[1]["file_type"] = "unknown"
+    records[3]["_id"] = ObjectId()
+    records[4]["_id"] = records[3]["_id"]
+
+    result = dm_handle.set_files(records)
+
+    assert [error["index"] for error in result["errors"]] == [1, 4]
+    assert result["ids"][1] is None
+    assert result["ids"][4] is None
+    assert len(dm_handle.get_files_by_user(user)) == 3
+
+    result = dm_handle.set_files(_records("bulk_ordered", 3)[:1] + [{"user_id": "x"}], ordered=True)
+    assert result["ids"][0] is not None
+    assert result["errors"][0]["index"] == 1
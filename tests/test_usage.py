@@ -0,0 +1,68 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+from dmp import dmp
+
+
+def _summed_usage(dm_handle, user):
+    results = dm_handle.get_files_by_user(user)
+    if not isinstance(results, list):
+        return {"files": 0, "size": 0}
+    return {"files": len(results), "size": sum([result["size"] for result in results])}
+
+
+def test_usage_summary():
+    """
+    Test the server side grouping of the stored files
+    """
+    users = ["adam", "ben", "chris", "denis", "eric", "test"]
+    dm_handle = dmp(test=True)
+
+    summary = dm_handle.get_usage_summary()
+    for user in users:
+        row = [r for r in summary if r["user_id"] == user][0]
+        assert {"files": row["files"], "size": row["size"]} == _summed_usage(dm_handle, user)
+
+    summary = dm_handle.get_usage_summary("test", ["file_type"])
+    assert sorted([r["file_type"] for r in summary]) == ["bb", "bw", "hdf5"]
+    assert sum([r["files"] for r in summary]) == 4
+
+
+def test_usage_counters():
+    """
+    Test that the stored counters follow the changes to the files
+    """
+    user = "adam"
+    dm_handle = dmp(test=True)
+
+    assert dm_handle.get_user_usage(user) == _summed_usage(dm_handle, user)
+
+    results = dm_handle.get_files_by_user(user)
+    dm_handle.modify_column(user, results[0]["_id"], "size", 1)
+    assert dm_handle.get_user_usage(user) == _summed_usage(dm_handle, user)
+
+    dm_handle.remove_file(user, results[0]["_id"])
+    assert dm_handle.get_user_usage(user) == _summed_usage(dm_handle, user)
+
+    dm_handle.remove_files(user, [result["_id"] for result in results[1:]])
+    assert dm_handle.get_user_usage(user) == {"files": 0, "size": 0}
+
+    dm_handle.db_handle.usage.drop()
+    dm_handle.rebuild_usage()
+    assert dm_handle.get_user_usage("ben") == _summed_usage(dm_handle, "ben")
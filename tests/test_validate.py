@@ -0,0 +1,103 @@
+"""
+.. See the NOTICE file distributed with this work for additional information
+   regarding copyright ownership.
+
+   Licensed under the Apache License, Version 2.0 (the "License");
+   you may not use this file except in compliance with the License.
+   You may obtain a copy of the License at
+
+       http://www.apache.org/licenses/LICENSE-2.0
+
+   Unless required by applicable law or agreed to in writing, software
+   distributed under the License is distributed on an "AS IS" BASIS,
+   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+   See the License for the specific language governing permissions and
+   limitations under the License.
+"""
+
+from __future__ import print_function
+
+import importlib
+
+import pytest
+
+from dmp import dmp
+
+# The dmp package exports the dmp class under the name of its module
+dmp_module = importlib.import_module("dmp.dmp")
+
+
+def _entry(**kwargs):
+    entry = {
+        "user_id": "test", "file_path": "/tmp/sample.bam", "path_type": "file",
+        "file_type": "bam", "size": 64000, "taxon_id": 9606,
+        "meta_data": {"assembly": "GCA_000001405.22"}
+    }
+    entry.update(kwargs)
+    return entry
+
+
+def test_validate_file():
+    """
+    Test that the first problem with an entry is raised
+    """
+    assert dmp.validate_file(_entry()) is True
+
+    with pytest.raises(ValueError) as err:
+        dmp.validate_file(_entry(file_type="unknown", meta_data={}))
+    assert str(err.value).startswith("File type must be one of the valid file types")
+
+    with pytest.raises(TypeError):
+        dmp.validate_file(_entry(size="64000"))
+
+    with pytest.raises(ValueError) as err:
+        dmp.validate_file(_entry(meta_data={}))
+    assert "assembly" in str(err.value)
+
+    with pytest.raises(ValueError) as err:
+        dmp.validate_file(_entry(source_id=["5a0c1e7a4e4c2c3b5c000000"]))
+    assert "Tool" in str(err.value)
+
+
+def test_validate_files():
+    """
+    Test that all of the problems with each entry in a batch are reported
+    """
+    records = [
+        _entry(),
+        _entry(path_type="other", size=None),
+        _entry(file_type="", taxon_id=None),
+    ]
+
+    report = dmp.validate_files(records)
+
+    assert [item["index"] for item in report] == [1, 2]
+    assert report[0]["errors"] == [
+        "Path type must be of value file|dir|link", "Size must be an integer"]
+    assert len(report[1]["errors"]) == 2
+    assert dmp.validate_files(records[:1]) == []
+
+
+def test_register_file_types():
+    """
+    Test that extra file types can be added from the configuration
+    """
+    file_types = dmp_module.parse_file_types("vcfx:assembly, xmlx")
+    assert file_types == {"vcfx": ("assembly",), "xmlx": ()}
+
+    dm_handle = dmp(test=True, sample_data=False)
+    dm_handle.register_file_types(file_types)
+    entry = _entry(file_type="xmlx", meta_data={})
+    assert dmp.validate_file(entry, dm_handle.file_types) is True
+    with pytest.raises(ValueError):
+        dmp.validate_file(_entry(file_type="vcfx", meta_data={}), dm_handle.file_types)
+    assert dm_handle.set_file(
+        "test", "/tmp/sample.xmlx", "file", "xmlx", 64000, taxon_id=9606) is not None
+
+    # The file types are only registered for that object
+    assert "xmlx" not in dmp_module.FILE_TYPES
+    with pytest.raises(ValueError):
+        dmp.validate_file(entry)
+    with pytest.raises(ValueError):
+        dmp(test=True, sample_data=False).set_file(
+            "test", "/tmp/sample.xmlx", "file", "xmlx", 64000, taxon_id=9606)